@@ -0,0 +1,257 @@
+"""Load test of the tokenization API with BigQuery shaped batches.
+
+Drives the routes through the ASGI app, without a server: remote function deidentify
+of new and of existing rows, reidentify, /token, /token/find, and the listing and
+deletion of identities. Batches have sizes, ratios of repeated rows and token types
+like those of BigQuery remote function calls.
+
+Tokens are stored in the in-memory store, whose round trips are counted and delayed
+by --latency seconds to stand in for Firestore, or in the Firestore emulator with
+--store firestore and FIRESTORE_EMULATOR_HOST set. The token cache is disabled unless
+--cache is given, so every request reaches the store.
+
+Reports rows/s, p50 and p99 request latency and store round trips per row, and the
+change in rows/s against a saved baseline. Run with
+
+    python -m benchmarks.bench_api
+    python -m benchmarks.bench_api --sizes 1,100,10000,50000 --save
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+BASELINE = Path(__file__).with_name("baseline.json")
+# rows of each identity in a batch
+ROWS_PER_IDENTITY = 10
+
+
+def make_calls(run: str, size: int, data_type: str, duplicates: float) -> List[list]:
+    """Create deidentify calls of new identities, duplicates is the repeated share."""
+    unique = max(1, round(size * (1 - duplicates)))
+    values = {
+        "STRING": lambda i: f"user{i}@example.com",
+        "INT": lambda i: 10**8 + i,
+        "FLOAT": lambda i: i + 0.25,
+    }[data_type]
+    rows = [
+        [f"bench-{run}", str(i // ROWS_PER_IDENTITY), values(i)] for i in range(unique)
+    ]
+    calls = rows + [random.choice(rows) for _ in range(size - unique)]
+    random.shuffle(calls)
+    return calls
+
+
+def percentile(timings: List[float], share: float) -> float:
+    """Get a percentile of timings in milliseconds."""
+    if len(timings) == 1:
+        return timings[0] * 1000
+    return statistics.quantiles(timings, n=100, method="inclusive")[
+        round(share * 100) - 1
+    ] * 1000
+
+
+class Bench:
+    """Runs the scenarios against the app and collects their results."""
+
+    def __init__(self, client: Any, store: Any, repeat: int) -> None:
+        self.client = client
+        self.store = store
+        self.repeat = repeat
+        self.results: Dict[str, Dict[str, float]] = {}
+
+    def rpcs(self) -> int:
+        """Get the number of store round trips so far, 0 if they aren't counted."""
+        counts = getattr(self.store, "rpcs", {})
+        return sum(count for kind, count in counts.items() if "_" not in kind)
+
+    async def measure(
+        self, name: str, rows: int, request: Callable[[int], Any]
+    ) -> List[Any]:
+        """Time repeat requests of rows rows, request gets the repetition."""
+        timings = []
+        responses = []
+        rpcs = self.rpcs()
+        for i in range(self.repeat):
+            start = time.perf_counter()
+            response = await request(i)
+            timings.append(time.perf_counter() - start)
+            assert response.status_code < 300, (name, response.text[:200])
+            responses.append(response)
+        total = rows * self.repeat
+        self.results[name] = {
+            "rows_per_s": round(total / sum(timings), 1),
+            "p50_ms": round(percentile(timings, 0.5), 3),
+            "p99_ms": round(percentile(timings, 0.99), 3),
+            "rpcs_per_row": round((self.rpcs() - rpcs) / total, 4),
+        }
+        return responses
+
+    async def remote_function(
+        self, action: str, calls: List[list], data_type: str
+    ) -> Any:
+        """Post a remote function request."""
+        return await self.client.post(
+            "/",
+            json={
+                "requestId": "benchmark",
+                "caller": "benchmark",
+                "sessionUser": "benchmark",
+                "userDefinedContext": {"action": action, "tokenType": data_type},
+                "calls": calls,
+            },
+        )
+
+    async def batches(self, size: int, data_type: str, duplicates: float) -> None:
+        """Deidentify new and existing rows of a shape, then reidentify them."""
+        shape = f"{size}/{data_type}/{duplicates:g}"
+        runs = [f"{shape}-{i}-{random.randrange(10**9)}" for i in range(self.repeat)]
+        calls = [make_calls(run, size, data_type, duplicates) for run in runs]
+        responses = await self.measure(
+            f"deidentify new {shape}",
+            size,
+            lambda i: self.remote_function("DEIDENTIFY", calls[i], data_type),
+        )
+        await self.measure(
+            f"deidentify existing {shape}",
+            size,
+            lambda i: self.remote_function("DEIDENTIFY", calls[i], data_type),
+        )
+        reidentify_calls = []
+        for run_calls, response in zip(calls, responses):
+            identities = {call[1] for call in run_calls}
+            identity_calls = [[run_calls[0][0], identity, identity] for identity in identities]
+            identity_tokens = dict(
+                zip(
+                    identities,
+                    (await self.remote_function("DEIDENTIFY", identity_calls, "STRING"))
+                    .json()["replies"],
+                )
+            )
+            reidentify_calls.append(
+                [
+                    [call[0], identity_tokens[call[1]], token]
+                    for call, token in zip(run_calls, response.json()["replies"])
+                ]
+            )
+        await self.measure(
+            f"reidentify {shape}",
+            size,
+            lambda i: self.remote_function("REIDENTIFY", reidentify_calls[i], data_type),
+        )
+
+    async def single_tokens(self) -> None:
+        """Create, find, list and delete tokens one request at a time."""
+        run = random.randrange(10**9)
+        creates = [
+            {
+                "identifier": f"bench-single-{run}",
+                "identity": str(i),
+                "value": f"user{i}@example.com",
+                "type": "STRING",
+                "method": "RANDOM",
+            }
+            for i in range(self.repeat)
+        ]
+        responses = await self.measure(
+            "create /token", 1, lambda i: self.client.post("/token", json=creates[i])
+        )
+        tokens = [response.json() for response in responses]
+        await self.measure(
+            "find /token/find",
+            1,
+            lambda i: self.client.post(
+                "/token/find",
+                json={
+                    key: tokens[i][key]
+                    for key in ("identifier", "identity_token", "token", "field")
+                },
+            ),
+        )
+        path = "/tokens/identifier/{identifier}/identity/{identity}"
+        await self.measure(
+            "list /tokens", 2, lambda i: self.client.get(path.format(**tokens[i]))
+        )
+        await self.measure(
+            "delete /tokens", 2, lambda i: self.client.delete(path.format(**tokens[i]))
+        )
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    """Run all scenarios."""
+    from httpx import AsyncClient
+
+    from tokenvaultapi.dependencies import services
+    from tokenvaultapi.main import api
+
+    store = services(api).token_service.token_dao.store
+    if hasattr(store, "latency"):
+        store.latency = args.latency
+    bench = Bench(AsyncClient(app=api, base_url="http://benchmark"), store, args.repeat)
+    async with bench.client:
+        for size in args.sizes:
+            for data_type in args.types:
+                for duplicates in args.duplicates:
+                    await bench.batches(size, data_type, duplicates)
+        await bench.single_tokens()
+    return bench.results
+
+
+def report(results: Dict[str, Dict[str, float]], baseline: Dict[str, Any]) -> None:
+    """Print the results, with the change in rows/s against the baseline."""
+    width = max(len(name) for name in results)
+    print(
+        f"{'scenario':<{width}} {'rows/s':>10} {'p50 ms':>9} {'p99 ms':>9}"
+        f" {'rpcs/row':>9} {'vs base':>8}"
+    )
+    for name, result in results.items():
+        base = baseline.get(name)
+        change = ""
+        if base:
+            change = f"{result['rows_per_s'] / base['rows_per_s'] - 1:+.0%}"
+        print(
+            f"{name:<{width}} {result['rows_per_s']:>10.0f} {result['p50_ms']:>9.2f}"
+            f" {result['p99_ms']:>9.2f} {result['rpcs_per_row']:>9.3f} {change:>8}"
+        )
+
+
+def main() -> None:
+    """Run the benchmark from the command line."""
+
+    def numbers(kind: Callable[[str], Any]) -> Callable[[str], List[Any]]:
+        return lambda value: [kind(item) for item in value.split(",")]
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=numbers(int), default=[1, 100, 1000, 10000])
+    parser.add_argument("--types", type=numbers(str), default=["STRING", "INT"])
+    parser.add_argument("--duplicates", type=numbers(float), default=[0, 0.5])
+    parser.add_argument("--repeat", type=int, default=5, help="requests per scenario")
+    parser.add_argument(
+        "--latency", type=float, default=0.002, help="seconds per store round trip"
+    )
+    parser.add_argument("--store", default="memory", help="memory or firestore")
+    parser.add_argument("--cache", action="store_true", help="enable the token cache")
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="save as the baseline")
+    args = parser.parse_args()
+    os.environ["TOKEN_STORE"] = args.store
+    if not args.cache:
+        os.environ["CACHE_MAX_SIZE"] = "0"
+    # the Firestore client is created at import, it's only used with --store firestore
+    os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+    os.environ.setdefault("GCLOUD_PROJECT", "benchmark")
+    random.seed(0)
+    results = asyncio.run(run(args))
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    report(results, baseline)
+    if args.save:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Micro-benchmark of primary key derivation per scheme, one row at a time vs batched.
+
+Run with `python -m benchmarks.bench_keys`.
+"""
+import random
+import string
+import timeit
+
+from tokenvaultapi.keys import V1, V2, derive_key, derive_keys
+
+
+def make_rows(count: int) -> list:
+    """Create rows of identifier, identity and an email-like value."""
+    alphabet = string.ascii_lowercase + string.digits
+    return [
+        [
+            "customers",
+            str(random.randrange(10**8)),
+            "".join(random.choices(alphabet, k=12)) + "@example.com",
+        ]
+        for _ in range(count)
+    ]
+
+
+def main() -> None:
+    """Time the per-row cost of each scheme."""
+    count = 100000
+    rows = make_rows(count)
+    print(f"{'scheme':>6} {'per row':>12} {'batched':>12}")
+    for scheme in (V1, V2):
+        single = min(
+            timeit.repeat(
+                lambda: [derive_key(row, scheme) for row in rows], number=1, repeat=3
+            )
+        )
+        batched = min(
+            timeit.repeat(lambda: derive_keys(rows, scheme), number=1, repeat=3)
+        )
+        single_ns, batched_ns = single / count * 1e9, batched / count * 1e9
+        print(f"{scheme:>6} {single_ns:>10.0f}ns {batched_ns:>10.0f}ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Tail latency of small requests while a large batch is deidentified.
+
+Small single row requests are posted every few milliseconds while one large batch of
+new rows is deidentified, with the CPU work of large batches run on the event loop and
+then offloaded to the process pool, see tokenvaultapi.executor. Tokens are stored in
+the in-memory store with a simulated round trip latency. Run with
+
+    python -m benchmarks.bench_offload --rows 50000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import time
+from typing import Any, Dict, List
+
+os.environ["TOKEN_STORE"] = "memory"
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("GCLOUD_PROJECT", "benchmark")
+
+from httpx import AsyncClient  # noqa: E402
+
+from tokenvaultapi.dependencies import services  # noqa: E402
+from tokenvaultapi.executor import offloader  # noqa: E402
+from tokenvaultapi.keys import derive_keys  # noqa: E402
+from tokenvaultapi.main import api  # noqa: E402
+
+
+def request(calls: List[list], method: str) -> Dict[str, Any]:
+    """Create a deidentify request."""
+    return {
+        "requestId": "benchmark",
+        "caller": "benchmark",
+        "sessionUser": "benchmark",
+        "userDefinedContext": {
+            "action": "DEIDENTIFY",
+            "tokenType": "STRING",
+            "method": method,
+        },
+        "calls": calls,
+    }
+
+
+async def run(client: AsyncClient, args: argparse.Namespace, run_id: str) -> Dict:
+    """Deidentify a large batch while timing small requests."""
+    small = request([["CUSTOMER_ID", "small", "small@example.com"]], args.method)
+    await client.post("/", json=small)
+    large = request(
+        [
+            ["CUSTOMER_ID", f"{run_id}-{i // 10}", f"user{i}@example.com"]
+            for i in range(args.rows)
+        ],
+        args.method,
+    )
+    timings = []
+    done = asyncio.Event()
+
+    async def post_small() -> None:
+        while not done.is_set():
+            start = time.perf_counter()
+            await client.post("/", json=small)
+            timings.append(time.perf_counter() - start)
+            await asyncio.sleep(args.interval)
+
+    smalls = asyncio.create_task(post_small())
+    start = time.perf_counter()
+    response = await client.post("/", json=large)
+    seconds = time.perf_counter() - start
+    done.set()
+    await smalls
+    assert response.status_code == 200, response.text[:200]
+    percentiles = statistics.quantiles(timings, n=100, method="inclusive")
+    return {
+        "large_s": seconds,
+        "small": len(timings),
+        "p50_ms": percentiles[49] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+        "max_ms": max(timings) * 1000,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    """Compare inline and offloaded CPU work."""
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    services(api).token_service.token_dao.store.latency = args.latency
+    print(f"{args.rows} rows {args.method}, a small request every {args.interval}s")
+    print(
+        f"{'cpu work':>9} {'large s':>8} {'small':>6} {'p50 ms':>8} {'p99 ms':>8}"
+        f" {'max ms':>8}"
+    )
+    async with AsyncClient(app=api, base_url="http://benchmark", timeout=600) as client:
+        for name, workers in (("inline", 0), ("offloaded", args.workers)):
+            offloader.workers = workers
+            if workers:
+                # start the pool before timing
+                await offloader.map(derive_keys, [["warm up"]] * offloader.threshold)
+            result = await run(client, args, name)
+            print(
+                f"{name:>9} {result['large_s']:>8.2f} {result['small']:>6}"
+                f" {result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f}"
+                f" {result['max_ms']:>8.1f}"
+            )
+    offloader.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--method", default="FORMAT_PRESERVING")
+    parser.add_argument("--workers", type=int, default=max(1, offloader.workers))
+    parser.add_argument("--interval", type=float, default=0.005)
+    parser.add_argument(
+        "--latency", type=float, default=0.002, help="seconds per store round trip"
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,99 @@
+"""Benchmark of a 10k row remote function request through the API, with a warm cache.
+
+All tokens are cached so no Firestore requests are made, which leaves request parsing,
+the DAO and response rendering. Run with `python -m benchmarks.bench_remote_function`.
+"""
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+
+# the Firestore client is created on first use, which a warm cache never gets to
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("GCLOUD_PROJECT", "benchmark")
+
+from tokenvaultapi.dependencies import services  # noqa: E402
+from tokenvaultapi.keys import derive_keys  # noqa: E402
+from tokenvaultapi.main import api  # noqa: E402
+from tokenvaultapi.schemas.token import Token  # noqa: E402
+
+ROWS = 10000
+
+
+def make_calls(count: int) -> list:
+    """Create calls of 100 identities."""
+    return [["CUSTOMER_ID", str(i % 100), f"user{i}@example.com"] for i in range(count)]
+
+
+async def warm_cache(calls: list) -> None:
+    """Cache a token for every call."""
+    tokens = {
+        pk: Token(
+            pk=pk,
+            identifier=call[0],
+            identity=call[1],
+            identity_token=call[1],
+            value=call[2],
+            token=f"token{i}",
+            type="STRING",
+            created_at=datetime.utcnow(),
+        )
+        for i, (pk, call) in enumerate(zip(derive_keys(calls), calls))
+    }
+    await services(api).token_service.token_dao.cache.set_many(tokens)
+
+
+async def post(body: bytes) -> bytes:
+    """Post a body to the root route of the API, without a server."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/",
+        "raw_path": b"/",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json")],
+        "server": ("testserver", 80),
+        "client": ("testclient", 50000),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive() -> dict:
+        return messages.pop() if messages else {"type": "http.disconnect"}
+
+    async def send(message: dict) -> None:
+        sent.append(message)
+
+    await api(scope, receive, send)
+    return b"".join(message.get("body", b"") for message in sent[1:])
+
+
+async def main() -> None:
+    """Time the request."""
+    calls = make_calls(ROWS)
+    await warm_cache(calls)
+    body = json.dumps(
+        {
+            "requestId": "benchmark",
+            "caller": "benchmark",
+            "sessionUser": "benchmark",
+            "userDefinedContext": {"action": "DEIDENTIFY", "tokenType": "STRING"},
+            "calls": calls,
+        }
+    ).encode()
+    assert len(json.loads(await post(body))["replies"]) == ROWS
+    timings = []
+    for _ in range(10):
+        start = time.perf_counter()
+        await post(body)
+        timings.append(time.perf_counter() - start)
+    print(f"{ROWS} rows: best {min(timings) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+"""Stored bytes and decode time of token documents per schema version.
+
+Run with `python -m benchmarks.bench_schema`. Sizes are Firestore's storage sizes,
+https://cloud.google.com/firestore/docs/storage-size, of the document and its name.
+"""
+import random
+import timeit
+from datetime import datetime
+from uuid import uuid4
+
+from tokenvaultapi.keys import derive_key
+from tokenvaultapi.stores.codec import V1, V2, encode, token_from_document
+from tokenvaultapi.tokenizers import tokenize_value
+
+
+def value_size(value) -> int:
+    """Get the storage size of a field value."""
+    if isinstance(value, str):
+        return len(value.encode()) + 1
+    # numbers and timestamps
+    return 8
+
+
+def document_size(pk: str, stored: dict) -> int:
+    """Get the storage size of a document of the tokens collection."""
+    name = len("tokens") + 1 + len(pk) + 1 + 16
+    fields = sum(len(key) + 1 + value_size(value) for key, value in stored.items())
+    return name + fields + 32
+
+
+def make_documents(count: int) -> list:
+    """Create token documents of identities with an identity document, an email and an
+    INT token each."""
+    documents = []
+    for _ in range(count // 3):
+        identity = str(random.randrange(10**8))
+        identity_token = str(uuid4())
+        email = f"user{random.randrange(10**8)}@example.com"
+        age = str(random.randrange(1, 100))
+        common = {
+            "identifier": "CUSTOMER_ID",
+            "identity": identity,
+            "identity_token": identity_token,
+            "field": "",
+            "created_at": datetime(2023, 9, 1, 12),
+        }
+        documents += [
+            {
+                **common,
+                "pk": derive_key(["CUSTOMER_ID", identity, identity]),
+                "value": identity,
+                "token": identity_token,
+                "type": "STRING",
+            },
+            {
+                **common,
+                "pk": derive_key(["CUSTOMER_ID", identity, email]),
+                "value": email,
+                "token": tokenize_value("FORMAT_PRESERVING", "STRING", email),
+                "type": "STRING",
+                "method": "FORMAT_PRESERVING",
+            },
+            {
+                **common,
+                "pk": derive_key(["CUSTOMER_ID", identity, age]),
+                "value": age,
+                "token": str(random.randrange(10, 100)),
+                "type": "INT",
+                "method": "FORMAT_PRESERVING",
+            },
+        ]
+    return documents
+
+
+def main() -> None:
+    """Print the bytes per document and decode time of each schema version."""
+    documents = make_documents(30000)
+    print(f"{'schema':>6} {'bytes/doc':>10} {'decode':>10}")
+    for version in (V1, V2):
+        stored = [(data["pk"], encode(data, version)) for data in documents]
+        size = sum(document_size(pk, data) for pk, data in stored) / len(stored)
+        seconds = min(
+            timeit.repeat(
+                lambda: [token_from_document(pk, data) for pk, data in stored],
+                number=1,
+                repeat=5,
+            )
+        )
+        print(f"v{version:>5} {size:>10.1f} {seconds / len(stored) * 1e9:>8.0f}ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Import time and startup of the app per token store.
+
+Run with `python -m benchmarks.bench_startup`. Every run is a new interpreter, which
+imports tokenvaultapi.main, then runs the lifespan of the app until /healthcheck reports
+ready, the time a Cloud Run instance takes to take its first request.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from statistics import median
+from typing import Dict
+
+# the child process, prints its timings as JSON
+CHILD = """
+import asyncio, json, sys, time
+started = time.perf_counter()
+from tokenvaultapi.main import api
+imported = time.perf_counter() - started
+firestore = "google.cloud.firestore" in sys.modules
+
+
+async def start():
+    started = time.perf_counter()
+    async with api.router.lifespan_context(api):
+        while not api.state.ready:
+            await asyncio.sleep(0.001)
+        return time.perf_counter() - started
+
+
+try:
+    ready = asyncio.run(asyncio.wait_for(start(), {timeout}))
+except asyncio.TimeoutError:
+    ready = None
+print(json.dumps({{"import": imported, "ready": ready, "firestore": firestore}}))
+"""
+
+
+def run(store: str, timeout: float) -> Dict:
+    """Import and start the app in a new interpreter with a token store."""
+    env = {
+        **os.environ,
+        "TOKEN_STORE": store,
+        "SQLITE_PATH": os.path.join(tempfile.mkdtemp(), "bench.db"),
+    }
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD.format(timeout=timeout)],
+        env=env,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main() -> None:
+    """Time the import and startup of the app per token store."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stores", default="firestore,sqlite,memory")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--timeout", type=float, default=10, help="seconds to wait for ready"
+    )
+    args = parser.parse_args()
+    print(f"{'store':>9} {'import s':>9} {'ready s':>8} {'firestore imported':>19}")
+    for store in args.stores.split(","):
+        runs = [run(store, args.timeout) for _ in range(args.repeat)]
+        ready = [result["ready"] for result in runs if result["ready"] is not None]
+        print(
+            f"{store:>9} {median(result['import'] for result in runs):>9.2f}"
+            f" {f'{median(ready):.2f}' if ready else '-':>8}"
+            f" {str(runs[0]['firestore']).lower():>19}"
+        )
+
+
+if __name__ == "__main__":
+    main()
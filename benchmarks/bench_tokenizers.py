@@ -0,0 +1,49 @@
+"""Micro-benchmark of format preserving tokenization, one value at a time vs batched.
+
+Run with `python -m benchmarks.bench_tokenizers`.
+"""
+import random
+import string
+import timeit
+
+from tokenvaultapi.tokenizers import tokenize_value, tokenize_values
+
+
+def make_values(count: int, length: int) -> list:
+    """Create random email-like values of roughly the given length."""
+    alphabet = string.ascii_letters + string.digits + ".-+ "
+    return [
+        "".join(random.choices(alphabet, k=length - 12)) + "@example.com"
+        for _ in range(count)
+    ]
+
+
+def main() -> None:
+    """Time both implementations for short and long strings."""
+    print(f"{'rows':>8} {'length':>7} {'per value':>12} {'batched':>12} {'speedup':>8}")
+    for count, length in [(10000, 20), (10000, 100), (1000, 1000), (100000, 20)]:
+        values = make_values(count, length)
+        single = min(
+            timeit.repeat(
+                lambda: [
+                    tokenize_value("FORMAT_PRESERVING", "STRING", v) for v in values
+                ],
+                number=1,
+                repeat=3,
+            )
+        )
+        batched = min(
+            timeit.repeat(
+                lambda: tokenize_values("FORMAT_PRESERVING", "STRING", values),
+                number=1,
+                repeat=3,
+            )
+        )
+        print(
+            f"{count:>8} {length:>7} {single * 1000:>10.1f}ms {batched * 1000:>10.1f}ms"
+            f" {single / batched:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
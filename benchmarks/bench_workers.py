@@ -0,0 +1,171 @@
+"""Load test of gunicorn worker settings over HTTP.
+
+Starts gunicorn with tokenvaultapi/gunicorn_config.py for each number of workers, with
+and without preload, against the in-memory store with a simulated Firestore latency.
+Measures the seconds until the server answers, then posts deidentify batches from
+concurrent clients and reports requests/s, rows/s and p50/p99 latency, as the mean and
+standard deviation of several runs of each setting. Run with
+
+    python -m benchmarks.bench_workers --workers 1,2,4 --concurrency 32 --runs 5
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import httpx
+
+PORT = 8765
+
+
+def start(workers: int, preload: bool, latency: float) -> subprocess.Popen:
+    """Start gunicorn with the config of the repository."""
+    env = {
+        **os.environ,
+        "PORT": str(PORT),
+        "WEB_CONCURRENCY": str(workers),
+        "GUNICORN_PRELOAD": str(preload).lower(),
+        "TOKEN_STORE": "memory",
+        "MEMORY_STORE_LATENCY_SECONDS": str(latency),
+        "LOGLEVEL": "WARNING",
+    }
+    env.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+    env.setdefault("GCLOUD_PROJECT", "benchmark")
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "--config",
+            "tokenvaultapi/gunicorn_config.py",
+            "--log-level",
+            "warning",
+            "tokenvaultapi.main:api",
+        ],
+        env=env,
+    )
+
+
+async def wait_ready(client: httpx.AsyncClient, workers: int) -> None:
+    """Wait until the server answers, and for every worker to have started."""
+    while True:
+        try:
+            response = await client.get("/healthcheck")
+            if response.status_code == 200:
+                break
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.05)
+    # the first worker answers before the others are up
+    await asyncio.gather(*(client.get("/healthcheck") for _ in range(workers * 8)))
+
+
+def batch(size: int) -> dict:
+    """Create a deidentify request of size rows, half of them seen before."""
+    calls = [
+        ["CUSTOMER_ID", str(random.randrange(1000)), f"user{random.randrange(10**6)}"]
+        for _ in range(size)
+    ]
+    return {
+        "requestId": "benchmark",
+        "caller": "benchmark",
+        "sessionUser": "benchmark",
+        "userDefinedContext": {"action": "DEIDENTIFY", "tokenType": "STRING"},
+        "calls": calls,
+    }
+
+
+async def load(
+    client: httpx.AsyncClient, concurrency: int, size: int, seconds: float
+) -> List[float]:
+    """Post batches from concurrent clients for seconds, returns the latencies."""
+    timings = []
+    deadline = time.perf_counter() + seconds
+
+    async def run() -> None:
+        while time.perf_counter() < deadline:
+            body = batch(size)
+            start = time.perf_counter()
+            response = await client.post("/", json=body)
+            timings.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.text[:200]
+
+    await asyncio.gather(*(run() for _ in range(concurrency)))
+    return timings
+
+
+async def measure(args: argparse.Namespace, workers: int, preload: bool) -> Dict:
+    """Measure the startup and throughput of a setting."""
+    started = time.perf_counter()
+    server = start(workers, preload, args.latency)
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{PORT}", limits=limits, timeout=60
+        ) as client:
+            await wait_ready(client, workers)
+            startup = time.perf_counter() - started
+            timings = await load(client, args.concurrency, args.size, args.seconds)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    percentiles = statistics.quantiles(timings, n=100)
+    return {
+        "startup_s": startup,
+        "requests_per_s": len(timings) / args.seconds,
+        "rows_per_s": len(timings) * args.size / args.seconds,
+        "p50_ms": percentiles[49] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+    }
+
+
+def spread(results: List[Dict], name: str, digits: int) -> str:
+    """Format the mean and standard deviation of a measure over the runs."""
+    values = [result[name] for result in results]
+    deviation = statistics.stdev(values) if len(values) > 1 else 0.0
+    return f"{statistics.mean(values):.{digits}f} ± {deviation:.{digits}f}"
+
+
+async def main(args: argparse.Namespace) -> None:
+    """Measure every setting, runs times each."""
+    print(
+        f"{os.cpu_count()} CPUs, {args.concurrency} clients, {args.size} rows/batch,"
+        f" {args.runs} runs"
+    )
+    print(
+        f"{'workers':>7} {'preload':>7} {'startup s':>13} {'req/s':>9}"
+        f" {'p50 ms':>15} {'p99 ms':>15}"
+    )
+    for workers in args.workers:
+        for preload in (False, True):
+            results = [await measure(args, workers, preload) for _ in range(args.runs)]
+            print(
+                f"{workers:>7} {str(preload):>7} {spread(results, 'startup_s', 2):>13}"
+                f" {spread(results, 'requests_per_s', 0):>9}"
+                f" {spread(results, 'p50_ms', 1):>15}"
+                f" {spread(results, 'p99_ms', 1):>15}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--workers",
+        type=lambda value: [int(item) for item in value.split(",")],
+        default=[1, 2, 4],
+    )
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--size", type=int, default=100, help="rows per batch")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--runs", type=int, default=5, help="runs of each setting")
+    parser.add_argument(
+        "--latency", type=float, default=0.005, help="seconds per store round trip"
+    )
+    asyncio.run(main(parser.parse_args()))
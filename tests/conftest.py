@@ -1,24 +1,72 @@
+import os
+import tempfile
+from datetime import datetime
 from starlette.testclient import TestClient
 from typing import Generator
 import pytest
 from httpx import AsyncClient
 from asyncio import get_event_loop, get_event_loop_policy
 
-# from tokenvaultapi.database import db
-from tokenvaultapi.main import api
 
-# @pytest.fixture
-# def anyio_backend():
-#     return 'asyncio'
+def pytest_configure(config):
+    """Run the tests offline, against a sqlite token store instead of Firestore.
+
+    Runs before the test modules are imported, and with them tokenvaultapi.config.
+    """
+    os.environ.setdefault("TOKEN_STORE", "sqlite")
+    os.environ.setdefault("SQLITE_PATH", os.path.join(tempfile.mkdtemp(), "test.db"))
+
+
+def document(pk: str, value: str, token: str = None, **fields) -> dict:
+    """Create a token document of identity 1, fields replace its defaults."""
+    return {
+        "pk": pk,
+        "identifier": "CUSTOMER_ID",
+        "identity": "1",
+        "identity_token": "identity-token",
+        "value": value,
+        "token": token or f"token-{value}",
+        "type": "STRING",
+        "field": "",
+        "method": "FORMAT_PRESERVING",
+        "created_at": datetime(2023, 9, 1, 12),
+        **fields,
+    }
+
+
+def token_create(call: list, method: str = "RANDOM"):
+    """Create the token create of a call of identifier, identity and value."""
+    # imported here, tokenvaultapi.config reads the environment of pytest_configure
+    from tokenvaultapi.keys import derive_key
+    from tokenvaultapi.schemas.token import TokenCreate
+
+    return TokenCreate(
+        pk=derive_key(call),
+        identifier=call[0],
+        identity=call[1],
+        value=call[2],
+        type="STRING",
+        method=method,
+    )
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    """Run the async tests on asyncio, which the app and its stores run on."""
+    return "asyncio"
+
 
 @pytest.fixture()
 def client():
+    from tokenvaultapi.main import api
+
     with TestClient(api) as client:
         yield client
 
 
 @pytest.fixture()
 async def async_client() -> Generator:
+    from tokenvaultapi.main import api
 
     async with AsyncClient(app=api, base_url="http://testserver") as async_client:
 
@@ -0,0 +1,237 @@
+"""In-memory stand-in for the Firestore async client, for the Firestore store tests.
+
+Only the calls the store and the migrations make are implemented. Queries filter with
+field filters, documents without a filtered field don't match like in Firestore, and
+batches are committed atomically. Every commit is a tick of the clock documents have the
+update time of, checked by the last_update_time preconditions of updates.
+"""
+import operator
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, Iterable, List
+
+from google.api_core.exceptions import (AlreadyExists, FailedPrecondition,
+                                        NotFound)
+from google.cloud.firestore_v1.base_query import BaseCompositeFilter
+
+OPERATORS = {
+    "==": operator.eq,
+    ">": operator.gt,
+    "<": operator.lt,
+    "in": lambda value, values: value in values,
+}
+
+
+class Snapshot:
+    """A document read."""
+
+    def __init__(self, reference: "Document", data: Dict[str, Any] = None) -> None:
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = reference.collection.update_times.get(reference.id)
+        self._data = data
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self._data) if self.exists else None
+
+    def get(self, field: str) -> Any:
+        return self._data[field]
+
+
+class Document:
+    """Reference to a document of a collection."""
+
+    def __init__(self, collection: "Collection", id: str) -> None:
+        self.collection = collection
+        self.id = id
+
+    def __hash__(self) -> int:
+        return hash((self.collection.name, self.id))
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, Document) and hash(self) == hash(other)
+
+    async def get(self) -> Snapshot:
+        self.collection.client.rpcs["get"] += 1
+        return self.collection.snapshot(self.id)
+
+    async def set(self, data: Dict[str, Any]) -> None:
+        batch = self.collection.client.batch()
+        batch.set(self, data)
+        await batch.commit()
+
+    async def update(self, data: Dict[str, Any]) -> None:
+        batch = self.collection.client.batch()
+        batch.update(self, data)
+        await batch.commit()
+
+
+class Query:
+    """Query of the documents of a collection."""
+
+    def __init__(self, collection: "Collection", **options: Any) -> None:
+        self.collection = collection
+        self.options = {
+            "filters": [],
+            "fields": None,
+            "start_after": None,
+            "limit": None,
+            **options,
+        }
+
+    def _with(self, **options: Any) -> "Query":
+        return Query(self.collection, **{**self.options, **options})
+
+    def where(self, filter: Any) -> "Query":
+        filters = [filter]
+        if isinstance(filter, BaseCompositeFilter):
+            filters = filter.filters
+        return self._with(filters=self.options["filters"] + list(filters))
+
+    def select(self, fields: List[str]) -> "Query":
+        return self._with(fields=list(fields))
+
+    def order_by(self, field: str) -> "Query":
+        # documents are always streamed in id order
+        assert field == "__name__"
+        return self
+
+    def start_after(self, values: Dict[str, Any]) -> "Query":
+        return self._with(start_after=values["__name__"])
+
+    def limit(self, count: int) -> "Query":
+        return self._with(limit=count)
+
+    def _matches(self, data: Dict[str, Any]) -> bool:
+        return all(
+            f.field_path in data and OPERATORS[f.op_string](data[f.field_path], f.value)
+            for f in self.options["filters"]
+        )
+
+    async def stream(self) -> AsyncIterator[Snapshot]:
+        self.collection.client.rpcs["query"] += 1
+        start_after = self.options["start_after"]
+        count = 0
+        for id in sorted(self.collection.documents):
+            # documents may be written while they are streamed
+            data = self.collection.documents.get(id)
+            if start_after is not None and id <= start_after:
+                continue
+            if data is None or not self._matches(data):
+                continue
+            if count == self.options["limit"]:
+                return
+            count += 1
+            if self.options["fields"] is not None:
+                data = {key: data[key] for key in self.options["fields"] if key in data}
+            yield Snapshot(Document(self.collection, id), data)
+
+
+class Collection(Query):
+    """A collection of documents by id."""
+
+    def __init__(self, client: "FakeFirestore", name: str) -> None:
+        super().__init__(self)
+        self.client = client
+        self.name = name
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        # clock ticks of the last writes by id, documents set directly have none
+        self.update_times: Dict[str, int] = {}
+
+    def document(self, id: str) -> Document:
+        return Document(self, id)
+
+    def snapshot(self, id: str) -> Snapshot:
+        data = self.documents.get(id)
+        return Snapshot(Document(self, id), None if data is None else dict(data))
+
+
+class Batch:
+    """Writes committed atomically."""
+
+    def __init__(self, client: "FakeFirestore") -> None:
+        self.client = client
+        self.writes = []
+        self.preconditions = []
+
+    def create(self, reference: Document, data: Dict[str, Any]) -> None:
+        self.writes.append(("create", reference, data))
+
+    def set(self, reference: Document, data: Dict[str, Any]) -> None:
+        self.writes.append(("set", reference, data))
+
+    def update(
+        self, reference: Document, data: Dict[str, Any], option: Any = None
+    ) -> None:
+        if option is not None:
+            self.preconditions.append((reference, option))
+        self.writes.append(("update", reference, data))
+
+    def delete(self, reference: Document) -> None:
+        self.writes.append(("delete", reference, None))
+
+    async def commit(self) -> None:
+        self.client.rpcs["commit"] += 1
+        if self.client.errors:
+            raise self.client.errors.pop(0)
+        for reference, option in self.preconditions:
+            updated = reference.collection.update_times.get(reference.id)
+            if updated != option.last_update_time:
+                raise FailedPrecondition(f"Document changed: {reference.id}")
+        self.client.clock += 1
+        # applied to copies, so a failing write leaves every collection as it was
+        collections = {
+            name: dict(collection.documents)
+            for name, collection in self.client.collections.items()
+        }
+        update_times = {
+            name: dict(collection.update_times)
+            for name, collection in self.client.collections.items()
+        }
+        for kind, reference, data in self.writes:
+            documents = collections[reference.collection.name]
+            times = update_times[reference.collection.name]
+            times[reference.id] = self.client.clock
+            if kind == "create" and reference.id in documents:
+                raise AlreadyExists(f"Document already exists: {reference.id}")
+            if kind == "update":
+                if reference.id not in documents:
+                    raise NotFound(f"No document to update: {reference.id}")
+                data = {**documents[reference.id], **data}
+            if kind == "delete":
+                documents.pop(reference.id, None)
+                times.pop(reference.id)
+            else:
+                documents[reference.id] = dict(data)
+        for name, documents in collections.items():
+            self.client.collections[name].documents = documents
+            self.client.collections[name].update_times = update_times[name]
+
+
+class FakeFirestore:
+    """In-memory Firestore client."""
+
+    def __init__(self) -> None:
+        self.collections: Dict[str, Collection] = {}
+        # round trips by kind
+        self.rpcs = Counter()
+        # errors the next commits raise
+        self.errors: List[Exception] = []
+        self.clock = 0
+
+    def collection(self, name: str) -> Collection:
+        if name not in self.collections:
+            self.collections[name] = Collection(self, name)
+        return self.collections[name]
+
+    def batch(self) -> Batch:
+        return Batch(self)
+
+    def write_option(self, last_update_time: int = None) -> SimpleNamespace:
+        return SimpleNamespace(last_update_time=last_update_time)
+
+    async def get_all(self, references: Iterable[Document]) -> AsyncIterator[Snapshot]:
+        self.rpcs["get"] += 1
+        for reference in references:
+            yield reference.collection.snapshot(reference.id)
@@ -0,0 +1,130 @@
+"""Test the admission control and backpressure of store calls."""
+import asyncio
+from uuid import uuid4
+
+import pytest
+from httpx import AsyncClient
+
+from tokenvaultapi.admission import (AdaptiveBatchSize, Admission,
+                                     AdmissionLimiter, Overloaded, retry)
+from tokenvaultapi.cache import NullCache
+from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.main import api
+from tokenvaultapi.services.token import TokenService
+from tokenvaultapi.stores.memory import MemoryTokenStore
+
+pytestmark = pytest.mark.anyio
+
+
+class Contended(Exception):
+    """Retryable error of the flaky store."""
+
+
+class FlakyStore(MemoryTokenStore):
+    """Memory store whose first writes fail with a retryable error."""
+
+    retryable_errors = (Contended,)
+
+    def __init__(self, failures: int) -> None:
+        super().__init__()
+        self.failures = failures
+
+    async def create_many(self, documents):
+        if self.failures:
+            self.failures -= 1
+            raise Contended("contention")
+        await super().create_many(documents)
+
+
+async def test_limiter_sheds_calls_when_the_queue_is_full() -> None:
+    """Test that calls beyond the slots and the queue are rejected with a 503."""
+    limiter = AdmissionLimiter(max_concurrency=1, max_queue=1, queue_timeout=1)
+    release = asyncio.Event()
+
+    async def call():
+        async with limiter.slot():
+            await release.wait()
+
+    running = asyncio.create_task(call())
+    queued = asyncio.create_task(call())
+    await asyncio.sleep(0)
+    assert limiter.waiting == 1
+    with pytest.raises(Overloaded) as e:
+        await call()
+    assert e.value.status_code == 503
+    assert e.value.headers == {"Retry-After": "1"}
+    release.set()
+    await asyncio.gather(running, queued)
+    assert limiter.waiting == 0
+
+
+async def test_limiter_times_out_waiting_calls() -> None:
+    """Test that calls waiting longer than the queue timeout are rejected."""
+    limiter = AdmissionLimiter(max_concurrency=1, max_queue=10, queue_timeout=0.01)
+    async with limiter.slot():
+        with pytest.raises(Overloaded):
+            async with limiter.slot():
+                pass
+    async with limiter.slot():
+        pass
+
+
+async def test_retry_backs_off_and_gives_up_with_a_429() -> None:
+    """Test that retryable errors are retried and raise Overloaded once exhausted."""
+    errors = []
+
+    async def fail():
+        raise Contended("contention")
+
+    async def fail_otherwise():
+        errors.append("called")
+        raise ValueError("not retryable")
+
+    with pytest.raises(Overloaded) as e:
+        await retry(fail, (Contended,), 3, 0.001, 0.5, errors.append)
+    assert e.value.status_code == 429
+    assert e.value.headers == {"Retry-After": "1"}
+    assert len(errors) == 3
+    with pytest.raises(ValueError):
+        await retry(fail_otherwise, (Contended,))
+    assert len(errors) == 4
+
+
+def test_batch_size_halves_and_grows_back() -> None:
+    """Test that batches halve on contention and grow back additively."""
+    size = AdaptiveBatchSize(100)
+    size.shrink()
+    size.shrink()
+    assert size.size == 25
+    for _ in range(20):
+        size.grow()
+    assert size.size == 100
+
+
+async def test_contended_writes_are_retried_in_smaller_batches() -> None:
+    """Test that a batch is written despite contention, and later batches shrink."""
+    store = FlakyStore(failures=2)
+    dao = TokenDAO(store=store, cache=NullCache())
+    calls = [["CUSTOMER_ID", str(i), f"user{i}@example.com"] for i in range(3)]
+    tokens = await dao.deidentify_calls(calls, "STRING")
+    assert len(set(tokens)) == 3
+    assert len(store.documents) == 6
+    assert dao.admission.batch_size("write") < store.max_write_batch
+
+
+async def test_overloaded_batches_are_answered_with_retry_after(monkeypatch) -> None:
+    """Test that a saturated worker answers remote function calls with a 503."""
+    admission = Admission(AdmissionLimiter(0, 0, 1), read=250, write=250)
+    dao = TokenDAO(store=MemoryTokenStore(), cache=NullCache(), admission=admission)
+    monkeypatch.setattr(api.state, "token_service", TokenService(dao), raising=False)
+    body = {
+        "requestId": "overloaded",
+        "caller": "test",
+        "sessionUser": "test",
+        "userDefinedContext": {"action": "DEIDENTIFY", "tokenType": "STRING"},
+        "calls": [["CUSTOMER_ID", str(uuid4()), "a@example.com"]],
+    }
+    async with AsyncClient(app=api, base_url="http://test") as client:
+        response = await client.post("/", json=body)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
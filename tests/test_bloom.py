@@ -0,0 +1,90 @@
+"""Test the Bloom filter of token keys and the reads it skips."""
+import pytest
+
+from tokenvaultapi.bloom import BloomFilter, build, token_keys
+from tokenvaultapi.cache import NullCache
+from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.stores.memory import MemoryTokenStore
+
+pytestmark = pytest.mark.anyio
+
+CALLS = [["CUSTOMER_ID", str(i), f"user{i}@example.com"] for i in range(20)]
+
+
+def test_false_positive_rate() -> None:
+    """Test that added keys are found and others mostly not, at the sized rate."""
+    bloom = BloomFilter.for_capacity(10000, 0.01)
+    bloom.add_many(f"key{i}" for i in range(10000))
+    assert all(f"key{i}" in bloom for i in range(10000))
+    false_positives = sum(f"other{i}" in bloom for i in range(10000))
+    assert false_positives < 200
+    assert bloom.count == pytest.approx(10000, abs=100)
+    assert bloom.error_rate == pytest.approx(0.01, rel=0.2)
+
+
+def test_memory_budget() -> None:
+    """Test that a filter larger than its budget is capped, at a higher rate."""
+    bloom = BloomFilter.for_capacity(100000, 0.001, max_bytes=1024)
+    assert len(bloom.data) == 1024
+    bloom.add_many(f"key{i}" for i in range(1000))
+    assert bloom.error_rate > 0.001
+
+
+def test_save_and_load(tmp_path) -> None:
+    """Test that a saved filter is loaded with its keys and watermark."""
+    path = str(tmp_path / "tokens.bloom")
+    bloom = BloomFilter.for_capacity(100, 0.01)
+    bloom.add_many(["a", "b"])
+    bloom.save(path)
+    loaded = BloomFilter.load(path)
+    assert "a" in loaded and "b" in loaded
+    assert (loaded.bits, loaded.hashes, loaded.count) == (bloom.bits, bloom.hashes, 2)
+    assert loaded.watermark == bloom.watermark
+
+
+async def test_new_tokens_are_created_without_reads(tmp_path) -> None:
+    """Test that tokens missing from the filter are created without reading them."""
+    store = MemoryTokenStore()
+    writer = TokenDAO(store=store, cache=NullCache())
+    tokens = await writer.deidentify_calls(CALLS[:10], "STRING")
+    bloom = await build(store, str(tmp_path / "tokens.bloom"))
+    assert bloom.count == 2 * len(store.documents)
+    dao = TokenDAO(store=store, cache=NullCache(), bloom=bloom)
+    store.rpcs.clear()
+    assert await dao.deidentify_calls(CALLS[:10], "STRING") == tokens
+    assert store.rpcs["write"] == 0
+    store.rpcs.clear()
+    new_tokens = await dao.deidentify_calls(CALLS[10:], "STRING")
+    assert store.rpcs["get"] == 0
+    # created tokens are added to the filter
+    assert all(key in bloom for key in token_keys(store.documents.values()))
+    assert await dao.deidentify_calls(CALLS[10:], "STRING") == new_tokens
+
+
+async def test_tokens_missing_from_the_filter_are_read_back() -> None:
+    """Test that existing tokens missing from the filter fail their creation."""
+    store = MemoryTokenStore()
+    tokens = await TokenDAO(store=store).deidentify_calls(CALLS, "STRING")
+    dao = TokenDAO(store=store, cache=NullCache(), bloom=BloomFilter(1024, 3))
+    assert await dao.deidentify_calls(CALLS, "STRING") == tokens
+    assert len(store.documents) == 40
+
+
+async def test_reidentify_trusts_negatives() -> None:
+    """Test that tokens missing from the filter are replied with None if trusted."""
+    store = MemoryTokenStore()
+    writer = TokenDAO(store=store, cache=NullCache())
+    await writer.deidentify_calls(CALLS, "STRING")
+    bloom = BloomFilter.for_capacity(1000, 0.01)
+    bloom.add_many(token_keys(store.documents.values()))
+    calls = [["CUSTOMER_ID", "identity-token", f"never-issued-{i}"] for i in range(10)]
+    dao = TokenDAO(store=store, cache=NullCache(), bloom=bloom)
+    store.rpcs.clear()
+    assert await dao.reidentify_calls(calls) == [None] * 10
+    assert store.rpcs["get"] == 1
+    dao = TokenDAO(
+        store=store, cache=NullCache(), bloom=bloom, bloom_trust_negatives=True
+    )
+    store.rpcs.clear()
+    assert await dao.reidentify_calls(calls) == [None] * 10
+    assert store.rpcs["get"] == 0
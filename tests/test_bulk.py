@@ -0,0 +1,111 @@
+"""Test the offline bulk tokenization of files."""
+import csv
+import os
+
+import pytest
+
+from tokenvaultapi.bulk import run
+from tokenvaultapi.cache import NullCache
+from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.stores.memory import MemoryTokenStore
+
+pytestmark = pytest.mark.anyio
+
+ROWS = [
+    {"customer_id": str(i // 2), "email": f"user{i}@example.com", "phone": str(i)}
+    for i in range(10)
+]
+
+
+class FailingDAO(TokenDAO):
+    """Token DAO whose deidentify fails after a number of calls."""
+
+    def __init__(self, calls: int, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.calls = calls
+
+    async def deidentify_calls(self, *args, **kwargs):
+        if not self.calls:
+            raise RuntimeError("interrupted")
+        self.calls -= 1
+        return await super().deidentify_calls(*args, **kwargs)
+
+
+def write_csv(path: str, rows: list) -> None:
+    """Write rows to a CSV file with a header."""
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_csv(path: str) -> list:
+    """Read the rows of a CSV file with a header."""
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+async def test_csv_columns_are_tokenized(tmp_path) -> None:
+    """Test that the columns are replaced by the tokens of their calls."""
+    rows = [*ROWS, {"customer_id": "9", "email": "", "phone": "9"}]
+    write_csv(tmp_path / "input.csv", rows)
+    output = str(tmp_path / "output.csv")
+    dao = TokenDAO(store=MemoryTokenStore(), cache=NullCache())
+    count = await run(
+        str(tmp_path / "input.csv"),
+        output,
+        ["email"],
+        "customer_id",
+        identifier="CUSTOMER_ID",
+        chunk_size=4,
+        dao=dao,
+    )
+    assert count == 11
+    calls = [["CUSTOMER_ID", row["customer_id"], row["email"]] for row in ROWS]
+    tokens = await dao.deidentify_calls(calls, "STRING")
+    output_rows = read_csv(output)
+    assert [row["email"] for row in output_rows] == tokens + [""]
+    assert [row["phone"] for row in output_rows] == [row["phone"] for row in rows]
+    assert not os.path.exists(f"{output}.checkpoint")
+
+
+async def test_interrupted_runs_resume_from_the_checkpoint(tmp_path) -> None:
+    """Test that a rerun continues after the last chunk written."""
+    write_csv(tmp_path / "input.csv", ROWS)
+    store = MemoryTokenStore()
+    arguments = (
+        str(tmp_path / "input.csv"),
+        str(tmp_path / "output.csv"),
+        ["email", "phone"],
+        "customer_id",
+        "CUSTOMER_ID",
+    )
+    dao = FailingDAO(2, store=store, cache=NullCache())
+    with pytest.raises(RuntimeError):
+        await run(*arguments, chunk_size=3, dao=dao)
+    assert len(read_csv(tmp_path / "output.csv")) == 6
+    dao = TokenDAO(store=store, cache=NullCache())
+    assert await run(*arguments, chunk_size=3, dao=dao) == 4
+    resumed = read_csv(tmp_path / "output.csv")
+    await run(*arguments[:1], str(tmp_path / "again.csv"), *arguments[2:], dao=dao)
+    assert resumed == read_csv(tmp_path / "again.csv")
+
+
+async def test_parquet(tmp_path) -> None:
+    """Test that Parquet files are tokenized into a directory of Parquet files."""
+    pyarrow = pytest.importorskip("pyarrow")
+    parquet = pytest.importorskip("pyarrow.parquet")
+    parquet.write_table(pyarrow.Table.from_pylist(ROWS), tmp_path / "input.parquet")
+    output = str(tmp_path / "output.parquet")
+    count = await run(
+        str(tmp_path / "input.parquet"),
+        output,
+        ["email"],
+        "customer_id",
+        identifier="CUSTOMER_ID",
+        chunk_size=4,
+        dao=TokenDAO(store=MemoryTokenStore(), cache=NullCache()),
+    )
+    assert count == 10
+    assert len(os.listdir(output)) == 3
+    assert parquet.read_table(output).num_rows == 10
@@ -0,0 +1,161 @@
+"""Test the token caches."""
+import asyncio
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from fakeredis import FakeAsyncRedis, FakeServer
+
+from tokenvaultapi import cache as cache_module
+from tokenvaultapi.cache import (LRUCache, NullCache, RedisCache, TieredCache,
+                                 create_cache)
+from tokenvaultapi.config import CACHE_TTL_SECONDS
+from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.keys import derive_key
+from tokenvaultapi.schemas.token import Token
+from tokenvaultapi.stores.memory import MemoryTokenStore
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_lru_cache_get_set_delete() -> None:
+    """Test that cached values are returned until deleted."""
+    cache = LRUCache(max_size=10, ttl=60)
+    await cache.set_many({"a": 1, "b": 2})
+    assert await cache.get_many(["a", "b", "c"]) == {"a": 1, "b": 2}
+    await cache.delete("a")
+    assert await cache.get("a") is None
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+    assert stats["size"] == 1
+
+
+async def test_lru_cache_evicts_least_recently_used() -> None:
+    """Test that the least recently used entry is evicted when full."""
+    cache = LRUCache(max_size=2, ttl=60)
+    await cache.set("a", 1)
+    await cache.set("b", 2)
+    await cache.get("a")
+    await cache.set("c", 3)
+    assert await cache.get_many(["a", "b", "c"]) == {"a": 1, "c": 3}
+    assert cache.stats()["evictions"] == 1
+
+
+async def test_lru_cache_expires_entries(monkeypatch) -> None:
+    """Test that entries expire after the TTL."""
+    cache = LRUCache(max_size=2, ttl=60)
+    await cache.set("a", 1)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert await cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+async def test_null_cache() -> None:
+    """Test that the disabled cache holds nothing."""
+    cache = NullCache()
+    await cache.set("a", 1)
+    assert await cache.get("a") is None
+
+
+async def test_redis_cache_round_trips_tokens() -> None:
+    """Test that tokens, strings and negative entries survive the shared cache."""
+    cache = RedisCache("redis://", ttl=60, client=FakeAsyncRedis())
+    token = Token(
+        pk="pk",
+        identifier="CUSTOMER_ID",
+        identity="12345",
+        identity_token="identity-token",
+        type="INT",
+        created_at=datetime.utcnow(),
+        token=42,
+        value="7",
+    )
+    token.value = 7
+    await cache.set_many({"pk": token, "index:key": "pk", "index:missing": None})
+    found = await cache.get_many(["pk", "index:key", "index:missing", "other"])
+    assert found["pk"] == token
+    assert found["pk"].value == 7
+    assert found["index:key"] == "pk"
+    assert found["index:missing"] is None
+    assert "other" not in found
+    assert cache.stats() == {"hits": 3, "misses": 1, "errors": 0}
+
+
+async def test_tiered_cache_fills_l1_from_l2() -> None:
+    """Test that the in-process cache is filled from the shared cache."""
+    l2 = RedisCache("redis://", ttl=60, client=FakeAsyncRedis())
+    await l2.set_many({"a": "1", "b": None})
+    cache = TieredCache(LRUCache(max_size=10, ttl=60), l2, negative_ttl=1)
+    assert await cache.get_many(["a", "b"]) == {"a": "1", "b": None}
+    assert await cache.get_many(["a", "b"]) == {"a": "1", "b": None}
+    stats = cache.stats()
+    assert stats["l1"]["hits"] == 2
+    assert stats["l2"]["hits"] == 2
+    await cache.delete("a")
+    assert await cache.get("a") is None
+    assert await l2.get("a") is None
+
+
+CALL = ["CUSTOMER_ID", "1", "john.doe@example.com"]
+
+
+async def reidentify(dao: TokenDAO, token: str) -> str:
+    """Reidentify a token of CALL."""
+    identity = await dao.get_by_values(["CUSTOMER_ID", "1", "1"])
+    replies = await dao.reidentify_calls([["CUSTOMER_ID", identity.token, token]])
+    return replies[0]
+
+
+async def test_deletes_are_removed_from_the_caches_of_other_workers() -> None:
+    """Test that a delete is published to the in-process caches of other workers."""
+    server = FakeServer()
+    store = MemoryTokenStore()
+    workers = [
+        TokenDAO(
+            store=store,
+            cache=TieredCache(
+                LRUCache(max_size=10, ttl=3600),
+                RedisCache("redis://", ttl=3600, client=FakeAsyncRedis(server=server)),
+                negative_ttl=1,
+            ),
+            legacy_key_fallback=False,
+        )
+        for _ in range(2)
+    ]
+    listeners = [asyncio.create_task(dao.cache.listen()) for dao in workers]
+    try:
+        (token,) = await workers[0].deidentify_calls([CALL], "STRING")
+        # the token is in the in-process cache of the other worker
+        assert await reidentify(workers[1], token) == CALL[2]
+        assert await reidentify(workers[1], token) == CALL[2]
+        # lets the listeners subscribe
+        await asyncio.sleep(0.05)
+        await workers[0].delete(derive_key(CALL))
+        for _ in range(100):
+            if derive_key(CALL) not in workers[1].cache.l1._entries:
+                break
+            await asyncio.sleep(0.01)
+        assert await reidentify(workers[1], token) is None
+    finally:
+        for listener in listeners:
+            listener.cancel()
+
+
+async def test_deletes_expire_from_other_workers_in_seconds(monkeypatch) -> None:
+    """Test that without a shared cache other workers serve a delete within seconds."""
+    assert CACHE_TTL_SECONDS <= 60
+    store = MemoryTokenStore()
+    workers = [
+        TokenDAO(store=store, cache=create_cache(), legacy_key_fallback=False)
+        for _ in range(2)
+    ]
+    (token,) = await workers[0].deidentify_calls([CALL], "STRING")
+    assert await reidentify(workers[1], token) == CALL[2]
+    await workers[0].delete(derive_key(CALL))
+    assert await reidentify(workers[1], token) == CALL[2]
+    later = SimpleNamespace(monotonic=lambda: time.monotonic() + CACHE_TTL_SECONDS)
+    monkeypatch.setattr(cache_module, "time", later)
+    assert await reidentify(workers[1], token) is None
@@ -0,0 +1,68 @@
+"""Test the versioned schemas of stored token documents."""
+from datetime import datetime
+
+from tokenvaultapi.keys import reverse_key_of
+from tokenvaultapi.stores.base import token_from_dict
+from tokenvaultapi.stores.codec import (V1, V2, VERSION, decode, encode,
+                                        token_from_document)
+
+from tests.conftest import document
+
+CREATED_AT = datetime(2023, 9, 1, 12)
+
+
+def test_v2_leaves_out_defaults() -> None:
+    """Test that a token is stored without its pk and defaults, and read back."""
+    data = document("pk1", "john.doe@example.com", "abc", field="email")
+    stored = encode(data, V2)
+    assert stored == {
+        VERSION: V2,
+        "n": "CUSTOMER_ID",
+        "i": "1",
+        "it": "identity-token",
+        "v": "john.doe@example.com",
+        "t": "abc",
+        "f": "email",
+        "c": CREATED_AT,
+    }
+    assert decode("pk1", stored) == data
+    assert token_from_document("pk1", stored) == token_from_dict(data)
+
+
+def test_identity_documents_leave_out_value_and_token() -> None:
+    """Test that identity documents are stored without their value and token."""
+    data = document("pk1", "1", "identity-token")
+    del data["method"]
+    stored = encode(data, V2)
+    assert "v" not in stored and "t" not in stored
+    assert decode("pk1", stored) == data
+    assert token_from_document("pk1", stored).token == "identity-token"
+
+
+def test_numbers_are_stored_as_numbers() -> None:
+    """Test that INT and FLOAT tokens are stored and read as numbers."""
+    for data_type, value, token in (("INT", "123", "456"), ("FLOAT", "1.5", "7.25")):
+        data = document("pk1", value, token, type=data_type)
+        stored = encode(data, V2)
+        assert "y" not in stored
+        assert token_from_document("pk1", stored) == token_from_dict(data)
+        # the reverse key is derived from the same strings
+        assert reverse_key_of(decode("pk1", stored)) == reverse_key_of(data)
+
+
+def test_lossy_numbers_keep_their_strings() -> None:
+    """Test that numbers that don't round trip are stored as strings with their type."""
+    data = document("pk1", "0123", "0456", type="INT")
+    stored = encode(data, V2)
+    assert (stored["v"], stored["t"], stored["y"]) == ("0123", "0456", "INT")
+    assert decode("pk1", stored) == data
+    assert token_from_document("pk1", stored).token == 456
+
+
+def test_v1_documents_are_read() -> None:
+    """Test that v1 documents are stored and read as they are."""
+    data = document("pk1", "123", "456", type="INT")
+    stored = encode(data, V1)
+    assert stored == data
+    assert decode("pk1", stored) == data
+    assert token_from_document("pk1", stored) == token_from_dict(data)
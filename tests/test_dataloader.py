@@ -0,0 +1,59 @@
+"""Test the micro-batching of point reads."""
+import asyncio
+
+import pytest
+
+from tokenvaultapi.dataloader import DataLoader
+
+pytestmark = pytest.mark.anyio
+
+
+class Reads:
+    """Load function that records its batches."""
+
+    def __init__(self) -> None:
+        self.batches = []
+
+    async def __call__(self, keys):
+        self.batches.append(keys)
+        await asyncio.sleep(0)
+        return {key: key.upper() for key in keys if key != "missing"}
+
+
+async def test_concurrent_loads_are_batched() -> None:
+    """Test that keys loaded within the window are read in one batch."""
+    reads = Reads()
+    loader = DataLoader(reads, window=0.005)
+    results = await asyncio.gather(
+        loader.load_many(["a", "b"]),
+        loader.load_many(["b", "missing"]),
+        loader.load_many(["c"]),
+    )
+    assert results == [{"a": "A", "b": "B"}, {"b": "B"}, {"c": "C"}]
+    assert reads.batches == [["a", "b", "missing", "c"]]
+    stats = loader.stats()
+    assert stats["batch_size"]["count"] == 1
+    assert stats["wait_seconds"]["count"] == 4
+
+
+async def test_full_batches_are_read_at_once() -> None:
+    """Test that batches are at most max_batch keys and full ones don't wait."""
+    reads = Reads()
+    loader = DataLoader(reads, window=10, max_batch=2)
+    keys = ["a", "b", "c", "d"]
+    results = await asyncio.wait_for(loader.load_many(keys), 1)
+    assert results == {key: key.upper() for key in keys}
+    assert reads.batches == [["a", "b"], ["c", "d"]]
+
+
+async def test_errors_are_raised_to_the_batch() -> None:
+    """Test that the callers of a failed batch get its error."""
+
+    async def fail(keys):
+        raise ValueError("failed")
+
+    loader = DataLoader(fail, window=0)
+    results = await asyncio.gather(
+        loader.load_many(["a"]), loader.load_many(["b"]), return_exceptions=True
+    )
+    assert [type(result) for result in results] == [ValueError, ValueError]
@@ -0,0 +1,56 @@
+"""Test the offloading of batches to a process pool."""
+import pytest
+from starlette.testclient import TestClient
+
+from tokenvaultapi.cache import NullCache
+from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.executor import Offloader, offloader, tokenize_pairs
+from tokenvaultapi.keys import derive_keys
+from tokenvaultapi.main import api
+from tokenvaultapi.stores.memory import MemoryTokenStore
+
+pytestmark = pytest.mark.anyio
+
+ROWS = [["CUSTOMER_ID", str(i // 3), f"user{i}@example.com"] for i in range(10)]
+
+
+@pytest.fixture(scope="module")
+def pool_offloader():
+    offloader = Offloader(threshold=2, workers=1, chunk_size=3)
+    yield offloader
+    offloader.shutdown()
+
+
+async def test_small_batches_run_inline() -> None:
+    """Test that batches below the threshold don't start the pool."""
+    inline = Offloader(threshold=100, workers=1)
+    assert await inline.map(derive_keys, ROWS) == derive_keys(ROWS)
+    assert inline._pool is None
+
+
+async def test_large_batches_run_in_chunks(pool_offloader: Offloader) -> None:
+    """Test that chunks run in the pool give the results of the whole batch."""
+    assert await pool_offloader.map(derive_keys, ROWS) == derive_keys(ROWS)
+    pairs = [(row[2], b"") for row in ROWS]
+    tokens = await pool_offloader.map(
+        tokenize_pairs, pairs, "FORMAT_PRESERVING", "STRING"
+    )
+    assert [len(token) for token in tokens] == [len(row[2]) for row in ROWS]
+    assert pool_offloader._pool is not None
+
+
+async def test_deidentify_offloaded(monkeypatch, pool_offloader: Offloader) -> None:
+    """Test that deidentify gives the same tokens with offloading."""
+    for name in ("threshold", "workers", "chunk_size", "_pool"):
+        monkeypatch.setattr(offloader, name, getattr(pool_offloader, name))
+    dao = TokenDAO(cache=NullCache(), store=MemoryTokenStore())
+    tokens = await dao.deidentify_calls(ROWS, "STRING", "RANDOM")
+    assert await dao.deidentify_calls(ROWS, "STRING", "RANDOM") == tokens
+
+
+def test_pool_is_shut_down_with_the_app() -> None:
+    """Test that the lifespan of the app shuts the process pool down."""
+    with TestClient(api):
+        pool = offloader.pool()
+    assert offloader._pool is None
+    assert pool._shutdown_thread
@@ -0,0 +1,236 @@
+"""Test the reverse index of the Firestore token store and its migrations."""
+import pytest
+from google.api_core.exceptions import Aborted
+
+from tokenvaultapi.cache import NullCache
+from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.keys import reverse_key_of
+from tokenvaultapi.migrations.reverse_index import backfill
+from tokenvaultapi.migrations.token_schema import migrate
+from tokenvaultapi.schemas.token import TokenFind
+from tokenvaultapi.stores import TokenExists
+from tokenvaultapi.stores.codec import V1, V2
+from tokenvaultapi.stores.firestore import FirestoreTokenStore, merge_by_pk
+
+from tests.conftest import document
+from tests.fake_firestore import FakeFirestore
+
+pytestmark = pytest.mark.anyio
+
+
+def token_find(token: str) -> TokenFind:
+    """Create the find of a token of identity 1."""
+    return TokenFind(
+        identifier="CUSTOMER_ID", identity_token="identity-token", token=token
+    )
+
+
+async def find(store: FirestoreTokenStore, token: str) -> str:
+    """Find the value of a token of identity 1."""
+    key = reverse_key_of(token_find(token).dict())
+    tokens = await store.find_many({key: token_find(token)})
+    return tokens[key].value if key in tokens else None
+
+
+def legacy_store(*documents: dict) -> FirestoreTokenStore:
+    """Create a store with v1 documents written before the reverse index."""
+    client = FakeFirestore()
+    tokens = client.collection(FirestoreTokenStore.collection_name)
+    for data in documents:
+        tokens.documents[data["pk"]] = data
+    return FirestoreTokenStore(client, schema_version=V1)
+
+
+async def test_tokens_are_found_with_point_reads() -> None:
+    """Test that tokens are found through their reverse index entries."""
+    client = FakeFirestore()
+    store = FirestoreTokenStore(client)
+    await store.create_many([document("a", "x"), document("b", "y")])
+    index = client.collection(store.index_collection_name).documents
+    assert index[reverse_key_of(document("a", "x"))] == {"pk": "a"}
+    client.rpcs.clear()
+    assert await find(store, "token-x") == "x"
+    assert client.rpcs == {"get": 2}
+
+
+async def test_taken_reverse_keys_are_not_overwritten() -> None:
+    """Test that a token with the token of another token fails its whole batch."""
+    client = FakeFirestore()
+    store = FirestoreTokenStore(client)
+    await store.create_many([document("a", "x", "same")])
+    with pytest.raises(TokenExists):
+        await store.create_many([document("b", "y"), document("c", "z", "same")])
+    assert set(client.collection(store.collection_name).documents) == {"a"}
+    assert await find(store, "same") == "x"
+
+
+async def test_aborted_commits_are_retried() -> None:
+    """Test that contention aborting a commit is retried, not taken as TokenExists."""
+    client = FakeFirestore()
+    store = FirestoreTokenStore(client)
+    client.errors = [Aborted("Too much contention on these documents.")]
+    with pytest.raises(Aborted):
+        await store.create_many([document("a", "x")])
+    client.errors = [Aborted("Too much contention on these documents.")]
+    client.rpcs.clear()
+    dao = TokenDAO(store=store, cache=NullCache(), legacy_key_fallback=False)
+    tokens = await dao.deidentify_calls([["CUSTOMER_ID", "1", "x"]], "STRING")
+    assert (await dao.get_by_values(["CUSTOMER_ID", "1", "x"])).token == tokens[0]
+    # the identity is created in a retried commit, then the token
+    assert client.rpcs["commit"] == 2 + 1
+
+
+async def test_scan_merges_both_schema_versions() -> None:
+    """Test that the tokens of an identity in both versions are listed in pk order."""
+    store = legacy_store(document("a", "w"), document("c", "y"))
+    store.schema_version = V2
+    await store.create_many([document("b", "x"), document("d", "z")])
+    scan = store.scan("CUSTOMER_ID", "1", ["value"])
+    assert [data async for data in scan] == [
+        {"pk": pk, "value": value} for pk, value in zip("abcd", "wxyz")
+    ]
+    scan = store.scan("CUSTOMER_ID", "1", ["value"], start_after="a", limit=2)
+    assert [data["pk"] async for data in scan] == ["b", "c"]
+
+
+async def test_merge_by_pk_streams() -> None:
+    """Test that streams are merged as they are read, and closed at the limit."""
+    read = []
+
+    async def stream(pks: str):
+        for pk in pks:
+            read.append(pk)
+            yield {"pk": pk}
+
+    merged = merge_by_pk([stream("ace"), stream("bdf")], limit=4)
+    assert (await merged.__anext__())["pk"] == "a"
+    assert sorted(read) == ["a", "b"]
+    assert [data["pk"] async for data in merged] == list("bcd")
+    assert sorted(read) == list("abcde")
+
+
+async def test_query_fallback() -> None:
+    """Test that tokens missing from the index are queried only with the fallback."""
+    store = legacy_store(document("a", "x"), document("b", "y", "same"))
+    assert await find(store, "token-x") == "x"
+    assert await find(store, "missing") is None
+    store.reverse_index_fallback = False
+    assert await find(store, "token-x") is None
+
+
+async def test_query_fallback_reports_ambiguous_tokens() -> None:
+    """Test that legacy tokens with the same token aren't silently picked from."""
+    store = legacy_store(document("a", "x", "same"), document("b", "y", "same"))
+    with pytest.raises(Exception, match="More than one token"):
+        await find(store, "same")
+
+
+async def test_backfill() -> None:
+    """Test that the backfill indexes every document, and can be run again."""
+    store = legacy_store(*(document(str(i), str(i)) for i in range(5)))
+    assert await backfill(page_size=2, client=store.db) == 5
+    store.reverse_index_fallback = False
+    assert [await find(store, f"token-{i}") for i in range(5)] == list("01234")
+    index = store.db.collection(store.index_collection_name)
+    entries = dict(index.documents)
+    assert await backfill(page_size=2, client=store.db, start_after="2") == 2
+    assert index.documents == entries
+
+
+async def test_backfill_of_both_schema_versions() -> None:
+    """Test that the backfill indexes v1 and v2 documents alike."""
+    store = legacy_store(document("a", "x"), document("c", "z"))
+    await FirestoreTokenStore(store.db).create_many(
+        [document("b", "y"), {**document("d", "5", "7"), "type": "INT"}]
+    )
+    index = store.db.collection(store.index_collection_name)
+    assert "_v" in store.db.collection(store.collection_name).documents["d"]
+    index.documents.clear()
+    assert await backfill(page_size=3, client=store.db) == 4
+    store.reverse_index_fallback = False
+    assert [await find(store, f"token-{value}") for value in "xyz"] == list("xyz")
+    assert index.documents[reverse_key_of(document("d", "5", "7"))] == {"pk": "d"}
+
+
+async def test_backfill_removes_ambiguous_entries() -> None:
+    """Test that legacy tokens with the same token aren't indexed."""
+    store = legacy_store(
+        document("a", "x", "same"), document("b", "y"), document("c", "z", "same")
+    )
+    # an entry the service created for one of them since
+    await store.db.collection(store.index_collection_name).document(
+        reverse_key_of(document("a", "x", "same"))
+    ).set({"pk": "a"})
+    assert await backfill(page_size=2, client=store.db) == 3
+    store.reverse_index_fallback = False
+    assert await find(store, "same") is None
+    assert await find(store, "token-y") == "y"
+
+
+class ChangingFirestore(FakeFirestore):
+    """Firestore client where a token is updated while its page is migrated."""
+
+    def __init__(self, pk: str) -> None:
+        super().__init__()
+        self.pk = pk
+
+    async def get_all(self, references):
+        if self.pk is not None:
+            pk, self.pk = self.pk, None
+            await self.collection("tokens").document(pk).update({"method": "RANDOM"})
+        async for snapshot in super().get_all(references):
+            yield snapshot
+
+
+def migrated_store(client: FakeFirestore, *documents: dict) -> FirestoreTokenStore:
+    """Add v1 documents to a client, and get a store that only reads the index."""
+    tokens = client.collection(FirestoreTokenStore.collection_name)
+    for data in documents:
+        tokens.documents[data["pk"]] = data
+    store = FirestoreTokenStore(client)
+    store.reverse_index_fallback = False
+    return store
+
+
+async def test_migrate() -> None:
+    """Test that v1 documents are rewritten in v2 with their index entries, once."""
+    client = FakeFirestore()
+    store = migrated_store(client, *(document(str(i), str(i)) for i in range(5)))
+    assert await migrate(page_size=2, rate=10000, client=client) == 5
+    stored = client.collection(store.collection_name).documents
+    assert {data.get("_v") for data in stored.values()} == {2}
+    assert [await find(store, f"token-{i}") for i in range(5)] == list("01234")
+    assert await migrate(page_size=2, rate=10000, client=client) == 0
+
+
+async def test_migrate_resumes_after_a_document() -> None:
+    """Test that a migration resumed after a document id leaves earlier ones."""
+    client = FakeFirestore()
+    store = migrated_store(client, *(document(str(i), str(i)) for i in range(5)))
+    assert await migrate(page_size=2, start_after="2", rate=10000, client=client) == 2
+    stored = client.collection(store.collection_name).documents
+    assert [stored[str(i)].get("_v") for i in range(5)] == [None, None, None, 2, 2]
+
+
+async def test_migrate_reads_changed_documents_again() -> None:
+    """Test that a token updated since its page was read isn't overwritten."""
+    client = ChangingFirestore("1")
+    store = migrated_store(client, *(document(str(i), str(i)) for i in range(3)))
+    assert await migrate(page_size=2, rate=10000, client=client) == 3
+    stored = client.collection(store.collection_name).documents
+    assert stored["1"]["m"] == "RANDOM"
+    assert (await store.get_many(["1"]))["1"].value == "1"
+
+
+@pytest.mark.parametrize("page_size", [1, 3])
+async def test_migrate_leaves_ambiguous_tokens_out_of_the_index(page_size) -> None:
+    """Test that the migration doesn't index legacy tokens that share a token."""
+    client = FakeFirestore()
+    documents = [document("a", "x", "same"), document("b", "y")]
+    store = migrated_store(client, *documents, document("c", "z", "same"))
+    assert await backfill(client=client) == 3
+    assert await migrate(page_size=page_size, rate=10000, client=client) == 3
+    index = client.collection(store.index_collection_name).documents
+    assert reverse_key_of(document("a", "x", "same")) not in index
+    assert await find(store, "same") is None
+    assert await find(store, "token-y") == "y"
@@ -0,0 +1,117 @@
+"""Test format preserving encryption."""
+import pytest
+from httpx import AsyncClient
+
+from tokenvaultapi import fpe
+from tokenvaultapi.fpe import (INT64_MAX, INT64_MIN, FormatPreservingCipher,
+                               encryption_tweak)
+from tokenvaultapi.main import api
+
+KEY = bytes(range(32))
+TWEAK = encryption_tweak("CUSTOMER_ID", "437389b6-3ca3-07f2-500b-8b031957a824", "email")
+
+
+@pytest.mark.parametrize(
+    "value, data_type",
+    [
+        ("john.doe@example.com", "STRING"),
+        ("+46(0)701020304", "STRING"),
+        ("Åsa Öberg", "STRING"),
+        ("xy", "STRING"),
+        ("", "STRING"),
+        ("12345", "INT"),
+        ("-42", "INT"),
+        (str(INT64_MAX), "INT"),
+        (str(INT64_MIN), "INT"),
+        ("3.14", "FLOAT"),
+        ("0.30000000000000004", "FLOAT"),
+        ("1e-05", "FLOAT"),
+    ],
+)
+def test_encrypt_decrypt(value: str, data_type: str) -> None:
+    """Test that tokens preserve the format and decrypt to the value."""
+    cipher = FormatPreservingCipher(KEY)
+    token = cipher.encrypt(value, data_type, TWEAK)
+    assert len(token) == len(value)
+    assert [c.isdigit() for c in token] == [c.isdigit() for c in value]
+    assert [c.isupper() for c in token] == [c.isupper() for c in value]
+    assert cipher.encrypt(value, data_type, TWEAK) == token
+    assert cipher.decrypt(token, data_type, TWEAK) == value
+    if data_type == "INT":
+        assert str(int(token)) == token
+    if data_type == "FLOAT":
+        assert str(float(token)) == token
+
+
+def test_tokens_depend_on_key_and_tweak() -> None:
+    """Test that other keys and tweaks give other tokens."""
+    value = "john.doe@example.com"
+    token = FormatPreservingCipher(KEY).encrypt(value, "STRING", TWEAK)
+    assert FormatPreservingCipher(bytes(32)).encrypt(value, "STRING", TWEAK) != token
+    assert FormatPreservingCipher(KEY).encrypt(value, "STRING", b"other") != token
+
+
+def test_short_key_is_rejected() -> None:
+    """Test that keys shorter than 128 bits are rejected."""
+    with pytest.raises(ValueError):
+        FormatPreservingCipher(bytes(8))
+
+
+@pytest.mark.parametrize(
+    "value, data_type",
+    [
+        (str(INT64_MAX + 1), "INT"),
+        (str(INT64_MIN - 1), "INT"),
+        ("99999999999999999999", "INT"),
+        ("007", "INT"),
+        ("+7", "INT"),
+        ("1.50", "FLOAT"),
+        ("abc", "INT"),
+    ],
+)
+def test_values_that_arent_canonical_are_rejected(value: str, data_type: str) -> None:
+    """Test that values out of range or not written canonically aren't encrypted."""
+    with pytest.raises(ValueError, match="canonical"):
+        FormatPreservingCipher(KEY).encrypt(value, data_type, TWEAK)
+
+
+@pytest.mark.parametrize(
+    "value, data_type", [("x", "STRING"), ("7", "INT"), ("-7", "INT")]
+)
+def test_short_values_are_rejected(value: str, data_type: str) -> None:
+    """Test that values with fewer than 100 possible tokens aren't encrypted."""
+    with pytest.raises(ValueError, match="Too few characters"):
+        FormatPreservingCipher(KEY).encrypt(value, data_type, TWEAK)
+
+
+def test_cycle_walks_are_bounded(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a cycle walk that doesn't end fails instead of looping."""
+    monkeypatch.setattr(fpe, "is_canonical", lambda value, data_type: False)
+    with pytest.raises(ValueError, match="cycle walks"):
+        FormatPreservingCipher(KEY).decrypt("12345", "INT", TWEAK)
+
+
+@pytest.mark.anyio
+async def test_out_of_range_values_are_bad_requests(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Test that deidentify answers INT values out of range with a 400."""
+    monkeypatch.setattr(fpe, "_cipher", FormatPreservingCipher(KEY))
+    body = {
+        "requestId": "124ab1c",
+        "caller": "caller",
+        "sessionUser": "test-user@test-company.com",
+        "userDefinedContext": {
+            "action": "DEIDENTIFY",
+            "tokenType": "INT",
+            "method": "FORMAT_PRESERVING_ENCRYPTION",
+        },
+        "calls": [["CUSTOMER_ID", "12345", "99999999999999999999"]],
+    }
+    async with AsyncClient(app=api, base_url="http://testserver") as client:
+        response = await client.post("/", json=body)
+        assert response.status_code == 400
+        assert "canonical" in response.json()["error"]
+        body["calls"] = [["CUSTOMER_ID", "12345", INT64_MAX]]
+        response = await client.post("/", json=body)
+        assert response.status_code == 200
@@ -5,3 +5,9 @@ import tokenvaultapi.gunicorn_config as gunicorn_config
 
 def test_gunicorn_config(client: TestClient) -> None:
     assert gunicorn_config.worker_class == "uvicorn.workers.UvicornWorker"
+
+
+def test_workers_fit_the_cpus() -> None:
+    """Test that there is a worker per CPU and that threads aren't set."""
+    assert gunicorn_config.workers == gunicorn_config.cpu_count() >= 1
+    assert not hasattr(gunicorn_config, "threads")
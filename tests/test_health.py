@@ -1,11 +1,20 @@
 #from starlette.testclient import TestClient
+import asyncio
+import time
+
 import pytest
 from httpx import AsyncClient
+from starlette.testclient import TestClient
+
+from tokenvaultapi import main
 from tokenvaultapi.main import api
+from tokenvaultapi.stores.memory import MemoryTokenStore
+
 
 #def test_healthcheck(client: TestClient):
 #@pytest.fixture(scope="module", autouse=True)
 @pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio", "trio"])
 #async def test_healthcheck(async_client: AsyncClient):
 async def test_healthcheck():
     async with AsyncClient(app=api, base_url="http://test") as async_client:
@@ -14,3 +23,25 @@ async def test_healthcheck():
     assert response.get("message") == "healthy"
     assert response.get("version")
     assert response.get("time")
+
+
+class SlowStore(MemoryTokenStore):
+    """Memory store that takes a while to warm up."""
+
+    async def warm_up(self) -> None:
+        await asyncio.sleep(0.5)
+
+
+def test_healthcheck_is_unavailable_until_warmed_up(monkeypatch):
+    """Test that a starting worker reports ready once its store is warmed up."""
+    monkeypatch.setattr(main, "create_store", SlowStore)
+    with TestClient(api) as client:
+        assert client.get("/healthcheck").status_code == 503
+        for _ in range(50):
+            response = client.get("/healthcheck")
+            if response.status_code == 200:
+                break
+            time.sleep(0.05)
+        assert response.json()["message"] == "healthy"
+        assert isinstance(api.state.token_service.token_dao.store, SlowStore)
+    assert api.state.token_service is None
@@ -0,0 +1,49 @@
+"""Test derivation of document keys."""
+import hashlib
+from uuid import UUID
+
+from tokenvaultapi import keys
+from tokenvaultapi.keys import (V1, V2, derive_key, derive_keys, legacy_key,
+                                reverse_key)
+
+ROWS = [
+    ["customers", "42", "john.doe@example.com"],
+    ["customers", "42", "john.doe@example.com", "email"],
+    ["customers", 42, 3.14],
+    ["customers", "Åsa", "Öberg"],
+]
+
+
+def test_legacy_key_is_unchanged() -> None:
+    expected = str(UUID(hex=hashlib.md5(b"customers 42 12345").hexdigest()))
+    assert legacy_key(["customers", "42", 12345]) == expected
+    assert derive_key(["customers", "42", 12345], V1) == expected
+
+
+def test_v2_keys_are_unambiguous() -> None:
+    assert legacy_key(["a b", "c"]) == legacy_key(["a", "b c"])
+    assert derive_key(["a b", "c"], V2) != derive_key(["a", "b c"], V2)
+    assert derive_key(["a", "b", ""], V2) != derive_key(["a", "b"], V2)
+
+
+def test_v2_keys_differ_from_legacy_keys() -> None:
+    for row in ROWS:
+        key = derive_key(row, V2)
+        assert len(key) == 32 and "-" not in key
+        assert key != legacy_key(row).replace("-", "")
+
+
+def test_batch_matches_single_keys() -> None:
+    for scheme in (V1, V2):
+        assert derive_keys(ROWS, scheme) == [derive_key(row, scheme) for row in ROWS]
+
+
+def test_reverse_keys_dont_follow_key_scheme(monkeypatch) -> None:
+    """Test that reverse keys stay the same when KEY_SCHEME is switched."""
+    values = ["customers", "identity-token", "token", "email"]
+    key = reverse_key(*values)
+    assert key == derive_key(values, V2)
+    # as if started with KEY_SCHEME=v1
+    monkeypatch.setattr(keys.derive_key, "__defaults__", (V1,))
+    assert derive_key(values) == legacy_key(values)
+    assert reverse_key(*values) == key
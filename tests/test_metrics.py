@@ -0,0 +1,74 @@
+"""Test the metrics."""
+import pytest
+from fakeredis import FakeAsyncRedis
+from httpx import AsyncClient
+
+from tokenvaultapi.cache import LRUCache, RedisCache, TieredCache
+from tokenvaultapi.main import api
+from tokenvaultapi.metrics import Registry, registry
+from tokenvaultapi.schemas.token import RemoteFunctionTokenRequest
+
+pytestmark = pytest.mark.anyio
+
+
+def test_render() -> None:
+    """Test that histograms and counters are rendered in the Prometheus format."""
+    registry = Registry()
+    registry.inc("requests_total", "Requests.", 2, result="hit")
+    histogram = registry.histogram("seconds", "Seconds.", (0.1, 1), stage="parse")
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{result="hit"} 2',
+        "# HELP seconds Seconds.",
+        "# TYPE seconds histogram",
+        'seconds_bucket{stage="parse",le="0.1"} 1',
+        'seconds_bucket{stage="parse",le="1"} 2',
+        'seconds_bucket{stage="parse",le="+Inf"} 2',
+        'seconds_sum{stage="parse"} 0.55',
+        'seconds_count{stage="parse"} 2',
+    ]
+
+
+async def test_metrics_endpoint() -> None:
+    """Test that the stages of a request are exported."""
+    request = RemoteFunctionTokenRequest.Config.schema_extra["example"]
+    async with AsyncClient(app=api, base_url="http://testserver") as client:
+        response = await client.post("/", json=request)
+        assert response.status_code == 200
+        response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    for line in (
+        'tokenvault_stage_seconds_count{stage="parse"}',
+        'tokenvault_stage_seconds_count{stage="derive_keys"}',
+        'tokenvault_cache_lookups_total{result="miss"}',
+        'tokenvault_request_seconds_count{method="POST",route="/"}',
+    ):
+        assert line in response.text
+
+
+async def test_cache_lookups_by_tier() -> None:
+    """Test that the lookups of each cache tier are counted by result."""
+    name = "tokenvault_cache_tier_lookups_total"
+    counters = dict(registry.counters.get(name, {}))
+    l2 = RedisCache("redis://", ttl=60, client=FakeAsyncRedis())
+    await l2.set_many({"a": "1"})
+    cache = TieredCache(LRUCache(max_size=10, ttl=60), l2, negative_ttl=1)
+    await cache.get_many(["a", "b"])
+    await cache.get_many(["a"])
+    counted = {
+        "{tier} {result}".format(**dict(labels)): value - counters.get(labels, 0)
+        for labels, value in registry.counters[name].items()
+    }
+    assert counted == {
+        "memory hit": 1,
+        "memory miss": 2,
+        "redis hit": 1,
+        "redis miss": 1,
+    }
+    async with AsyncClient(app=api, base_url="http://testserver") as client:
+        response = await client.get("/metrics")
+    assert f'{name}{{result="hit",tier="memory"}}' in response.text
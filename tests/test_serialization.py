@@ -0,0 +1,53 @@
+"""Test parsing of remote function requests."""
+import json
+
+import pytest
+
+from tokenvaultapi.schemas.token import RemoteFunctionTokenRequest
+from tokenvaultapi.serialization import parse_remote_function_request
+
+REQUEST = {
+    "requestId": "124ab1c",
+    "caller": "//bigquery.googleapis.com/projects/myproject/jobs/myproject:US.job",
+    "sessionUser": "test-user@test-company.com",
+    "userDefinedContext": {"action": "DEIDENTIFY", "tokenType": "STRING"},
+    "calls": [
+        ["CUSTOMER_ID", "12345", "john.doe@example.com"],
+        ["CUSTOMER_ID", "12345", 42, "age"],
+        ["CUSTOMER_ID", "12345", 3.14],
+        ["CUSTOMER_ID", "12345", None],
+        ["CUSTOMER_ID", "12345", True],
+    ],
+}
+
+
+def test_parse_matches_pydantic() -> None:
+    """Test that parsing gives the same request as the pydantic model."""
+    batch = parse_remote_function_request(json.dumps(REQUEST).encode())
+    assert batch == RemoteFunctionTokenRequest(**REQUEST)
+    assert batch.calls[4][2] == "True"
+
+
+def test_parse_without_context() -> None:
+    """Test that the user defined context is optional."""
+    request = {**REQUEST, "userDefinedContext": None}
+    batch = parse_remote_function_request(json.dumps(request).encode())
+    assert batch.userDefinedContext is None
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"not json",
+        b"[]",
+        json.dumps({**REQUEST, "requestId": None}).encode(),
+        json.dumps({**REQUEST, "calls": {"a": 1}}).encode(),
+        json.dumps({**REQUEST, "calls": ["a"]}).encode(),
+        json.dumps({**REQUEST, "calls": [["a", "b", {"c": 1}]]}).encode(),
+        json.dumps({**REQUEST, "userDefinedContext": ["DEIDENTIFY"]}).encode(),
+    ],
+)
+def test_parse_invalid_requests(body: bytes) -> None:
+    """Test that invalid requests raise ValueError."""
+    with pytest.raises(ValueError):
+        parse_remote_function_request(body)
@@ -0,0 +1,76 @@
+"""Test the coalescing of concurrent token lookups and creations."""
+import asyncio
+
+import pytest
+
+from tokenvaultapi.cache import NullCache
+from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.singleflight import SingleFlight
+from tokenvaultapi.stores.sqlite import SQLiteTokenStore
+
+from tests.conftest import token_create
+
+pytestmark = pytest.mark.anyio
+
+CALLS = [["CUSTOMER_ID", "1", "a@example.com"], ["CUSTOMER_ID", "1", "b"]]
+
+
+@pytest.fixture()
+def store(tmp_path) -> SQLiteTokenStore:
+    return SQLiteTokenStore(str(tmp_path / "tokens.db"))
+
+
+async def test_concurrent_calls_are_coalesced() -> None:
+    """Test that callers of keys in flight share one call."""
+    flight = SingleFlight()
+    calls = []
+
+    async def func(keys):
+        calls.append(keys)
+        await asyncio.sleep(0.01)
+        return {key: key.upper() for key in keys if key != "missing"}
+
+    results = await asyncio.gather(
+        flight.do_many(["a", "b"], func),
+        flight.do_many(["b", "c", "missing"], func),
+        flight.do("a", lambda: asyncio.sleep(0, "not called")),
+    )
+    assert results[:2] == [{"a": "A", "b": "B"}, {"b": "B", "c": "C"}]
+    assert results[2] == "A"
+    assert calls == [["a", "b"], ["c", "missing"]]
+    assert flight.in_flight() == 0
+
+
+async def test_errors_are_raised_to_waiting_callers() -> None:
+    """Test that callers waiting for a failed call get its error."""
+    flight = SingleFlight()
+
+    async def func(keys):
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    results = await asyncio.gather(
+        flight.do_many(["a"], func), flight.do_many(["a"], func), return_exceptions=True
+    )
+    assert [type(result) for result in results] == [ValueError, ValueError]
+    assert flight.in_flight() == 0
+
+
+async def test_concurrent_deidentify(store: SQLiteTokenStore) -> None:
+    """Test that concurrent batches of the same rows get the same tokens."""
+    dao = TokenDAO(cache=NullCache(), store=store)
+    replies = await asyncio.gather(
+        *(dao.deidentify_calls(CALLS, "STRING", "RANDOM") for _ in range(5))
+    )
+    assert all(reply == replies[0] for reply in replies)
+    assert len(await store.list("CUSTOMER_ID", "1")) == 3
+
+
+async def test_create_reads_back_existing_tokens(store: SQLiteTokenStore) -> None:
+    """Test that tokens created by another worker are read back instead of failing."""
+    other = TokenDAO(cache=NullCache(), store=store)
+    token = await other.create(token_create(CALLS[0]))
+    dao = TokenDAO(cache=NullCache(), store=store)
+    tokens = await dao.create_many([token_create(call) for call in CALLS])
+    assert tokens[token.pk].token == token.token
+    assert len(await store.list("CUSTOMER_ID", "1")) == 3
@@ -0,0 +1,112 @@
+"""Test the memory-mapped token snapshots and their replicas."""
+import os
+import stat
+from datetime import datetime
+
+import pytest
+
+from tokenvaultapi.cache import NullCache
+from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.keys import reverse_key_of
+from tokenvaultapi.snapshot import (Snapshot, SnapshotReplica, export,
+                                    write_snapshot)
+from tokenvaultapi.stores.memory import MemoryTokenStore
+
+from tests.conftest import document
+
+pytestmark = pytest.mark.anyio
+
+CALLS = [["CUSTOMER_ID", str(i), f"user{i}@example.com"] for i in range(20)]
+
+
+@pytest.fixture()
+def store() -> MemoryTokenStore:
+    store = MemoryTokenStore()
+    store.tombstones = True
+    return store
+
+
+def reidentify_calls(store: MemoryTokenStore, tokens: list) -> list:
+    """Create the reidentify calls of the tokens of CALLS."""
+    identity_tokens = {
+        data["identity"]: data["identity_token"] for data in store.documents.values()
+    }
+    return [
+        [call[0], identity_tokens.get(call[1], "deleted"), token]
+        for call, token in zip(CALLS, tokens)
+    ]
+
+
+def test_snapshot_file(tmp_path) -> None:
+    """Test that documents are looked up by pk and reverse key, and kept in order."""
+    path = str(tmp_path / "tokens.snapshot")
+    documents = [document(f"pk{i}", str(i), f"1{i}", type="INT") for i in (3, 1, 2)]
+    # snapshots keep the fields of a Token, without the method
+    for data in documents:
+        del data["method"]
+    count = write_snapshot(path, documents, datetime(2023, 9, 2), ["CUSTOMER_ID"])
+    assert count == 3
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    with Snapshot(path) as snapshot:
+        assert len(snapshot) == 3
+        assert snapshot.watermark == datetime(2023, 9, 1, 12)
+        assert snapshot.exported_at == datetime(2023, 9, 2)
+        assert snapshot.identifiers == ["CUSTOMER_ID"]
+        assert [data["pk"] for data in snapshot] == ["pk1", "pk2", "pk3"]
+        assert snapshot.get("pk2") == documents[2]
+        assert snapshot.find(reverse_key_of(documents[0]))["pk"] == "pk3"
+        assert snapshot.get("missing") is None
+        assert snapshot.find("missing") is None
+
+
+async def test_reads_are_answered_from_the_replica(store, tmp_path) -> None:
+    """Test that tokens in the snapshot are read without store round trips."""
+    path = str(tmp_path / "tokens.snapshot")
+    writer = TokenDAO(store=store, cache=NullCache())
+    tokens = await writer.deidentify_calls(CALLS, "STRING")
+    assert await export(store, path) == 40
+    dao = TokenDAO(store=store, cache=NullCache(), snapshot=SnapshotReplica(path))
+    store.rpcs.clear()
+    calls = reidentify_calls(store, tokens)
+    assert await dao.reidentify_calls(calls) == [call[2] for call in CALLS]
+    assert await dao.deidentify_calls(CALLS, "STRING") == tokens
+    assert store.rpcs["get"] == 0
+
+
+async def test_refresh_reads_what_changed_since(store, tmp_path) -> None:
+    """Test that refreshes add created tokens and hide deleted ones."""
+    path = str(tmp_path / "tokens.snapshot")
+    writer = TokenDAO(store=store, cache=NullCache())
+    tokens = await writer.deidentify_calls(CALLS[:10], "STRING")
+    await export(store, path)
+    replica = SnapshotReplica(path)
+    dao = TokenDAO(store=store, cache=NullCache(), snapshot=replica)
+    new_tokens = await writer.deidentify_calls(CALLS[10:], "STRING")
+    calls = reidentify_calls(store, tokens + new_tokens)
+    await writer.delete_identity("CUSTOMER_ID", "0")
+    assert await replica.refresh(store) > 0
+    store.rpcs.clear()
+    replies = await dao.reidentify_calls(calls)
+    assert replies == [None] + [call[2] for call in CALLS[1:]]
+    # the deleted token is read from the store
+    assert store.rpcs["get"] == 1
+    await dao.delete_identity("CUSTOMER_ID", "1")
+    assert (await dao.reidentify_calls(calls[1:2])) == [None]
+
+
+async def test_incremental_export(store, tmp_path) -> None:
+    """Test that an incremental export merges the changes into the snapshot."""
+    path = str(tmp_path / "tokens.snapshot")
+    writer = TokenDAO(store=store, cache=NullCache())
+    await writer.deidentify_calls(CALLS[:10], "STRING")
+    await export(store, path, ["CUSTOMER_ID"])
+    await writer.deidentify_calls(CALLS[10:], "STRING")
+    await writer.delete_identity("CUSTOMER_ID", "0")
+    replica = SnapshotReplica(path)
+    assert await export(store, path, incremental=True) == 38
+    with Snapshot(path) as snapshot:
+        assert snapshot.identifiers == ["CUSTOMER_ID"]
+        assert sorted(data["pk"] for data in snapshot) == sorted(store.documents)
+    # the replica reopens the replaced file
+    await replica.refresh(store)
+    assert len(replica.snapshot) == 38
@@ -0,0 +1,140 @@
+"""Test the token stores, Firestore with an in-memory client."""
+from datetime import datetime
+
+import pytest
+
+from tokenvaultapi.keys import reverse_key_of
+from tokenvaultapi.schemas.token import TokenFind
+from tokenvaultapi.stores import TokenExists, TokenStore
+from tokenvaultapi.stores.firestore import FirestoreTokenStore
+from tokenvaultapi.stores.memory import MemoryTokenStore
+from tokenvaultapi.stores.sqlite import SQLiteTokenStore
+
+from tests.conftest import document
+from tests.fake_firestore import FakeFirestore
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(params=["sqlite", "memory", "firestore"])
+def store(request, tmp_path) -> TokenStore:
+    if request.param == "memory":
+        return MemoryTokenStore()
+    if request.param == "firestore":
+        return FirestoreTokenStore(FakeFirestore())
+    return SQLiteTokenStore(str(tmp_path / "tokens.db"))
+
+
+async def test_create_and_get(store: TokenStore) -> None:
+    """Test that created documents are read back as typed tokens."""
+    await store.create_many([document("a", "x"), document("b", "42", "24", type="INT")])
+    tokens = await store.get_many(["a", "b", "c"])
+    assert set(tokens) == {"a", "b"}
+    assert tokens["a"].token == "token-x"
+    assert tokens["a"].created_at == datetime(2023, 9, 1, 12)
+    assert tokens["b"].value == 42
+    assert tokens["b"].token == 24
+
+
+async def test_create_existing_token(store: TokenStore) -> None:
+    """Test that creating an existing token raises TokenExists."""
+    await store.create_many([document("a", "x")])
+    with pytest.raises(TokenExists):
+        await store.create_many([document("b", "y"), document("a", "x")])
+    # the batch is written all or nothing
+    assert await store.get_many(["b"]) == {}
+
+
+async def test_create_taken_reverse_key(store: TokenStore) -> None:
+    """Test that a token another token of its identity and field has isn't created."""
+    await store.create_many([document("a", "x", "same")])
+    with pytest.raises(TokenExists):
+        await store.create_many([document("b", "y"), document("c", "z", "same")])
+    with pytest.raises(TokenExists):
+        await store.create_many(
+            [document("b", "y"), document("c", "y", "token-y")]
+        )
+    assert await store.get_many(["b", "c"]) == {}
+    other_field = {**document("c", "z", "same"), "field": "email"}
+    await store.create_many([other_field])
+    find = TokenFind(
+        identifier="CUSTOMER_ID", identity_token="identity-token", token="same"
+    )
+    key = reverse_key_of(find.dict())
+    assert (await store.find_many({key: find}))[key].value == "x"
+
+
+async def test_find(store: TokenStore) -> None:
+    """Test that tokens are found by token."""
+    await store.create_many([document("a", "x")])
+    found = TokenFind(
+        identifier="CUSTOMER_ID", identity_token="identity-token", token="token-x"
+    )
+    missing = TokenFind(
+        identifier="CUSTOMER_ID", identity_token="identity-token", token="token-y"
+    )
+    key = reverse_key_of(found.dict())
+    tokens = await store.find_many(
+        {key: found, reverse_key_of(missing.dict()): missing}
+    )
+    assert list(tokens) == [key]
+    assert tokens[key].pk == "a"
+
+
+async def test_scan_and_delete(store: TokenStore) -> None:
+    """Test that the tokens of an identity are scanned in pages and deleted."""
+    store.page_size = 2
+    await store.create_many([document(str(i), str(i)) for i in range(5)])
+    fields = ["identifier", "identity_token", "token", "field"]
+    documents = [data async for data in store.scan("CUSTOMER_ID", "1", fields)]
+    assert [data["pk"] for data in documents] == ["0", "1", "2", "3", "4"]
+    assert reverse_key_of(documents[0]) == reverse_key_of(document("0", "0"))
+    await store.delete_many(documents[:3])
+    assert [token.pk for token in await store.list("CUSTOMER_ID", "1")] == ["3", "4"]
+
+
+async def test_scan_pages(store: TokenStore) -> None:
+    """Test that the tokens of an identity are scanned a page after a cursor."""
+    store.page_size = 2
+    await store.create_many([document(str(i), str(i)) for i in range(5)])
+    page = [data async for data in store.scan("CUSTOMER_ID", "1", limit=3)]
+    assert [data["pk"] for data in page] == ["0", "1", "2"]
+    assert page[0]["created_at"] == datetime(2023, 9, 1, 12)
+    page = [
+        data
+        async for data in store.scan("CUSTOMER_ID", "1", ["token"], page[-1]["pk"], 3)
+    ]
+    assert page == [{"pk": "3", "token": "token-3"}, {"pk": "4", "token": "token-4"}]
+
+
+async def test_scan_since_and_tombstones(store: TokenStore) -> None:
+    """Test that documents are scanned by created_at and deletes leave tombstones."""
+    store.page_size = 2
+    store.tombstones = True
+    documents = [document(str(i), str(i)) for i in range(4)]
+    documents[3]["created_at"] = datetime(2023, 9, 2)
+    documents[2]["identifier"] = "EMAIL"
+    await store.create_many(documents)
+    scanned = [data async for data in store.scan_since()]
+    assert sorted(data["pk"] for data in scanned) == ["0", "1", "2", "3"]
+    scanned = [data async for data in store.scan_since(datetime(2023, 9, 1, 12))]
+    assert [data["pk"] for data in scanned] == ["3"]
+    assert scanned[0]["created_at"] == datetime(2023, 9, 2)
+    scanned = [data async for data in store.scan_since(identifiers=["EMAIL"])]
+    assert [data["pk"] for data in scanned] == ["2"]
+    before = datetime.utcnow()
+    await store.delete_many(documents[:1])
+    tombstones = [tombstone async for tombstone in store.deleted_since(before)]
+    assert len(tombstones) == 1
+    assert tombstones[0]["pk"] == "0"
+    assert reverse_key_of(tombstones[0]) == reverse_key_of(documents[0])
+    assert tombstones[0]["deleted_at"] >= before
+    assert [tombstone async for tombstone in store.deleted_since(datetime.utcnow())] == []
+
+
+async def test_jobs(store: TokenStore) -> None:
+    """Test that jobs are stored and updated."""
+    assert await store.get_job("job") is None
+    await store.set_job("job", {"status": "pending", "count": 0})
+    await store.update_job("job", {"status": "running", "count": 3})
+    assert await store.get_job("job") == {"status": "running", "count": 3}
@@ -0,0 +1,79 @@
+"""Test streaming tokenization of NDJSON and CSV rows."""
+import json
+from typing import AsyncIterator, List
+
+import pytest
+
+from tokenvaultapi.streaming import (CSVStreamFormat, StreamFormat,
+                                     stream_format, tokenize_stream)
+
+pytestmark = pytest.mark.anyio
+
+
+async def body(*parts: bytes) -> AsyncIterator[bytes]:
+    """Stream a request body in parts."""
+    for part in parts:
+        yield part
+
+
+async def collect(stream: AsyncIterator[bytes]) -> bytes:
+    """Read a whole stream."""
+    return b"".join([data async for data in stream])
+
+
+async def test_ndjson_rows_split_across_parts() -> None:
+    """Test that rows are processed in chunks and replied in order."""
+    chunks = []
+
+    async def process(calls: List[list]) -> list:
+        chunks.append(len(calls))
+        return [f"{call[0]}:{call[2]}" for call in calls]
+
+    output = await collect(
+        tokenize_stream(
+            body(b'["C", "1", "a"]\n["C", "1", ', b'2]\n\n["C", "2", "c", "f"]\n'),
+            StreamFormat(),
+            process,
+            chunk_size=2,
+        )
+    )
+    replies = [json.loads(line) for line in output.splitlines()]
+    assert replies == ["C:a", "C:2", "C:c"]
+    assert chunks == [2, 1]
+
+
+async def test_csv_rows() -> None:
+    """Test CSV rows with quoted values and a missing trailing newline."""
+
+    async def process(calls: List[list]) -> list:
+        return [call[2] or None for call in calls]
+
+    output = await collect(
+        tokenize_stream(
+            body(b'C,1,"a, b"\nC,1,,f'), CSVStreamFormat(), process, chunk_size=10
+        )
+    )
+    assert output == b'"a, b"\n""\n'
+
+
+async def test_invalid_row_ends_stream_with_error() -> None:
+    """Test that rows before an invalid row are replied before the error."""
+
+    async def process(calls: List[list]) -> list:
+        return [None for _ in calls]
+
+    output = await collect(
+        tokenize_stream(
+            body(b'["C", "1", "a"]\n["C", "1"]\n'), StreamFormat(), process, 1
+        )
+    )
+    lines = output.splitlines()
+    assert lines[0] == b"null"
+    assert json.loads(lines[1]) == {"error": "Row 2 must have 3 or 4 values."}
+
+
+def test_stream_format() -> None:
+    """Test that the format is chosen by content type."""
+    assert isinstance(stream_format("text/csv; charset=utf-8"), CSVStreamFormat)
+    assert type(stream_format("application/x-ndjson")) is StreamFormat
+    assert type(stream_format("")) is StreamFormat
@@ -0,0 +1,185 @@
+"""Test the batched reads and writes of the token DAO."""
+import pytest
+
+from tokenvaultapi.cache import LRUCache, NullCache
+from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.keys import derive_key
+from tokenvaultapi.stores import TokenCollision
+from tokenvaultapi.stores.memory import MemoryTokenStore
+from tokenvaultapi.stores.sqlite import SQLiteTokenStore
+
+from tests.conftest import token_create
+
+pytestmark = pytest.mark.anyio
+
+CALLS = [["CUSTOMER_ID", str(i % 10), f"user{i}@example.com"] for i in range(100)]
+
+
+class RacingStore(MemoryTokenStore):
+    """Memory store where another worker creates a token before the first write."""
+
+    def __init__(self, pk: str) -> None:
+        super().__init__()
+        self.pk = pk
+
+    async def create_many(self, documents: list) -> None:
+        for data in documents:
+            if data["pk"] == self.pk:
+                self.pk = None
+                await super().create_many([{**data, "token": "other-worker"}])
+        await super().create_many(documents)
+
+
+def create_dao(store: MemoryTokenStore) -> TokenDAO:
+    """Create a DAO without cache and legacy key lookups, to count round trips."""
+    return TokenDAO(store=store, cache=NullCache(), legacy_key_fallback=False)
+
+
+async def test_created_tokens_are_not_read_back() -> None:
+    """Test that create returns the token it wrote without reading it back."""
+    store = MemoryTokenStore()
+    token = await create_dao(store).create(token_create(["CUSTOMER_ID", "1", "x"]))
+    # the identity is read, then the identity and the token are written
+    assert store.rpcs == {
+        "get": 1,
+        "get_documents": 1,
+        "write": 2,
+        "write_documents": 2,
+    }
+    stored = store.documents[token.pk]
+    assert (token.value, token.token, token.identity_token) == (
+        "x",
+        stored["token"],
+        stored["identity_token"],
+    )
+    assert token.token != "x"
+
+
+async def test_identities_are_resolved_once_per_memo() -> None:
+    """Test that creates sharing an identities memo read each identity once."""
+    store = MemoryTokenStore()
+    dao = create_dao(store)
+    identities = {}
+    first = await dao.create(token_create(["CUSTOMER_ID", "1", "x"]), identities)
+    assert list(identities) == [derive_key(["CUSTOMER_ID", "1", "1"])]
+    store.rpcs.clear()
+    tokens = [
+        await dao.create(token_create(["CUSTOMER_ID", "1", value]), identities)
+        for value in "abcde"
+    ]
+    assert store.rpcs == {"write": 5, "write_documents": 5}
+    assert {token.identity_token for token in tokens} == {first.identity_token}
+
+
+async def test_cached_identities_are_not_read() -> None:
+    """Test that an identity in the cache isn't read for new values."""
+    store = MemoryTokenStore()
+    dao = TokenDAO(store=store, cache=LRUCache(100, 60), legacy_key_fallback=False)
+    await dao.create(token_create(["CUSTOMER_ID", "1", "x"]))
+    store.rpcs.clear()
+    await dao.create(token_create(["CUSTOMER_ID", "1", "y"]))
+    assert store.rpcs == {"write": 1, "write_documents": 1}
+
+
+async def test_fields_of_an_identity_share_its_identity_read() -> None:
+    """Test that a batch with many fields of a customer reads its identity once."""
+    store = MemoryTokenStore()
+    calls = [["CUSTOMER_ID", "1", f"field{i}"] for i in range(50)]
+    await create_dao(store).deidentify_calls(calls, "STRING")
+    # the 50 tokens, then the one identity
+    assert store.rpcs["get_documents"] == 50 + 1
+
+
+async def test_duplicate_rows_are_created_once() -> None:
+    """Test that repeated rows of a batch get the same token and one document."""
+    store = MemoryTokenStore()
+    calls = CALLS[:5] + CALLS[:5]
+    tokens = await create_dao(store).deidentify_calls(calls, "STRING")
+    assert tokens[:5] == tokens[5:]
+    assert len(set(tokens)) == 5
+    # a token and an identity document per row
+    assert len(store.documents) == 10
+    assert store.rpcs["get_documents"] == 5 + 5
+
+
+async def test_existing_and_new_rows() -> None:
+    """Test that existing rows keep their tokens and only new rows are written."""
+    store = MemoryTokenStore()
+    dao = create_dao(store)
+    existing = await dao.deidentify_calls(CALLS[:50], "STRING")
+    written = store.rpcs["write_documents"]
+    tokens = await dao.deidentify_calls(CALLS[25:75] + CALLS[:25], "STRING")
+    assert tokens[:25] == existing[25:]
+    assert tokens[50:] == existing[:25]
+    assert len(set(tokens)) == 75
+    assert store.rpcs["write_documents"] - written == 25
+    assert await dao.deidentify_calls(CALLS[:75], "STRING") == tokens[50:] + tokens[:50]
+
+
+async def test_existing_tokens_are_read_back() -> None:
+    """Test that a token created between the read and the write is read back."""
+    pk = derive_key(CALLS[0])
+    store = RacingStore(pk)
+    tokens = await create_dao(store).deidentify_calls(CALLS[:20], "STRING")
+    assert tokens[0] == "other-worker"
+    assert store.documents[pk]["token"] == "other-worker"
+    assert all(
+        store.documents[derive_key(call)]["token"] == token
+        for call, token in zip(CALLS[1:20], tokens[1:])
+    )
+
+
+async def test_round_trips_per_batch() -> None:
+    """Test that a batch is read and written in a few batched round trips."""
+    store = MemoryTokenStore()
+    dao = create_dao(store)
+    await dao.deidentify_calls(CALLS, "STRING")
+    # the tokens, then the identities, are read in one batch and created in another
+    assert store.rpcs["get"] == 2
+    assert store.rpcs["write"] == 2
+    store.rpcs.clear()
+    await dao.deidentify_calls(CALLS, "STRING")
+    assert store.rpcs["get"] == 1
+    assert store.rpcs["write"] == 0
+
+
+async def test_large_batches_are_chunked() -> None:
+    """Test that batches larger than a chunk are read and written in chunks."""
+    store = MemoryTokenStore()
+    store.max_write_batch = 30
+    dao = TokenDAO(
+        store=store, cache=NullCache(), legacy_key_fallback=False, chunk_size=40
+    )
+    tokens = await dao.deidentify_calls(CALLS, "STRING")
+    assert len(set(tokens)) == 100
+    # 100 tokens in chunks of 40 and 30, 10 identities in one
+    assert store.rpcs["get"] == 3 + 1
+    assert store.rpcs["write"] == 4 + 1
+
+
+@pytest.mark.parametrize("store", ["memory", "sqlite"])
+async def test_tokens_are_unique_per_identity_and_field(store, tmp_path) -> None:
+    """Test that values whose random tokens collide are tokenized again."""
+    if store == "sqlite":
+        store = SQLiteTokenStore(str(tmp_path / "tokens.db"))
+    else:
+        store = MemoryTokenStore()
+    dao = create_dao(store)
+    # one digit INT tokens have 9 tokens, collisions are likely
+    calls = [["CUSTOMER_ID", "1", str(i)] for i in range(2, 10)]
+    tokens = await dao.deidentify_calls(calls, "INT")
+    assert len(set(tokens)) == 8
+    identity_token = (await dao.get(derive_key(["CUSTOMER_ID", "1", "1"]))).token
+    replies = await dao.reidentify_calls(
+        [["CUSTOMER_ID", identity_token, token] for token in tokens], "INT"
+    )
+    assert replies == list(range(2, 10))
+
+
+async def test_tokens_that_cant_be_unique_are_rejected() -> None:
+    """Test that a value that every token is taken for fails the batch."""
+    dao = create_dao(MemoryTokenStore())
+    # ten one digit values for 9 tokens
+    calls = [["CUSTOMER_ID", "a", str(i)] for i in range(10)]
+    with pytest.raises(TokenCollision):
+        await dao.deidentify_calls(calls, "INT")
@@ -0,0 +1,63 @@
+"""Test tokenization of values."""
+from tokenvaultapi.tokenizers import (
+    format_preserving_token,
+    format_preserving_tokens,
+    tokenize_value,
+    tokenize_values,
+)
+
+VALUES = [
+    "john.doe@example.com",
+    "+46(0)701020304",
+    "0",
+    "12345",
+    "3.14",
+    "John Doe 42",
+    "Åsa Öberg",
+    "",
+]
+
+
+def character_classes(value: str, nonzero_ends: bool = True) -> list:
+    """Describe the format of a string, one class per character."""
+    classes = []
+    for index, char in enumerate(value):
+        if char.islower() and char.isalpha():
+            classes.append("lower")
+        elif char.isupper() and char.isalpha():
+            classes.append("upper")
+        elif char.isdigit() and index in (0, len(value) - 1) and nonzero_ends:
+            classes.append("nonzero" if char != "0" else "zero")
+        elif char.isdigit():
+            classes.append("digit")
+        else:
+            classes.append(char)
+    return classes
+
+
+def test_format_preserving_tokens_preserve_format() -> None:
+    """Test that batch tokens have the same format as single tokens."""
+    for _ in range(100):
+        tokens = format_preserving_tokens(VALUES)
+        for value, token in zip(VALUES, tokens):
+            expected = character_classes(format_preserving_token(value))
+            assert character_classes(token) == expected
+            assert "zero" not in character_classes(token)
+
+
+def test_format_preserving_tokens_are_random() -> None:
+    """Test that batch tokens use the whole alphabet."""
+    tokens = format_preserving_tokens(["a" * 1000, "5" * 1000])
+    assert set(tokens[0]) == set("abcdefghijklmnopqrstuvwxyz")
+    assert set(tokens[1]) == set("0123456789")
+
+
+def test_tokenize_values_matches_tokenize_value() -> None:
+    """Test that batch tokenization has the semantics of tokenize_value."""
+    assert tokenize_values("RANDOM", "STRING", ["12345"]) == [
+        tokenize_value("RANDOM", "STRING", "12345")
+    ]
+    assert 0 <= int(tokenize_values("RANDOM", "INT", [1])[0]) <= 1000000
+    assert 0 <= float(tokenize_values("RANDOM", "FLOAT", [1.0])[0]) < 1
+    assert tokenize_values("UNKNOWN", "STRING", ["a", "b"]) == [None, None]
+    assert len(tokenize_values("FORMAT_PRESERVING", "INT", [123])[0]) == 3
@@ -5,6 +5,7 @@ import pytest
 from httpx import AsyncClient
 
 from tokenvaultapi.main import api
+from tokenvaultapi.routers import token as token_router
 from tokenvaultapi.schemas.token import RemoteFunctionTokenRequest, TokenCreate
 
 pytestmark = pytest.mark.anyio
@@ -16,11 +17,6 @@ PK = None
 IDENTIFIER = mock_create_token.get("identifier")
 IDENTITY = mock_create_token.get("identity")
 
-@pytest.fixture(scope="module")
-def anyio_backend():
-    return "asyncio"
-
-
 @pytest.fixture(scope="module")
 async def client():
     #async with LifespanManager(api):
@@ -107,3 +103,80 @@ async def test_deidentify() -> None:
         data = response.json()
         assert data.get("replies")
         print(data)
+
+
+@pytest.mark.anyio
+async def test_list_tokens(client: AsyncClient) -> None:
+    """Test that tokens are listed in pages, projected and streamed."""
+    identity = str(uuid4())
+    calls = [[IDENTIFIER, identity, "a@example.com"], [IDENTIFIER, identity, "b"]]
+    response = await client.post("/", json={**mock_deidentiy_tokens, "calls": calls})
+    assert response.status_code == 200
+    url = f"/tokens/identifier/{IDENTIFIER}/identity/{identity}"
+    response = await client.get(url, params={"limit": 2, "fields": "value"})
+    assert response.status_code == 200
+    page = response.json()
+    assert len(page) == 2
+    assert set(page[0]) == {"pk", "value"}
+    cursor = response.headers["X-Next-Cursor"]
+    assert cursor == page[-1]["pk"]
+    response = await client.get(url, params={"limit": 2, "start_after": cursor})
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+    assert "X-Next-Cursor" not in response.headers
+    response = await client.get(url, params={"stream": True})
+    assert response.status_code == 200
+    assert [token["pk"] for token in response.json()][:2] == [
+        token["pk"] for token in page
+    ]
+    response = await client.get(url, params={"fields": "secret"})
+    assert response.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_list_tokens_default_page(client: AsyncClient, monkeypatch) -> None:
+    """Test that a listing without limit is a page with a cursor if more follow."""
+    monkeypatch.setattr(token_router, "LIST_PAGE_SIZE", 2)
+    identity = str(uuid4())
+    calls = [[IDENTIFIER, identity, "a@example.com"], [IDENTIFIER, identity, "b"]]
+    response = await client.post("/", json={**mock_deidentiy_tokens, "calls": calls})
+    assert response.status_code == 200
+    url = f"/tokens/identifier/{IDENTIFIER}/identity/{identity}"
+    response = await client.get(url)
+    assert len(response.json()) == 2
+    cursor = response.headers["X-Next-Cursor"]
+    response = await client.get(url, params={"start_after": cursor})
+    assert len(response.json()) == 1
+    # a page with all remaining tokens has no cursor
+    response = await client.get(url, params={"limit": 3})
+    assert len(response.json()) == 3
+    assert "X-Next-Cursor" not in response.headers
+    response = await client.get(url, params={"stream": True})
+    assert len(response.json()) == 3
+
+
+@pytest.mark.anyio
+async def test_list_tokens_openapi(client: AsyncClient) -> None:
+    """Test that the listing documents its cursor and doesn't validate as a model."""
+    response = await client.get("/openapi.json")
+    path = "/tokens/identifier/{identifier}/identity/{identity}"
+    listed = response.json()["paths"][path]["get"]["responses"]["200"]
+    assert "X-Next-Cursor" in listed["headers"]
+    assert listed["content"]["application/json"]["schema"]["type"] == "array"
+
+
+@pytest.mark.anyio
+async def test_delete_tokens(client: AsyncClient) -> None:
+    """Test that all tokens of an identity are deleted and counted."""
+    identity = str(uuid4())
+    calls = [[IDENTIFIER, identity, "a@example.com"], [IDENTIFIER, identity, "b"]]
+    response = await client.post("/", json={**mock_deidentiy_tokens, "calls": calls})
+    assert response.status_code == 200
+    response = await client.delete(
+        f"/tokens/identifier/{IDENTIFIER}/identity/{identity}"
+    )
+    assert response.status_code == 204
+    # the identity token is deleted too
+    assert response.headers["X-Deleted-Count"] == "3"
+    response = await client.get(f"/tokens/identifier/{IDENTIFIER}/identity/{identity}")
+    assert response.status_code == 404
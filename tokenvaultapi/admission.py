@@ -0,0 +1,172 @@
+"""Admission control and backpressure of store I/O.
+
+BigQuery calls the remote function with many batches in parallel. Without a bound every
+request fires its store RPCs at once, and Firestore answers the contention with 429s
+and aborted writes. Store calls of a worker therefore take a slot of a limiter, queue
+for one while all are taken, and are rejected once the queue is full or they waited
+too long. Retryable errors of the store are retried with jittered exponential backoff,
+and shrink the batches of the kind of call that failed until calls succeed again.
+
+Rejected calls and exhausted retries raise Overloaded, which the API answers with a
+503 or a 429 and a Retry-After header, so that BigQuery retries the batch instead of
+failing the query.
+"""
+import asyncio
+import math
+import random
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Tuple, Type
+
+from tokenvaultapi.config import (ADMISSION_MAX_CONCURRENCY,
+                                  ADMISSION_MAX_QUEUE,
+                                  ADMISSION_QUEUE_TIMEOUT_SECONDS,
+                                  RETRY_ATTEMPTS, RETRY_BASE_SECONDS,
+                                  RETRY_MAX_SECONDS)
+from tokenvaultapi.metrics import count_rejected, count_retry
+
+
+class Overloaded(Exception):
+    """Raised when a call is shed, to be retried after retry_after seconds."""
+
+    def __init__(
+        self, message: str, retry_after: float, status_code: int = 503
+    ) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+    @property
+    def headers(self) -> dict:
+        """Get the Retry-After header, in whole seconds."""
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class AdmissionLimiter:
+    """Bounds the calls in flight, with a bounded queue of calls waiting for a slot."""
+
+    def __init__(
+        self,
+        max_concurrency: int = ADMISSION_MAX_CONCURRENCY,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT_SECONDS,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self._loop: asyncio.AbstractEventLoop = None
+        self._semaphore: asyncio.Semaphore = None
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold a slot for a call, raises Overloaded if the queue is saturated."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.waiting = 0
+        if self._semaphore.locked():
+            if self.waiting >= self.max_queue:
+                count_rejected("queue_full")
+                raise Overloaded("Too many store calls queued.", self.queue_timeout)
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                count_rejected("queue_timeout")
+                raise Overloaded(
+                    "Timed out waiting for a store call slot.", self.queue_timeout
+                )
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+class AdaptiveBatchSize:
+    """Batch size that halves on contention and grows back additively."""
+
+    def __init__(self, maximum: int, minimum: int = 1) -> None:
+        self.maximum = maximum
+        self.minimum = minimum
+        # grows back to the maximum in ten successful calls after halving it once
+        self.step = max(1, maximum // 20)
+        self.size = maximum
+
+    def shrink(self) -> None:
+        """Halve the batch size after a contended call."""
+        self.size = max(self.minimum, self.size // 2)
+
+    def grow(self) -> None:
+        """Grow the batch size after a successful call."""
+        self.size = min(self.maximum, self.size + self.step)
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    """Get the seconds to sleep before a retry, with full jitter."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+async def retry(
+    func: Callable[[], Awaitable[Any]],
+    retryable: Tuple[Type[Exception], ...],
+    attempts: int = RETRY_ATTEMPTS,
+    base: float = RETRY_BASE_SECONDS,
+    cap: float = RETRY_MAX_SECONDS,
+    on_error: Callable[[Exception], Any] = None,
+) -> Any:
+    """Await func(), retrying retryable errors with jittered exponential backoff.
+
+    on_error is called with every retryable error. Raises Overloaded with status 429
+    once all attempts failed.
+    """
+    for attempt in range(attempts):
+        try:
+            return await func()
+        except retryable as e:
+            count_retry(type(e).__name__)
+            if on_error is not None:
+                on_error(e)
+            if attempt == attempts - 1:
+                raise Overloaded(f"Store is overloaded: {e}", cap, 429) from e
+            await asyncio.sleep(backoff(attempt, base, cap))
+
+
+class Admission:
+    """Admission control of store calls: a limiter, retries and batch sizes by kind."""
+
+    def __init__(
+        self,
+        limiter: AdmissionLimiter = None,
+        retryable: Tuple[Type[Exception], ...] = (),
+        **batch_sizes: int,
+    ) -> None:
+        self.limiter = limiter if limiter is not None else AdmissionLimiter()
+        self.retryable = retryable
+        self.batch_sizes = {
+            kind: AdaptiveBatchSize(size) for kind, size in batch_sizes.items()
+        }
+
+    def batch_size(self, kind: str) -> int:
+        """Get the current batch size of calls of a kind."""
+        return self.batch_sizes[kind].size
+
+    async def call(
+        self, kind: str, func: Callable[..., Awaitable[Any]], *args: Any
+    ) -> Any:
+        """Await func(*args) in a slot of the limiter, retrying retryable errors."""
+        batch_size = self.batch_sizes[kind]
+
+        async def call() -> Any:
+            async with self.limiter.slot():
+                return await func(*args)
+
+        result = await retry(
+            call, self.retryable, on_error=lambda e: batch_size.shrink()
+        )
+        batch_size.grow()
+        return result
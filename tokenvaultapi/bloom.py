@@ -0,0 +1,215 @@
+"""Bloom filter of the keys of issued tokens, to skip reads of tokens that don't exist.
+
+Deidentify reads every token before creating the missing ones, and most reads of new
+values find nothing. A Bloom filter over the pks and reverse index keys of all tokens
+tells that a key definitely doesn't exist, so those reads are skipped and the tokens
+created right away. Creating a token that does exist fails the precondition of the
+write and the token is read back, see TokenDAO._create_chunk, so a filter that misses
+recent tokens only costs a failed write.
+
+Reidentify can skip the lookups of tokens that definitely don't exist as well, with
+BLOOM_TRUST_NEGATIVES set. Such a token is replied with None, so only set it when
+tokens are reidentified after the next refresh of the filter following their creation.
+
+Build the filter with `python -m tokenvaultapi.bloom --path tokens.bloom`, and set
+BLOOM_PATH to load it in every worker. Workers add the tokens they create, and the
+tokens created since the filter was built every BLOOM_REFRESH_SECONDS. Deleted tokens
+stay in the filter, which only costs their reads.
+"""
+import argparse
+import asyncio
+import hashlib
+import math
+import os
+import struct
+from datetime import datetime, timedelta
+from typing import Iterable, List
+
+from tokenvaultapi.config import (BLOOM_CAPACITY, BLOOM_ERROR_RATE,
+                                  BLOOM_MAX_BYTES, BLOOM_PATH,
+                                  BLOOM_REFRESH_SECONDS,
+                                  SNAPSHOT_REFRESH_OVERLAP_SECONDS)
+from tokenvaultapi.keys import reverse_key_of
+from tokenvaultapi.logger import logger
+from tokenvaultapi.serialization import dumps, loads
+from tokenvaultapi.snapshot import EPOCH, utc
+from tokenvaultapi.stores.base import TokenStore
+
+MAGIC = b"TVBLOOM1"
+# magic and length of the metadata
+HEADER = struct.Struct("<8sI")
+
+
+class BloomFilter:
+    """Set membership with false positives but no false negatives, in bits bits."""
+
+    def __init__(self, bits: int, hashes: int) -> None:
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray((bits + 7) // 8)
+        # keys added, and the latest created_at of the tokens added by a refresh
+        self.count = 0
+        self.watermark = EPOCH
+
+    @classmethod
+    def for_capacity(
+        cls,
+        capacity: int = 2 * BLOOM_CAPACITY,
+        error_rate: float = BLOOM_ERROR_RATE,
+        max_bytes: int = BLOOM_MAX_BYTES,
+    ) -> "BloomFilter":
+        """Size a filter for capacity keys at error_rate, in at most max_bytes.
+
+        The default capacity is the two keys of BLOOM_CAPACITY tokens.
+        """
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        bits = max(8, min(bits, max_bytes * 8))
+        hashes = max(1, round(bits / max(capacity, 1) * math.log(2)))
+        return cls(bits, hashes)
+
+    def _positions(self, key: str) -> Iterable[int]:
+        """Get the bit positions of a key, by double hashing."""
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.bits for i in range(self.hashes))
+
+    def add(self, key: str) -> None:
+        """Add a key, only counted if it wasn't in the filter yet."""
+        added = False
+        for position in self._positions(key):
+            bit = 1 << (position & 7)
+            if not self.data[position >> 3] & bit:
+                self.data[position >> 3] |= bit
+                added = True
+        self.count += added
+
+    def add_many(self, keys: Iterable[str]) -> None:
+        """Add keys."""
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key: str) -> bool:
+        """Whether the key may have been added, False if it definitely wasn't."""
+        return all(
+            self.data[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+    @property
+    def error_rate(self) -> float:
+        """Estimate the false positive rate at the number of keys added."""
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+    def save(self, path: str) -> None:
+        """Write the filter to a file, replacing it atomically."""
+        metadata = dumps(
+            {
+                "bits": self.bits,
+                "hashes": self.hashes,
+                "count": self.count,
+                "watermark": self.watermark.isoformat(),
+            }
+        )
+        temporary = f"{path}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(metadata)) + metadata)
+            f.write(self.data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BloomFilter":
+        """Read a filter written by save."""
+        with open(path, "rb") as f:
+            magic, length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a Bloom filter of tokens.")
+            metadata = loads(f.read(length))
+            bloom = cls(metadata["bits"], metadata["hashes"])
+            f.readinto(bloom.data)
+        bloom.count = metadata["count"]
+        bloom.watermark = datetime.fromisoformat(metadata["watermark"])
+        return bloom
+
+
+def token_keys(documents: Iterable[dict]) -> List[str]:
+    """Get the pks and reverse index keys of token documents."""
+    keys = []
+    for data in documents:
+        keys += [data["pk"], reverse_key_of(data)]
+    return keys
+
+
+async def refresh(
+    bloom: BloomFilter,
+    store: TokenStore,
+    overlap: float = SNAPSHOT_REFRESH_OVERLAP_SECONDS,
+) -> int:
+    """Add the tokens created since the watermark of the filter.
+
+    Tokens are committed after their created_at, the read starts overlap seconds
+    before the watermark. Returns the number of tokens read.
+    """
+    count = 0
+    async for data in store.scan_since(bloom.watermark - timedelta(seconds=overlap)):
+        bloom.add_many(token_keys([data]))
+        bloom.watermark = max(bloom.watermark, utc(data["created_at"]))
+        count += 1
+    return count
+
+
+async def refresh_forever(
+    bloom: BloomFilter, store: TokenStore, interval: float = BLOOM_REFRESH_SECONDS
+) -> None:
+    """Refresh a filter every interval seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh(bloom, store)
+        except Exception:
+            logger.exception("Refreshing the Bloom filter of tokens failed")
+
+
+async def build(store: TokenStore, path: str, incremental: bool = False) -> BloomFilter:
+    """Build the filter of all tokens of the store and save it.
+
+    With incremental set and an existing filter only the tokens created since it are
+    read, otherwise a filter sized by BLOOM_CAPACITY is filled with all tokens.
+    """
+    if incremental and os.path.exists(path):
+        bloom = BloomFilter.load(path)
+    else:
+        bloom = BloomFilter.for_capacity()
+    await refresh(bloom, store)
+    if bloom.error_rate > BLOOM_ERROR_RATE:
+        logger.warning(
+            f"The Bloom filter has {bloom.count} keys, raise BLOOM_CAPACITY or"
+            " BLOOM_MAX_BYTES and rebuild it to keep its false positive rate"
+        )
+    bloom.save(path)
+    return bloom
+
+
+def main() -> None:
+    """Parse arguments and build the filter of the configured token store."""
+    from tokenvaultapi.stores import get_store
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--path", default=BLOOM_PATH or "tokens.bloom")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only add the tokens created since the existing filter",
+    )
+    args = parser.parse_args()
+    bloom = asyncio.run(build(get_store(), args.path, args.incremental))
+    logger.info(
+        f"Saved {bloom.count} keys to {args.path}, {len(bloom.data)} bytes with an"
+        f" estimated false positive rate of {bloom.error_rate:.4f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""Offline bulk tokenization of CSV and Parquet files.
+
+Run with, e.g.
+
+    python -m tokenvaultapi.bulk --input export.csv --output tokens.csv \\
+        --identifier CUSTOMER_ID --identity-column customer_id --columns email,phone
+
+Every row is a call per column of --columns, with the identifier, or the value of
+--identifier-column, and the value of --identity-column as identity, like the calls of
+remote function requests. The output has the rows of the input with the values of those
+columns replaced by their tokens, empty values stay empty. Parquet, read and written by
+the suffix .parquet, requires pyarrow; Parquet output is a directory of one file per
+chunk.
+
+The input is read in chunks of --chunk-size rows while the previous chunk is tokenized
+by TokenDAO, with --workers processes deriving keys and tokens, see
+tokenvaultapi.executor, and batched writes of the new tokens. After every chunk is
+written the rows done are recorded in a checkpoint file, next to the output, that a
+rerun resumes from. Tokens are deterministic, so the rows of a chunk that was
+interrupted get the same tokens again.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List
+
+from tokenvaultapi.config import BLOOM_PATH, CPU_OFFLOAD_WORKERS
+from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.executor import offloader
+from tokenvaultapi.logger import logger
+from tokenvaultapi.streaming import prefetch
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:  # pragma: no cover
+    pyarrow = parquet = None
+
+
+def is_parquet(path: str) -> bool:
+    """Whether a path is of Parquet data."""
+    if not path.endswith(".parquet"):
+        return False
+    if parquet is None:
+        raise RuntimeError("Reading and writing Parquet requires pyarrow.")
+    return True
+
+
+def read_rows(path: str, chunk_size: int, skip: int = 0) -> Iterator[List[dict]]:
+    """Read the rows of a CSV file with a header or of a Parquet file in chunks.
+
+    The first skip rows are left out.
+    """
+    if is_parquet(path):
+        batches = (
+            batch.to_pylist()
+            for batch in parquet.ParquetFile(path).iter_batches(chunk_size)
+        )
+    else:
+        batches = read_csv(path, chunk_size)
+    for rows in batches:
+        if skip >= len(rows):
+            skip -= len(rows)
+            continue
+        yield rows[skip:]
+        skip = 0
+
+
+def read_csv(path: str, chunk_size: int) -> Iterator[List[dict]]:
+    """Read the rows of a CSV file with a header in chunks."""
+    with open(path, newline="", encoding="UTF-8") as f:
+        rows = []
+        for row in csv.DictReader(f):
+            rows.append(row)
+            if len(rows) == chunk_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+
+class Checkpoint:
+    """Progress of a bulk run, written atomically after every chunk."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # rows and chunks written, and the size of the CSV output after them
+        self.rows = 0
+        self.chunks = 0
+        self.size = 0
+
+    def load(self) -> bool:
+        """Read the progress of an earlier run, returns whether there is one."""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            self.__dict__.update(json.load(f))
+        return True
+
+    def save(self) -> None:
+        """Write the progress, replacing the file atomically."""
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({"rows": self.rows, "chunks": self.chunks, "size": self.size}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+    def remove(self) -> None:
+        """Remove the checkpoint of a finished run."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class RowWriter:
+    """Writes chunks of rows to a CSV file, or to a directory of Parquet files."""
+
+    def __init__(self, path: str, checkpoint: Checkpoint) -> None:
+        self.path = path
+        self.checkpoint = checkpoint
+        self.parquet = is_parquet(path)
+        self._file = None
+        if self.parquet:
+            os.makedirs(path, exist_ok=True)
+        elif checkpoint.rows:
+            # drops the rows of a chunk written after the checkpoint
+            self._file = open(path, "r+", newline="", encoding="UTF-8")
+            self._file.truncate(checkpoint.size)
+            self._file.seek(checkpoint.size)
+        else:
+            self._file = open(path, "w", newline="", encoding="UTF-8")
+
+    def write(self, rows: List[dict]) -> None:
+        """Write a chunk of rows and record it in the checkpoint."""
+        if self.parquet:
+            name = f"part-{self.checkpoint.chunks:05}.parquet"
+            parquet.write_table(
+                pyarrow.Table.from_pylist(rows), os.path.join(self.path, name)
+            )
+        else:
+            writer = csv.DictWriter(self._file, fieldnames=list(rows[0]))
+            if not self.checkpoint.rows:
+                writer.writeheader()
+            writer.writerows(rows)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.checkpoint.size = self._file.tell()
+        self.checkpoint.rows += len(rows)
+        self.checkpoint.chunks += 1
+        self.checkpoint.save()
+
+    def close(self) -> None:
+        """Close the output file."""
+        if self._file is not None:
+            self._file.close()
+
+
+async def read_chunks(
+    path: str, chunk_size: int, skip: int = 0
+) -> AsyncIterator[List[dict]]:
+    """Read chunks of rows in a thread, so the event loop keeps tokenizing."""
+    chunks = read_rows(path, chunk_size, skip)
+    done = object()
+    while True:
+        rows = await asyncio.to_thread(next, chunks, done)
+        if rows is done:
+            return
+        yield rows
+
+
+async def tokenize_rows(
+    dao: TokenDAO,
+    rows: List[dict],
+    columns: List[str],
+    identity_column: str,
+    identifier: str = None,
+    identifier_column: str = None,
+    data_type: str = "STRING",
+    method: str = "FORMAT_PRESERVING",
+    fields: bool = False,
+    identities: Dict[str, Any] = None,
+) -> List[dict]:
+    """Replace the values of columns of rows by their tokens.
+
+    With fields set the column names are the fields of the tokens.
+    """
+    calls = []
+    cells = []
+    for index, row in enumerate(rows):
+        call = [row[identifier_column] if identifier_column else identifier]
+        call.append(row[identity_column])
+        for column in columns:
+            if row[column] is None or row[column] == "":
+                continue
+            calls.append([*call, row[column]] + ([column] if fields else []))
+            cells.append((index, column))
+    tokens = await dao.deidentify_calls(calls, data_type, method, identities)
+    rows = [dict(row) for row in rows]
+    for (index, column), token in zip(cells, tokens):
+        rows[index][column] = token
+    return rows
+
+
+async def run(
+    input_path: str,
+    output_path: str,
+    columns: List[str],
+    identity_column: str,
+    identifier: str = None,
+    identifier_column: str = None,
+    data_type: str = "STRING",
+    method: str = "FORMAT_PRESERVING",
+    fields: bool = False,
+    chunk_size: int = 10000,
+    checkpoint_path: str = None,
+    dao: TokenDAO = None,
+) -> int:
+    """Tokenize the columns of a file into an output file, see the module docstring.
+
+    Resumes from the checkpoint of an earlier run if there is one. Returns the number
+    of rows tokenized by this run.
+    """
+    if dao is None:
+        dao = TokenDAO()
+        await load_bloom(dao)
+    checkpoint = Checkpoint(checkpoint_path or f"{output_path.rstrip('/')}.checkpoint")
+    if checkpoint.load():
+        logger.info(f"Resuming after {checkpoint.rows} rows of {input_path}")
+    writer = RowWriter(output_path, checkpoint)
+    # identity tokens shared between chunks, about the last chunk's worth
+    identities = {}
+    start_rows = checkpoint.rows
+    started = time.monotonic()
+    try:
+        async for rows in prefetch(
+            read_chunks(input_path, chunk_size, checkpoint.rows), 2
+        ):
+            if len(identities) > chunk_size:
+                identities.clear()
+            writer.write(
+                await tokenize_rows(
+                    dao,
+                    rows,
+                    columns,
+                    identity_column,
+                    identifier,
+                    identifier_column,
+                    data_type,
+                    method,
+                    fields,
+                    identities,
+                )
+            )
+            count = checkpoint.rows - start_rows
+            logger.info(
+                f"Tokenized {checkpoint.rows} rows,"
+                f" {count / (time.monotonic() - started):.0f} rows/s"
+            )
+    finally:
+        writer.close()
+    checkpoint.remove()
+    return checkpoint.rows - start_rows
+
+
+async def load_bloom(dao: TokenDAO) -> None:
+    """Skip the reads of new tokens with the Bloom filter at BLOOM_PATH, if set."""
+    if not BLOOM_PATH:
+        return
+    from tokenvaultapi import bloom
+
+    dao.bloom = bloom.BloomFilter.load(BLOOM_PATH)
+    await bloom.refresh(dao.bloom, dao.store)
+
+
+def main() -> None:
+    """Parse arguments and tokenize the file."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--input", required=True, help="CSV or .parquet file")
+    parser.add_argument(
+        "--output", required=True, help="CSV file or .parquet directory"
+    )
+    parser.add_argument(
+        "--columns", required=True, help="comma separated columns to tokenize"
+    )
+    parser.add_argument("--identity-column", required=True)
+    identifier = parser.add_mutually_exclusive_group(required=True)
+    identifier.add_argument("--identifier", help="identifier of all rows")
+    identifier.add_argument("--identifier-column")
+    parser.add_argument("--type", default="STRING", help="token type of the columns")
+    parser.add_argument("--method", default="FORMAT_PRESERVING")
+    parser.add_argument(
+        "--fields", action="store_true", help="use the column names as token fields"
+    )
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=max(CPU_OFFLOAD_WORKERS, os.cpu_count() or 1),
+        help="processes deriving keys and tokens, 0 derives them in this process",
+    )
+    parser.add_argument("--checkpoint", help="default the output path + .checkpoint")
+    args = parser.parse_args()
+    # every chunk is large, its keys and tokens are derived in the process pool
+    offloader.workers = args.workers
+    offloader.threshold = 1
+    offloader.chunk_size = max(1, args.chunk_size // max(args.workers, 1))
+    started = time.monotonic()
+    try:
+        count = asyncio.run(
+            run(
+                args.input,
+                args.output,
+                [column.strip() for column in args.columns.split(",")],
+                args.identity_column,
+                args.identifier,
+                args.identifier_column,
+                args.type,
+                args.method,
+                args.fields,
+                args.chunk_size,
+                args.checkpoint,
+            )
+        )
+    finally:
+        offloader.shutdown()
+    seconds = time.monotonic() - started
+    logger.info(
+        f"Tokenized {count} rows of {args.input} into {args.output} in {seconds:.1f}s,"
+        f" {count / seconds:.0f} rows/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
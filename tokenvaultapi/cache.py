@@ -0,0 +1,311 @@
+"""Token caches.
+
+Tokens are immutable once created, so the cache only has to be invalidated when tokens
+are deleted. Entries also expire after a TTL, seconds by default, so deletes made by
+other workers are picked up soon.
+
+A cached None is a negative entry, recording that a key is known to be missing.
+
+Each worker has an in-process LRU cache. With CACHE_REDIS_URL set it is backed by a
+shared Redis tier, so workers on a node warm the same cache, and deletes are published
+to the other workers, which remove the keys from their in-process caches right away.
+"""
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, List
+
+from tokenvaultapi.config import (CACHE_MAX_SIZE, CACHE_REDIS_TTL_SECONDS,
+                                  CACHE_REDIS_URL, CACHE_TTL_SECONDS,
+                                  NEGATIVE_CACHE_TTL_SECONDS)
+from tokenvaultapi.logger import logger
+from tokenvaultapi.metrics import count_cache_tier
+from tokenvaultapi.schemas.token import Token
+
+
+class Cache:
+    """Interface of a cache, keyed by string."""
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Get the cached values of keys, missing keys are left out."""
+        raise NotImplementedError
+
+    async def set_many(self, items: Dict[str, Any], ttl: float = None) -> None:
+        """Cache values by key, expiring after ttl seconds or the cache default."""
+        raise NotImplementedError
+
+    async def delete_many(self, keys: Iterable[str]) -> None:
+        """Remove keys from the cache."""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        """Get cache statistics."""
+        raise NotImplementedError
+
+    async def listen(self) -> None:
+        """Apply the deletes of other workers until cancelled.
+
+        Returns right away for caches that other workers don't share.
+        """
+
+    async def get(self, key: str) -> Any:
+        """Get a cached value, or None."""
+        return (await self.get_many([key])).get(key)
+
+    async def set(self, key: str, value: Any, ttl: float = None) -> None:
+        """Cache a value."""
+        await self.set_many({key: value}, ttl)
+
+    async def delete(self, key: str) -> None:
+        """Remove a key from the cache."""
+        await self.delete_many([key])
+
+
+class NullCache(Cache):
+    """Cache that never holds anything, used when caching is disabled."""
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        return {}
+
+    async def set_many(self, items: Dict[str, Any], ttl: float = None) -> None:
+        pass
+
+    async def delete_many(self, keys: Iterable[str]) -> None:
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class LRUCache(Cache):
+    """In-process cache bounded by size, evicting the least recently used entries."""
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        now = time.monotonic()
+        found = {}
+        misses = 0
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None:
+                misses += 1
+            elif entry[0] < now:
+                del self._entries[key]
+                self.expirations += 1
+                misses += 1
+            else:
+                self._entries.move_to_end(key)
+                found[key] = entry[1]
+        self.hits += len(found)
+        self.misses += misses
+        count_cache_tier("memory", len(found), misses)
+        return found
+
+    async def set_many(self, items: Dict[str, Any], ttl: float = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        for key, value in items.items():
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete_many(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class RedisCache(Cache):
+    """Cache shared between workers, stored in Redis or a Redis-compatible server.
+
+    Tokens are stored as JSON. Redis errors are logged and treated as misses, so an
+    unavailable cache only costs performance.
+    """
+
+    key_prefix = "tokenvault:"
+    # channel the keys of deletes are published on, as a JSON array
+    deletes_channel = "tokenvault:deletes"
+    # seconds to wait before subscribing again after an error
+    resubscribe_seconds = 1
+
+    def __init__(self, url: str, ttl: float, client: Any = None) -> None:
+        if client is None:
+            from redis.asyncio import Redis
+
+            client = Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            values = await self.client.mget([self.key_prefix + key for key in keys])
+        except Exception as e:
+            self._error(e)
+            return {}
+        found = {
+            key: decode_value(value) for key, value in zip(keys, values) if value
+        }
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        count_cache_tier("redis", len(found), len(keys) - len(found))
+        return found
+
+    async def set_many(self, items: Dict[str, Any], ttl: float = None) -> None:
+        if not items:
+            return
+        ttl_ms = int((self.ttl if ttl is None else ttl) * 1000)
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for key, value in items.items():
+                    pipe.set(self.key_prefix + key, encode_value(value), px=ttl_ms)
+                await pipe.execute()
+        except Exception as e:
+            self._error(e)
+
+    async def delete_many(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        if not keys:
+            return
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.delete(*[self.key_prefix + key for key in keys])
+                pipe.publish(self.deletes_channel, json.dumps(keys))
+                await pipe.execute()
+        except Exception as e:
+            self._error(e)
+
+    async def listen_deletes(
+        self, on_delete: Callable[[List[str]], Awaitable[None]]
+    ) -> None:
+        """Call on_delete with the keys of every delete published, until cancelled.
+
+        Subscribes again after errors, deletes published in the meantime are missed
+        and only expire.
+        """
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                await pubsub.subscribe(self.deletes_channel)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        await on_delete(json.loads(message["data"]))
+            except Exception as e:
+                self._error(e)
+            finally:
+                await pubsub.aclose()
+            await asyncio.sleep(self.resubscribe_seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "errors": self.errors}
+
+    def _error(self, e: Exception) -> None:
+        """Log a Redis error."""
+        self.errors += 1
+        logger.warning(f"Redis cache error: {e}")
+
+
+class TieredCache(Cache):
+    """Two level cache, an in-process l1 cache in front of a shared l2 cache.
+
+    Values found in l2 are copied to l1, negative entries only for negative_ttl
+    seconds since their remaining time to live in l2 is unknown. Deletes are removed
+    from the l1 cache of every worker that listens, see listen.
+    """
+
+    def __init__(self, l1: Cache, l2: Cache, negative_ttl: float) -> None:
+        self.l1 = l1
+        self.l2 = l2
+        self.negative_ttl = negative_ttl
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        found = await self.l1.get_many(keys)
+        misses = [key for key in keys if key not in found]
+        if misses:
+            shared = await self.l2.get_many(misses)
+            negative = {key: None for key, value in shared.items() if value is None}
+            await self.l1.set_many(
+                {key: value for key, value in shared.items() if value is not None}
+            )
+            await self.l1.set_many(negative, self.negative_ttl)
+            found.update(shared)
+        return found
+
+    async def set_many(self, items: Dict[str, Any], ttl: float = None) -> None:
+        await self.l1.set_many(items, ttl)
+        await self.l2.set_many(items, ttl)
+
+    async def delete_many(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        await self.l1.delete_many(keys)
+        await self.l2.delete_many(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"l1": self.l1.stats(), "l2": self.l2.stats()}
+
+    async def listen(self) -> None:
+        """Remove the keys that other workers delete from l1, see listen_deletes."""
+        await self.l2.listen_deletes(self.l1.delete_many)
+
+
+def encode_value(value: Any) -> str:
+    """Encode a cached token, string or None as JSON."""
+    if isinstance(value, Token):
+        return json.dumps({"token": json.loads(value.json())})
+    return json.dumps(value)
+
+
+def decode_value(raw: bytes) -> Any:
+    """Decode a cached token, string or None from JSON."""
+    value = json.loads(raw)
+    if isinstance(value, dict):
+        token = Token(**value["token"])
+        if token.type == "INT":
+            token.value = int(token.value)
+        elif token.type == "FLOAT":
+            token.value = float(token.value)
+        return token
+    return value
+
+
+def create_cache() -> Cache:
+    """Create the token cache from configuration.
+
+    The in-process cache is disabled if CACHE_MAX_SIZE is 0, and backed by a shared
+    Redis cache if CACHE_REDIS_URL is set.
+    """
+    cache = NullCache()
+    if CACHE_MAX_SIZE > 0:
+        cache = LRUCache(CACHE_MAX_SIZE, CACHE_TTL_SECONDS)
+    if CACHE_REDIS_URL:
+        return TieredCache(
+            cache,
+            RedisCache(CACHE_REDIS_URL, CACHE_REDIS_TTL_SECONDS),
+            NEGATIVE_CACHE_TTL_SECONDS,
+        )
+    return cache
@@ -0,0 +1,99 @@
+"""Runtime configuration read from environment variables."""
+import os
+
+# Keys per batched Firestore read in deidentify and reidentify.
+DEIDENTIFY_CHUNK_SIZE = int(os.getenv("DEIDENTIFY_CHUNK_SIZE", "250"))
+# Maximum number of chunks in flight against Firestore per request.
+DEIDENTIFY_MAX_CONCURRENCY = int(os.getenv("DEIDENTIFY_MAX_CONCURRENCY", "8"))
+# Seconds that point reads of concurrent requests are collected for before they are
+# read in one batch, the maximum keys per batch and batches read at a time per worker.
+READ_BATCH_WINDOW_SECONDS = float(os.getenv("READ_BATCH_WINDOW_SECONDS", "0.002"))
+READ_BATCH_MAX_KEYS = int(os.getenv("READ_BATCH_MAX_KEYS", "250"))
+READ_BATCH_MAX_CONCURRENCY = int(os.getenv("READ_BATCH_MAX_CONCURRENCY", "32"))
+# Store calls in flight per worker, calls waiting for one of them and seconds they may
+# wait before the request is answered with a 503 and Retry-After.
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "64"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "1000"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(
+    os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "5")
+)
+# Attempts of store calls failing with retryable errors, and the base and maximum
+# seconds of their jittered exponential backoff, before a 429 and Retry-After.
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "5"))
+RETRY_BASE_SECONDS = float(os.getenv("RETRY_BASE_SECONDS", "0.05"))
+RETRY_MAX_SECONDS = float(os.getenv("RETRY_MAX_SECONDS", "2"))
+# Fall back to a query when a token is missing from the reverse index. Disable once the
+# index has been backfilled with `python -m tokenvaultapi.migrations.reverse_index`.
+REVERSE_INDEX_FALLBACK = os.getenv("REVERSE_INDEX_FALLBACK", "true").lower() == "true"
+# Maximum number of entries in the per-worker token cache, 0 disables the cache.
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "100000"))
+# Seconds before an entry of the per-worker cache expires. Without CACHE_REDIS_URL this
+# is how long other workers may still serve a deleted token, keep it short.
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "10"))
+# Redis URL of a cache shared by the workers, e.g. redis://localhost:6379/0. Unset
+# disables the shared cache.
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "")
+# Seconds before an entry in the shared cache expires.
+CACHE_REDIS_TTL_SECONDS = float(os.getenv("CACHE_REDIS_TTL_SECONDS", "86400"))
+# Seconds to remember that a token was not found in reidentify.
+NEGATIVE_CACHE_TTL_SECONDS = float(os.getenv("NEGATIVE_CACHE_TTL_SECONDS", "60"))
+# Hex encoded key of the FORMAT_PRESERVING_ENCRYPTION method, or a file containing it.
+FPE_KEY = os.getenv("FPE_KEY", "")
+FPE_KEY_FILE = os.getenv("FPE_KEY_FILE", "")
+# Key scheme of new documents, v2 or the legacy v1, see tokenvaultapi.keys.
+KEY_SCHEME = os.getenv("KEY_SCHEME", "v2")
+# Also look up tokens by their legacy v1 key when they are not found by their key.
+LEGACY_KEY_FALLBACK = os.getenv("LEGACY_KEY_FALLBACK", "true").lower() == "true"
+# Schema version of new token documents, 2 or the legacy 1, see
+# tokenvaultapi.stores.codec. Documents of either version are read.
+TOKEN_SCHEMA_VERSION = int(os.getenv("TOKEN_SCHEMA_VERSION", "2"))
+# Also query documents of the other schema version. Disable once the documents have been
+# migrated with `python -m tokenvaultapi.migrations.token_schema`.
+LEGACY_SCHEMA_FALLBACK = os.getenv("LEGACY_SCHEMA_FALLBACK", "true").lower() == "true"
+# Batches of at least this many rows derive keys and tokenize in a pool of worker
+# processes, in chunks, instead of on the event loop. 0 workers disables the pool.
+CPU_OFFLOAD_THRESHOLD = int(os.getenv("CPU_OFFLOAD_THRESHOLD", "5000"))
+CPU_OFFLOAD_WORKERS = int(os.getenv("CPU_OFFLOAD_WORKERS", "1"))
+CPU_OFFLOAD_CHUNK_SIZE = int(os.getenv("CPU_OFFLOAD_CHUNK_SIZE", "2000"))
+# Rows per chunk of the streaming endpoint, and chunks read ahead of the one tokenized.
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "1000"))
+STREAM_PREFETCH_CHUNKS = int(os.getenv("STREAM_PREFETCH_CHUNKS", "2"))
+# Default and maximum number of tokens per page when listing the tokens of an identity.
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "1000"))
+LIST_MAX_PAGE_SIZE = int(os.getenv("LIST_MAX_PAGE_SIZE", "10000"))
+# Snapshot file of token documents that workers read tokens from before the store, see
+# tokenvaultapi.snapshot. Unset disables the snapshot.
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "")
+# Seconds between reads of the documents created and deleted since the snapshot, and
+# seconds before the last read document that a read starts at.
+SNAPSHOT_REFRESH_SECONDS = float(os.getenv("SNAPSHOT_REFRESH_SECONDS", "30"))
+SNAPSHOT_REFRESH_OVERLAP_SECONDS = float(
+    os.getenv("SNAPSHOT_REFRESH_OVERLAP_SECONDS", "300")
+)
+# Record tombstones of deleted tokens for the snapshots, by default when they are used.
+SNAPSHOT_TOMBSTONES = (
+    os.getenv("SNAPSHOT_TOMBSTONES", str(bool(SNAPSHOT_PATH))).lower() == "true"
+)
+# Bloom filter file of the keys of all tokens, that reads of tokens that don't exist are
+# skipped with, see tokenvaultapi.bloom. Unset disables the filter.
+BLOOM_PATH = os.getenv("BLOOM_PATH", "")
+# Tokens the filter is sized for, its false positive rate at that size and the most
+# memory it may take, which raises the rate of a filter that doesn't fit.
+BLOOM_CAPACITY = int(os.getenv("BLOOM_CAPACITY", "10000000"))
+BLOOM_ERROR_RATE = float(os.getenv("BLOOM_ERROR_RATE", "0.01"))
+BLOOM_MAX_BYTES = int(os.getenv("BLOOM_MAX_BYTES", str(64 * 1024 * 1024)))
+# Seconds between reads of the tokens created since the filter was built.
+BLOOM_REFRESH_SECONDS = float(os.getenv("BLOOM_REFRESH_SECONDS", "30"))
+# Reply None in reidentify for tokens the filter doesn't have, without reading them.
+BLOOM_TRUST_NEGATIVES = os.getenv("BLOOM_TRUST_NEGATIVES", "false").lower() == "true"
+# Token storage backend, firestore, sqlite for single node deployments and tests, or
+# memory for benchmarks.
+TOKEN_STORE = os.getenv("TOKEN_STORE", "firestore")
+# Database file of the sqlite token store.
+SQLITE_PATH = os.getenv("SQLITE_PATH", "tokenvault.db")
+# Seconds of simulated latency per round trip of the memory store, for benchmarks.
+MEMORY_STORE_LATENCY_SECONDS = float(os.getenv("MEMORY_STORE_LATENCY_SECONDS", "0"))
+# Time the stages of requests and export them at /metrics.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Also trace the timed stages as OpenTelemetry spans, requires opentelemetry-api.
+OTEL_ENABLED = os.getenv("OTEL_ENABLED", "false").lower() == "true"
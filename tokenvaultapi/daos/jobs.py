@@ -0,0 +1,34 @@
+from datetime import datetime
+from uuid import uuid4
+
+from tokenvaultapi.schemas.job import Job
+from tokenvaultapi.stores import TokenStore, get_store
+
+
+class JobDAO:
+    """Data access object for background jobs.
+
+    Jobs are kept in the token store so their status can be read from any worker.
+    """
+
+    def __init__(self, store: TokenStore = None) -> None:
+        self.store = store if store is not None else get_store()
+
+    async def create(self, kind: str) -> Job:
+        """Create a pending job."""
+        now = datetime.utcnow()
+        job = Job(id=uuid4().hex, kind=kind, created_at=now, updated_at=now)
+        await self.store.set_job(job.id, job.dict())
+        return job
+
+    async def get(self, job_id: str) -> Job:
+        """Get a job."""
+        data = await self.store.get_job(job_id)
+        if data:
+            return Job(**data)
+        return
+
+    async def update(self, job_id: str, **fields) -> None:
+        """Update fields of a job."""
+        fields["updated_at"] = datetime.utcnow()
+        await self.store.update_job(job_id, fields)
@@ -1,111 +1,402 @@
-import hashlib
-import string
-from random import choice, randint, random
-from typing import Any, List
-from uuid import UUID
+import asyncio
+from collections import defaultdict
+from typing import (Any, AsyncIterator, Awaitable, Callable, Dict, Iterable,
+                    Iterator, List, Sequence)
 
-from google.cloud.firestore_v1.base_query import (BaseCompositeFilter,
-                                                  FieldFilter)
-from google.cloud.firestore_v1.types import StructuredQuery
-
-from tokenvaultapi.database import db
+from tokenvaultapi.admission import Admission
+from tokenvaultapi.bloom import BloomFilter, token_keys
+from tokenvaultapi.cache import Cache, create_cache
+from tokenvaultapi.config import (BLOOM_TRUST_NEGATIVES, DEIDENTIFY_CHUNK_SIZE,
+                                  DEIDENTIFY_MAX_CONCURRENCY, KEY_SCHEME,
+                                  LEGACY_KEY_FALLBACK,
+                                  NEGATIVE_CACHE_TTL_SECONDS,
+                                  READ_BATCH_MAX_CONCURRENCY,
+                                  READ_BATCH_MAX_KEYS,
+                                  READ_BATCH_WINDOW_SECONDS)
+from tokenvaultapi.dataloader import DataLoader
+from tokenvaultapi.executor import offloader, tokenize_pairs
+from tokenvaultapi.fpe import encryption_tweak, get_cipher
+from tokenvaultapi.keys import (V1, derive_key, derive_keys, reverse_key,
+                                reverse_key_of)
+from tokenvaultapi.metrics import (count_bloom, count_cache, count_snapshot,
+                                   timer)
 from tokenvaultapi.schemas.token import (RemoteFunctionTokenRequest,
                                          RemoteFunctionTokenResponse, Token,
                                          TokenCreate, TokenFind)
+from tokenvaultapi.singleflight import SingleFlight
+from tokenvaultapi.snapshot import SnapshotReplica
+from tokenvaultapi.stores import (TokenCollision, TokenExists, TokenStore,
+                                  get_store)
+from tokenvaultapi.stores.base import token_from_dict, typed_value
+from tokenvaultapi.tokenizers import tokenize_value
+
+
+def encrypt_calls(calls: List[list], data_type: str) -> List[Any]:
+    """Deidentify remote function calls with format preserving encryption."""
+    cipher = get_cipher()
+    replies = []
+    for call in calls:
+        if call[2] is None:
+            replies.append(None)
+            continue
+        field = dict(enumerate(call)).get(3, "")
+        identity_token = tokenize_value("RANDOM", "STRING", call[1])
+        tweak = encryption_tweak(call[0], identity_token, field)
+        replies.append(
+            typed_value(data_type, cipher.encrypt(str(call[2]), data_type, tweak))
+        )
+    return replies
+
 
+def decrypt_calls(calls: List[list], data_type: str) -> List[Any]:
+    """Reidentify remote function calls with format preserving encryption.
+
+    Tokens that can't be decrypted to a value of the type are replied with None.
+    """
+    cipher = get_cipher()
+    replies = []
+    for call in calls:
+        tweak = encryption_tweak(call[0], call[1], dict(enumerate(call)).get(3, ""))
+        try:
+            value = cipher.decrypt(str(call[2]), data_type, tweak)
+        except ValueError:
+            value = None
+        if call[2] is None:
+            value = None
+        replies.append(None if value is None else typed_value(data_type, value))
+    return replies
+
+
+def chunked(items: list, size: int) -> Iterator[list]:
+    """Split a list into consecutive chunks of at most size items."""
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
 
-def format_preserving_token(input_string) -> str:
-    """Create a token that preserves the format of the input string."""
-    token = ""
-    last_index = len(input_string) - 1
-    for index, char in enumerate(input_string):
-        if char.islower() and char.isalpha():
-            token += choice(string.ascii_lowercase)
-        elif char.isupper() and char.isalpha():
-            token += choice(string.ascii_uppercase)
-        elif char.isdigit() and index in (0, last_index):
-            token += choice("123456789")
-        elif char.isdigit():
-            token += choice(string.digits)
-        else:
-            token += char
-    return token
-
-
-def tokenize_value(method: str, data_type: str, val: Any) -> str:
-    """Tokenize a value."""
-    if method == "FORMAT_PRESERVING" and data_type in ["STRING", "INT", "FLOAT"]:
-        return format_preserving_token(val)
-    if method == "RANDOM":
-        if data_type == "INT":
-            return str(randint(0, 1000000))
-        if data_type == "FLOAT":
-            return str(random())
-        if data_type == "STRING":
-            hex_string = hashlib.md5(str(val).encode("UTF-8")).hexdigest()
-            return str(UUID(hex=hex_string))
-        else:
-            hex_string = hashlib.md5(str(val).encode("UTF-8")).hexdigest()
-            return str(UUID(hex=hex_string))
-
-
-def create_uuid_from_list(li: list) -> str:
-    """Create a UUID from a list of values."""
-    val = " ".join(map(str, li))
-    hex_string = hashlib.md5(val.encode("UTF-8")).hexdigest()
-    return str(UUID(hex=hex_string))
-
-
-def typed_token(token: Token) -> Token:
-    """Convert token to correct type."""
-    if token.type == "INT":
-        token.token = int(token.token)
-        token.value = int(token.value)
-    elif token.type == "FLOAT":
-        token.token = float(token.token)
-        token.value = float(token.value)
-    return token
-    
 
 class TokenDAO:
-    """Data access object for tokens."""
+    """Data access object for tokens, on top of a token store."""
 
-    collection_name = "tokens"
+    # cache keys of reverse index entries, tokens are cached by pk
+    index_cache_prefix = "index:"
+    # rounds of tokenizing again the tokens that another token of their identity and
+    # field has, before giving up, e.g. on a one digit INT which has 9 tokens
+    max_tokenize_attempts = 100
+
+    def __init__(
+        self,
+        chunk_size: int = DEIDENTIFY_CHUNK_SIZE,
+        max_concurrency: int = DEIDENTIFY_MAX_CONCURRENCY,
+        cache: Cache = None,
+        negative_cache_ttl: float = NEGATIVE_CACHE_TTL_SECONDS,
+        key_scheme: str = KEY_SCHEME,
+        legacy_key_fallback: bool = LEGACY_KEY_FALLBACK,
+        store: TokenStore = None,
+        read_batch_window: float = READ_BATCH_WINDOW_SECONDS,
+        read_batch_max_keys: int = READ_BATCH_MAX_KEYS,
+        admission: Admission = None,
+        snapshot: SnapshotReplica = None,
+        bloom: BloomFilter = None,
+        bloom_trust_negatives: bool = BLOOM_TRUST_NEGATIVES,
+    ) -> None:
+        self.store = store if store is not None else get_store()
+        self.chunk_size = chunk_size
+        self.max_concurrency = max_concurrency
+        self.cache = cache if cache is not None else create_cache()
+        self.negative_cache_ttl = negative_cache_ttl
+        self.key_scheme = key_scheme
+        # legacy keys only differ from the keys of other schemes
+        self.legacy_key_fallback = legacy_key_fallback and key_scheme != V1
+        # lookups and creations in flight, of tokens and of identity tokens by pk
+        self.flight = SingleFlight()
+        self.identity_flight = SingleFlight()
+        # store calls of the worker are bounded and retried, and their batches shrink
+        # while the store is contended, see tokenvaultapi.admission
+        if admission is None:
+            admission = Admission(
+                retryable=self.store.retryable_errors,
+                read=chunk_size,
+                write=self.store.max_write_batch,
+            )
+        self.admission = admission
+        # local replica that tokens are read from before the store, see
+        # tokenvaultapi.snapshot
+        self.snapshot = snapshot
+        # filter of the keys of existing tokens, reads of keys it doesn't have are
+        # skipped before creating tokens, and in reidentify if negatives are trusted
+        self.bloom = bloom
+        self.bloom_trust_negatives = bloom_trust_negatives
+        # point reads by pk, batched across concurrent requests
+        self.loader = DataLoader(
+            self._load,
+            read_batch_window,
+            read_batch_max_keys,
+            READ_BATCH_MAX_CONCURRENCY,
+            name="tokens",
+        )
 
     async def find(self, token_find: TokenFind) -> Token:
-        identities_ref = db.collection(self.collection_name)
-        composite_filter = BaseCompositeFilter(
-            operator=StructuredQuery.CompositeFilter.Operator.AND,
-            filters=[
-                FieldFilter("identifier", "==", token_find.identifier),
-                FieldFilter("identity_token", "==", token_find.identity_token),
-                FieldFilter("token", "==", token_find.token),
-                FieldFilter("field", "==", token_find.field),
-            ],
+        """Find a token by identifier, identity token, token and field."""
+        key = reverse_key(
+            token_find.identifier,
+            token_find.identity_token,
+            token_find.token,
+            token_find.field,
         )
-        composite_query = identities_ref.where(filter=composite_filter)
-        tokens = [
-            typed_token(Token(**doc.to_dict()))
-            async for doc in composite_query.stream()
-            if doc.to_dict()
-        ]
-        if len(tokens) > 1:
-            raise Exception("More than one token found.")
-        if len(tokens) == 0:
-            return
-        else:
-            return tokens[0]
-
-    async def create(self, token_create: TokenCreate) -> Token:
-        """Create a token."""
-        identity_pk = create_uuid_from_list(
+        tokens = await self.find_many({key: token_find})
+        return tokens.get(key)
+
+    async def find_many(self, token_finds: Dict[str, TokenFind]) -> Dict[str, Token]:
+        """Find tokens by reverse index key with batched reads.
+
+        Cache misses are looked up in the snapshot first, if there is one. Tokens that
+        are not found are negatively cached for a short while. With bloom_trust_negatives
+        set, tokens that aren't in the Bloom filter are not looked up at all.
+        """
+        if self.bloom_trust_negatives:
+            token_finds = {
+                key: token_finds[key] for key in self._might_exist(token_finds)
+            }
+        prefix = self.index_cache_prefix
+        cached = await self.cache.get_many(prefix + key for key in token_finds)
+        count_cache(len(cached), len(token_finds) - len(cached))
+        pks = {key[len(prefix) :]: pk for key, pk in cached.items() if pk}
+        found = await self.get_many(list(set(pks.values())))
+        tokens = {key: found[pk] for key, pk in pks.items() if pk in found}
+        misses = [key for key in token_finds if key not in cached]
+        if self.snapshot is not None and misses:
+            found = self.snapshot.find_many(misses)
+            count_snapshot(len(found), len(misses) - len(found))
+            tokens.update(found)
+            misses = [key for key in misses if key not in found]
+        for chunk in await self._gather_chunks(
+            self._find_chunk,
+            [(key, token_finds[key]) for key in misses],
+            self.admission.batch_size("read"),
+        ):
+            tokens.update(chunk)
+            await self.cache.set_many(
+                {
+                    **{token.pk: token for token in chunk.values()},
+                    **{prefix + key: token.pk for key, token in chunk.items()},
+                }
+            )
+        await self.cache.set_many(
+            {prefix + key: None for key in misses if key not in tokens},
+            self.negative_cache_ttl,
+        )
+        return tokens
+
+    async def _find_chunk(self, items: List[tuple]) -> Dict[str, Token]:
+        """Find a chunk of (reverse index key, token find) in the store."""
+        with timer("store_find", len(items)):
+            return await self.admission.call("read", self.store.find_many, dict(items))
+
+    async def _load(self, pks: List[str]) -> Dict[str, Token]:
+        """Read a batch of the data loader, in chunks while the store is contended."""
+        tokens = {}
+        for chunk in await asyncio.gather(
+            *(
+                self.admission.call("read", self.store.get_many, chunk)
+                for chunk in chunked(pks, self.admission.batch_size("read"))
+            )
+        ):
+            tokens.update(chunk)
+        return tokens
+
+    async def create(
+        self, token_create: TokenCreate, identities: Dict[str, Token] = None
+    ) -> Token:
+        """Create a token, see create_many."""
+        tokens = await self.create_many([token_create], identities)
+        return tokens[token_create.pk]
+
+    async def get(self, pk: str) -> Token:
+        """Get a token."""
+        tokens = await self.get_many([pk])
+        return tokens.get(pk)
+
+    async def get_or_create(
+        self, token_create: TokenCreate, identities: Dict[str, Token] = None
+    ) -> Token:
+        """Get or create a token if doesn't exists.
+
+        Concurrent calls for the same pk share one lookup and creation. Tokens that
+        aren't in the Bloom filter are created without a lookup.
+        """
+
+        async def get_or_create() -> Token:
+            token = None
+            if self._might_exist([token_create.pk]):
+                token = await self.get(token_create.pk)
+            if not token:
+                tokens = await self._create_many([token_create], identities)
+                token = tokens[token_create.pk]
+            return token
+
+        return await self.flight.do(token_create.pk, get_or_create)
+
+    async def get_many(self, pks: List[str]) -> Dict[str, Token]:
+        """Get tokens by primary key.
+
+        Cache misses are read from the snapshot if there is one, and otherwise in
+        batches shared with the reads of concurrent requests, see
+        tokenvaultapi.dataloader.
+        """
+        tokens = await self.cache.get_many(pks)
+        misses = [pk for pk in pks if pk not in tokens]
+        count_cache(len(tokens), len(misses))
+        if self.snapshot is not None and misses:
+            found = self.snapshot.get_many(misses)
+            count_snapshot(len(found), len(misses) - len(found))
+            tokens.update(found)
+            misses = [pk for pk in misses if pk not in found]
+        if misses:
+            found = await self.loader.load_many(misses)
+            tokens.update(found)
+            await self.cache.set_many(found)
+        return tokens
+
+    async def get_by_values(self, values: Sequence) -> Token:
+        """Get a token by the values its primary key is derived from."""
+        pk = derive_key(values, self.key_scheme)
+        tokens = await self.get_many_by_values({pk: values})
+        return tokens.get(pk)
+
+    async def get_many_by_values(
+        self, rows: Dict[str, Sequence], skip_absent: bool = False
+    ) -> Dict[str, Token]:
+        """Get tokens by primary key, given the values each key is derived from.
+
+        With legacy_key_fallback set, tokens that are not found are looked up by their
+        legacy key. Returns the tokens by the given primary key, the pk of tokens found
+        by legacy key is the legacy key. With skip_absent set keys that aren't in the
+        Bloom filter are not read, for callers that create the missing tokens with
+        writes that fail if they exist.
+        """
+        pks = self._might_exist(rows) if skip_absent else list(rows)
+        tokens = await self.get_many(pks)
+        if self.legacy_key_fallback:
+            missing = [pk for pk in rows if pk not in tokens]
+            keys = await offloader.map(derive_keys, [rows[pk] for pk in missing], V1)
+            legacy_pks = dict(zip(keys, missing))
+            if skip_absent:
+                legacy_pks = {pk: legacy_pks[pk] for pk in self._might_exist(legacy_pks)}
+            if legacy_pks:
+                found = await self.get_many(list(legacy_pks))
+                tokens.update({legacy_pks[pk]: token for pk, token in found.items()})
+        return tokens
+
+    async def create_many(
+        self, token_creates: List[TokenCreate], identities: Dict[str, Token] = None
+    ) -> Dict[str, Token]:
+        """Create tokens, and any missing identity tokens, with batched writes.
+
+        Concurrent calls for the same tokens are coalesced, tokens that are being
+        created by another call are waited for instead. Tokens that exist already, also
+        those created by other workers, are read back instead of failing the batch.
+        Returns the tokens by primary key, built from the written data instead of read
+        back. identities is an optional memo of identity tokens by identity pk that
+        callers can share between calls for the same batch.
+        """
+        by_pk = {token_create.pk: token_create for token_create in token_creates}
+
+        async def create(pks: List[str]) -> Dict[str, Token]:
+            return await self._create_many([by_pk[pk] for pk in pks], identities)
+
+        return await self.flight.do_many(by_pk, create)
+
+    async def _create_many(
+        self, token_creates: List[TokenCreate], identities: Dict[str, Token] = None
+    ) -> Dict[str, Token]:
+        """Create tokens, see create_many, without coalescing."""
+        memo = identities if identities is not None else {}
+        identity_rows = [
             [token_create.identifier, token_create.identity, token_create.identity]
+            for token_create in token_creates
+        ]
+        with timer("derive_keys", len(identity_rows)):
+            keys = await offloader.map(derive_keys, identity_rows, self.key_scheme)
+        identity_pks = {
+            token_create.pk: pk for token_create, pk in zip(token_creates, keys)
+        }
+        identities = {pk: memo[pk] for pk in identity_pks.values() if pk in memo}
+        identity_creates = {}
+        for token_create in token_creates:
+            identity_pk = identity_pks[token_create.pk]
+            if identity_pk not in identities:
+                identity_creates.setdefault(identity_pk, token_create)
+        if identity_creates:
+
+            async def get_or_create_identities(pks: List[str]) -> Dict[str, Token]:
+                return await self._get_or_create_identities(
+                    {pk: identity_creates[pk] for pk in pks}
+                )
+
+            identities.update(
+                await self.identity_flight.do_many(
+                    identity_creates, get_or_create_identities
+                )
+            )
+        memo.update(identities)
+        tokens = {}
+        # tokenize in one batch per method and type
+        batches = defaultdict(list)
+        for token_create in token_creates:
+            if identity_pks[token_create.pk] == token_create.pk:
+                tokens[token_create.pk] = identities[token_create.pk]
+            else:
+                batches[token_create.method, token_create.type].append(token_create)
+        for (method, data_type), batch in batches.items():
+            tweaks = [b""] * len(batch)
+            if method == "FORMAT_PRESERVING_ENCRYPTION":
+                tweaks = [
+                    encryption_tweak(
+                        tc.identifier,
+                        identities[identity_pks[tc.pk]].identity_token,
+                        tc.field,
+                    )
+                    for tc in batch
+                ]
+            pairs = list(zip([tc.value for tc in batch], tweaks))
+            with timer("tokenize", len(batch)):
+                values = await offloader.map(tokenize_pairs, pairs, method, data_type)
+            for token_create, value in zip(batch, values):
+                token_create.token = value
+        documents = []
+        async for chunk in offloader.chunks(
+            [tc for tc in token_creates if tc.pk not in tokens]
+        ):
+            for token_create in chunk:
+                identity = identities[identity_pks[token_create.pk]]
+                data = token_create.dict()
+                data["identity_token"] = identity.identity_token
+                documents.append(data)
+                tokens[token_create.pk] = token_from_dict(data)
+        for existing in await self._gather_chunks(
+            self._create_chunk, documents, self.admission.batch_size("write")
+        ):
+            tokens.update(existing)
+        await self.cache.set_many(tokens)
+        return tokens
+
+    async def _get_or_create_identities(
+        self, token_creates: Dict[str, TokenCreate]
+    ) -> Dict[str, Token]:
+        """Get or create the identity tokens of tokens by identity pk."""
+        identities = await self.get_many_by_values(
+            {
+                pk: [tc.identifier, tc.identity, tc.identity]
+                for pk, tc in token_creates.items()
+            },
+            skip_absent=True,
         )
-        identity = await self.get(identity_pk)
-        if not identity:
+        created = {}
+        for pk, token_create in token_creates.items():
+            if pk in identities:
+                continue
             identity_token = tokenize_value("RANDOM", "STRING", token_create.identity)
-            identity_data = Token(
-                pk=identity_pk,
+            created[pk] = Token(
+                pk=pk,
                 identifier=token_create.identifier,
                 identity=token_create.identity,
                 identity_token=identity_token,
@@ -113,93 +404,327 @@ class TokenDAO:
                 created_at=token_create.created_at,
                 token=identity_token,
                 value=token_create.identity,
-            ).dict()
-            await db.collection(self.collection_name).document(identity_pk).create(
-                identity_data
             )
-            identity = await self.get(identity_pk)
-        if identity.pk == token_create.pk:
-            return identity
-        token_create.token = tokenize_value(
-            token_create.method, token_create.type, token_create.value
+        for existing in await self._gather_chunks(
+            self._create_chunk,
+            [token.dict() for token in created.values()],
+            self.admission.batch_size("write"),
+        ):
+            created.update(existing)
+        await self.cache.set_many(created)
+        identities.update(created)
+        return identities
+
+    async def _create_chunk(self, documents: List[dict]) -> Dict[str, Token]:
+        """Create documents in one batched write.
+
+        Batched writes fail if any of their documents, or their reverse index entries,
+        exists. Documents that were created in the meantime are read back, documents
+        whose token another token of their identity and field has are tokenized again,
+        and the others written again. Returns the tokens that existed and the tokens
+        that were tokenized again by pk.
+        """
+        existing = {}
+        # documents with the reverse key of an earlier document of the batch
+        keys = set()
+        taken = []
+        for data in documents:
+            key = reverse_key_of(data)
+            if key in keys:
+                taken.append(data)
+            keys.add(key)
+        for attempt in range(self.max_tokenize_attempts + 1):
+            if taken:
+                if attempt == self.max_tokenize_attempts:
+                    raise TokenCollision(
+                        f"No unique token found for {len(taken)} tokens."
+                    )
+                existing.update(self._tokenize_again(taken, documents))
+                taken = []
+                continue
+            try:
+                with timer("store_create", len(documents)):
+                    await self.admission.call(
+                        "write", self.store.create_many, documents
+                    )
+                break
+            except TokenExists:
+                found = await self.admission.call(
+                    "read", self.store.get_many, [data["pk"] for data in documents]
+                )
+                existing.update(found)
+                documents = [data for data in documents if data["pk"] not in found]
+                if not documents:
+                    break
+                taken = await self._taken(documents)
+                if not found and not taken:
+                    raise
+        if self.bloom is not None:
+            self.bloom.add_many(token_keys(documents))
+        # replaces negative entries of reidentify calls made before the token existed
+        await self.cache.set_many(
+            {
+                self.index_cache_prefix + reverse_key_of(data): data["pk"]
+                for data in documents
+            }
         )
-        data = token_create.dict()
-        data["identity_token"] = identity.identity_token
-        await db.collection(self.collection_name).document(token_create.pk).create(data)
-        return await self.get(token_create.pk)
+        return existing
 
-    async def get(self, pk: str) -> Token:
-        """Get a token."""
-        doc_ref = db.collection(self.collection_name).document(pk)
-        doc = await doc_ref.get()
-        if doc.exists:
-            return typed_token(Token(**doc.to_dict()))
-        return
-
-    async def get_or_create(self, token_create: TokenCreate) -> Token:
-        """Get or create a token if doesn't exists."""
-        token = await self.get(token_create.pk)
-        if not token:
-            token = await self.create(token_create)
-        return token
+    async def _taken(self, documents: List[dict]) -> List[dict]:
+        """Get the documents whose reverse key is taken by another token."""
+        token_finds = {
+            reverse_key_of(data): TokenFind(
+                identifier=data["identifier"],
+                identity_token=data["identity_token"],
+                token=data["token"],
+                field=data.get("field", ""),
+            )
+            for data in documents
+        }
+        found = await self.admission.call("read", self.store.find_many, token_finds)
+        return [data for data in documents if reverse_key_of(data) in found]
+
+    def _tokenize_again(
+        self, taken: List[dict], documents: List[dict]
+    ) -> Dict[str, Token]:
+        """Give documents whose reverse key is taken new tokens, unique in documents.
+
+        Returns the tokens of the documents by pk.
+        """
+        retokenized = {id(data) for data in taken}
+        keys = {
+            reverse_key_of(data) for data in documents if id(data) not in retokenized
+        }
+        tokens = {}
+        for data in taken:
+            # identity tokens and encrypted tokens are derived from their values
+            if (
+                data["token"] == data["identity_token"]
+                or data["method"] == "FORMAT_PRESERVING_ENCRYPTION"
+            ):
+                raise TokenCollision(f"Token of {data['pk']} is taken.")
+            for _ in range(self.max_tokenize_attempts):
+                data["token"] = tokenize_value(
+                    data["method"], data["type"], data["value"]
+                )
+                if reverse_key_of(data) not in keys:
+                    break
+            else:
+                raise TokenCollision(f"No unique token found for {data['pk']}.")
+            keys.add(reverse_key_of(data))
+            tokens[data["pk"]] = token_from_dict(dict(data))
+        return tokens
+
+    def _might_exist(self, keys: Iterable[str]) -> List[str]:
+        """Get the keys that may exist, all of them without a Bloom filter."""
+        keys = list(keys)
+        if self.bloom is None:
+            return keys
+        present = [key for key in keys if key in self.bloom]
+        count_bloom(len(keys) - len(present), len(present))
+        return present
+
+    async def _gather_chunks(
+        self, func: Callable[[list], Awaitable[Any]], items: list, chunk_size: int
+    ) -> List[Any]:
+        """Run func over chunks of items with bounded concurrency."""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(chunk: list) -> Any:
+            async with semaphore:
+                return await func(chunk)
+
+        return await asyncio.gather(
+            *(run(chunk) for chunk in chunked(items, chunk_size))
+        )
 
     async def list(self, identifier: str, identity: str) -> List[Token]:
         """List tokens."""
-        identities_ref = db.collection(self.collection_name)
-        composite_filter = BaseCompositeFilter(
-            operator=StructuredQuery.CompositeFilter.Operator.AND,
-            filters=[
-                FieldFilter("identifier", "==", identifier),
-                FieldFilter("identity", "==", identity),
-            ],
-        )
-        composite_query = identities_ref.where(filter=composite_filter)
-        return [
-            typed_token(Token(**doc.to_dict()))
-            async for doc in composite_query.stream()
-            if doc.to_dict()
-        ]
+        with timer("store_query"):
+            return await self.store.list(identifier, identity)
+
+    async def scan(
+        self,
+        identifier: str,
+        identity: str,
+        fields: List[str] = None,
+        start_after: str = None,
+        limit: int = None,
+    ) -> AsyncIterator[dict]:
+        """Stream the tokens of an identity in pk order, as dicts of their fields.
+
+        Only fields and the pk are read if fields are given, and a page of at most limit
+        tokens after the pk start_after if they are given.
+        """
+        names = list(Token.__fields__) if fields is None else ["pk", *fields]
+        read_fields = None
+        if fields is not None:
+            read_fields = list(fields)
+            # values and tokens are stored as strings of their type
+            if {"value", "token"} & set(fields) and "type" not in fields:
+                read_fields.append("type")
+        async for data in self.store.scan(
+            identifier, identity, read_fields, start_after, limit
+        ):
+            for name in ("value", "token"):
+                if data.get(name) is not None:
+                    data[name] = typed_value(data["type"], data[name])
+            yield {name: data[name] for name in names if name in data}
 
     async def delete(self, pk: str) -> str:
-        """Delete a token."""
-        await db.collection(self.collection_name).document(pk).delete()
+        """Delete a token and its reverse index entry."""
+        token = await self.get(pk)
+        if token:
+            await self.admission.call("write", self.store.delete_many, [token.dict()])
+            if self.snapshot is not None:
+                self.snapshot.forget([token.dict()])
+            key = reverse_key_of(token.dict())
+            await self.cache.delete(self.index_cache_prefix + key)
+        await self.cache.delete(pk)
         return pk
 
+    async def delete_identity(
+        self,
+        identifier: str,
+        identity: str,
+        progress: Callable[[int], Awaitable[Any]] = None,
+    ) -> int:
+        """Delete all tokens of an identity and their reverse index entries.
+
+        Only the fields of the reverse index keys are read, and the tokens are deleted
+        in batched writes with bounded concurrency while they are streamed from the
+        store. progress is awaited with the number of deleted tokens after every
+        batch. Returns the number of deleted tokens.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        deleted = 0
+
+        async def delete_chunk(documents: List[dict]) -> None:
+            nonlocal deleted
+            try:
+                await self._delete_chunk(documents)
+                deleted += len(documents)
+                if progress is not None:
+                    await progress(deleted)
+            finally:
+                semaphore.release()
+
+        tasks = []
+        chunk = []
+        fields = ["identifier", "identity_token", "token", "field"]
+        async for data in self.store.scan(identifier, identity, fields):
+            chunk.append(data)
+            if len(chunk) >= self.admission.batch_size("write"):
+                # bounds the chunks in memory, not only those being written
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(delete_chunk(chunk)))
+                chunk = []
+        if chunk:
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(delete_chunk(chunk)))
+        await asyncio.gather(*tasks)
+        return deleted
+
+    async def _delete_chunk(self, documents: List[dict]) -> None:
+        """Delete token documents in one batch and purge them from the cache."""
+        with timer("store_delete", len(documents)):
+            await self.admission.call("write", self.store.delete_many, documents)
+        if self.snapshot is not None:
+            self.snapshot.forget(documents)
+        await self.cache.delete_many(
+            [data["pk"] for data in documents]
+            + [self.index_cache_prefix + reverse_key_of(data) for data in documents]
+        )
+
     async def deidentify(
         self, batch: RemoteFunctionTokenRequest
     ) -> RemoteFunctionTokenResponse:
-        """Deidentify a batch of tokens."""
-        calls = batch.calls
-        replies = []
-        for call in calls:
-            pk = create_uuid_from_list(call)
-            token_create = TokenCreate(
-                pk=pk,
-                identifier=call[0],
-                identity=call[1],
-                value=call[2],
-                field=dict(enumerate(call)).get(3, ""),
-                type=batch.userDefinedContext["tokenType"],
-            )
-            token = await self.get_or_create(token_create)
-            replies.append(token.token)
-        response = {"replies": replies}
-        return RemoteFunctionTokenResponse(**response)
+        """Deidentify a batch of tokens, see deidentify_calls."""
+        replies = await self.deidentify_calls(
+            batch.calls,
+            batch.userDefinedContext["tokenType"],
+            batch.userDefinedContext.get("method", "FORMAT_PRESERVING"),
+        )
+        return RemoteFunctionTokenResponse.construct(replies=replies)
+
+    async def deidentify_calls(
+        self,
+        calls: List[list],
+        data_type: str,
+        method: str = "FORMAT_PRESERVING",
+        identities: Dict[str, Token] = None,
+    ) -> List[Any]:
+        """Deidentify calls of identifier, identity, value and optional field.
+
+        Primary keys are derived up front in one batch and repeated rows are only
+        looked up once. Existing tokens are read in chunks with batched reads, only the
+        misses are created, and the replies keep the order of the calls. Only the
+        misses are validated as models. Tokens of the FORMAT_PRESERVING_ENCRYPTION
+        method are derived from the key and not stored. identities is an optional memo
+        of identity tokens, see create_many.
+        """
+        if method == "FORMAT_PRESERVING_ENCRYPTION":
+            with timer("encrypt", len(calls)):
+                return await offloader.map(encrypt_calls, calls, data_type)
+        with timer("derive_keys", len(calls)):
+            pks = await offloader.map(derive_keys, calls, self.key_scheme)
+        rows = dict(zip(pks, calls))
+        tokens = await self.get_many_by_values(rows, skip_absent=True)
+        misses = []
+        async for chunk in offloader.chunks(
+            [(pk, call) for pk, call in rows.items() if pk not in tokens]
+        ):
+            misses += [
+                TokenCreate(
+                    pk=pk,
+                    identifier=call[0],
+                    identity=call[1],
+                    value=call[2],
+                    field=dict(enumerate(call)).get(3, ""),
+                    type=data_type,
+                    method=method,
+                )
+                for pk, call in chunk
+            ]
+        if misses:
+            tokens.update(await self.create_many(misses, identities))
+        return [tokens[pk].token for pk in pks]
 
     async def reidentify(
         self, batch: RemoteFunctionTokenRequest
     ) -> RemoteFunctionTokenResponse:
-        """Reidentify a batch of tokens."""
-        calls = batch.calls
-        replies = []
-        for call in calls:
-            token_find = TokenFind(
-                identifier=call[0], identity_token=call[1], token=call[2]
-            )
-            token = await self.find(token_find)
-            if not token:
-                replies.append(None)
-            else:
-                replies.append(token.value)
-        response = {"replies": replies}
-        return RemoteFunctionTokenResponse(**response)
+        """Reidentify a batch of tokens, see reidentify_calls."""
+        replies = await self.reidentify_calls(
+            batch.calls,
+            batch.userDefinedContext.get("tokenType", "STRING"),
+            batch.userDefinedContext.get("method"),
+        )
+        return RemoteFunctionTokenResponse.construct(replies=replies)
+
+    async def reidentify_calls(
+        self, calls: List[list], data_type: str = "STRING", method: str = None
+    ) -> List[Any]:
+        """Reidentify calls of identifier, identity token, token and optional field.
+
+        Tokens are looked up in the reverse index with batched point reads instead of
+        one query per call, and repeated rows are only looked up once. Tokens of the
+        FORMAT_PRESERVING_ENCRYPTION method are decrypted instead.
+        """
+        if method == "FORMAT_PRESERVING_ENCRYPTION":
+            with timer("decrypt", len(calls)):
+                return await offloader.map(decrypt_calls, calls, data_type)
+        keys = []
+        token_finds = {}
+        with timer("derive_keys", len(calls)):
+            for call in calls:
+                key = reverse_key(*call[:3], dict(enumerate(call)).get(3, ""))
+                keys.append(key)
+                if key not in token_finds:
+                    token_finds[key] = TokenFind(
+                        identifier=call[0],
+                        identity_token=call[1],
+                        token=call[2],
+                        field=dict(enumerate(call)).get(3, ""),
+                    )
+        tokens = await self.find_many(token_finds)
+        return [tokens[key].value if key in tokens else None for key in keys]
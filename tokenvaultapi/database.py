@@ -1,15 +1,15 @@
-"""database"""
-import sys
-
-from google.cloud import firestore
-
-# Project ID is determined by the GCLOUD_PROJECT environment variable
-# mockfirestore can't be used for testing async code, remove when fixed
-# if "pytest" in sys.argv[0]:
-#     # testing db
-#     from mockfirestore import AsyncMockFirestore
-#     db = AsyncMockFirestore()
-# else:
-    # not a testing db
-    # db = firestore.Client()  # pragma: no cover
-db = firestore.AsyncClient()
+"""Firestore client."""
+from typing import Any
+
+
+def create_client() -> Any:
+    """Create a Firestore client.
+
+    The client library is only imported here, and the project is determined by the
+    GCLOUD_PROJECT environment variable or the credentials. Creating the client looks
+    the credentials up, which blocks, and its channel is opened by its first call in
+    the event loop it will be used in, see FirestoreTokenStore.warm_up.
+    """
+    from google.cloud import firestore
+
+    return firestore.AsyncClient()
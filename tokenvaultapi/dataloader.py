@@ -0,0 +1,135 @@
+"""Micro-batching of point reads across concurrent requests.
+
+Each request reads its own tokens, so at high QPS many small reads are made at the same
+time and each pays the overhead of an RPC. A data loader collects the keys read within
+a short window, or until a batch is full, and reads them in one batched read. Keys that
+are read concurrently are read once.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Set, Tuple
+
+from tokenvaultapi.metrics import SIZE_BUCKETS, Histogram, registry
+
+# result of keys that were not found
+_MISSING = object()
+
+
+class DataLoader:
+    """Batches the keys loaded within window seconds into loads of up to max_batch."""
+
+    def __init__(
+        self,
+        load: Callable[[List[str]], Awaitable[Dict[str, Any]]],
+        window: float = 0.002,
+        max_batch: int = 250,
+        max_concurrency: int = 32,
+        name: str = None,
+    ) -> None:
+        self.load = load
+        self.window = window
+        self.max_batch = max_batch
+        self.max_concurrency = max_concurrency
+        # keys waiting for a batch, with the time they were queued
+        self._queue: List[Tuple[str, float]] = []
+        # futures of the keys that are queued or being loaded
+        self._futures: Dict[str, asyncio.Future] = {}
+        self._timer: asyncio.TimerHandle = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._loop: asyncio.AbstractEventLoop = None
+        self._semaphore: asyncio.Semaphore = None
+        # seconds keys wait for their batch, keys per batch and seconds per load, in
+        # the metrics registry if the loader has a name
+        self.wait_seconds = Histogram()
+        self.batch_size = Histogram(SIZE_BUCKETS)
+        self.load_seconds = Histogram()
+        if name is not None:
+            self.wait_seconds = registry.histogram(
+                "tokenvault_loader_wait_seconds",
+                "Seconds keys wait for their batched read.",
+                loader=name,
+            )
+            self.batch_size = registry.histogram(
+                "tokenvault_loader_batch_size",
+                "Keys per batched read.",
+                SIZE_BUCKETS,
+                loader=name,
+            )
+            self.load_seconds = registry.histogram(
+                "tokenvault_loader_read_seconds",
+                "Seconds per batched read.",
+                loader=name,
+            )
+
+    async def load_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Load keys in the next batches, keys that are not found are left out."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # whatever was queued on another event loop can't be loaded on this one
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._queue, self._futures, self._timer = [], {}, None
+        now = time.perf_counter()
+        futures = {}
+        for key in keys:
+            future = self._futures.get(key)
+            if future is None:
+                future = self._futures[key] = loop.create_future()
+                self._queue.append((key, now))
+            futures[key] = future
+        if len(self._queue) >= self.max_batch:
+            self._dispatch(full_only=True)
+        if self._queue and self._timer is None:
+            self._timer = loop.call_later(self.window, self._dispatch)
+        results = {}
+        for key, future in futures.items():
+            # a cancelled caller must not fail the other callers of the key
+            result = await asyncio.shield(future)
+            if result is not _MISSING:
+                results[key] = result
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the histograms of the loader."""
+        return {
+            "wait_seconds": self.wait_seconds.snapshot(),
+            "batch_size": self.batch_size.snapshot(),
+            "load_seconds": self.load_seconds.snapshot(),
+        }
+
+    def _dispatch(self, full_only: bool = False) -> None:
+        """Start loading the queued keys in batches, only full batches if full_only."""
+        if not full_only and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while len(self._queue) >= self.max_batch or (self._queue and not full_only):
+            batch = self._queue[: self.max_batch]
+            self._queue = self._queue[self.max_batch :]
+            task = asyncio.get_running_loop().create_task(self._load(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _load(self, batch: List[Tuple[str, float]]) -> None:
+        """Load a batch and resolve the futures of its keys."""
+        keys = [key for key, _ in batch]
+        try:
+            async with self._semaphore:
+                start = time.perf_counter()
+                for _, queued in batch:
+                    self.wait_seconds.observe(start - queued)
+                self.batch_size.observe(len(keys))
+                results = await self.load(keys)
+                self.load_seconds.observe(time.perf_counter() - start)
+        except asyncio.CancelledError:
+            for key in keys:
+                self._futures.pop(key).cancel()
+            raise
+        except Exception as e:
+            for key in keys:
+                future = self._futures.pop(key)
+                future.set_exception(e)
+                # retrieved here, the callers may have been cancelled
+                future.exception()
+            return
+        for key in keys:
+            self._futures.pop(key).set_result(results.get(key, _MISSING))
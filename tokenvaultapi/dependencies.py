@@ -0,0 +1,40 @@
+"""Services of the routes, injected with FastAPI dependencies.
+
+They are created by the lifespan of the app with its token store, see
+tokenvaultapi.main, or on first use if the app was not started with its lifespan, like
+in tests.
+"""
+from fastapi import FastAPI, Request
+from starlette.datastructures import State
+
+from tokenvaultapi.daos.jobs import JobDAO
+from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.services.job import JobService
+from tokenvaultapi.services.token import TokenService
+from tokenvaultapi.stores import TokenStore, get_store
+
+
+def create_services(app: FastAPI, store: TokenStore = None) -> State:
+    """Create the services of the app on its state, with the shared store by default."""
+    store = store if store is not None else get_store()
+    job_dao = JobDAO(store)
+    app.state.token_service = TokenService(TokenDAO(store=store), job_dao)
+    app.state.job_service = JobService(job_dao)
+    return app.state
+
+
+def services(app: FastAPI) -> State:
+    """Get the state of the app with its services, created on first use."""
+    if getattr(app.state, "token_service", None) is None:
+        create_services(app)
+    return app.state
+
+
+def get_token_service(request: Request) -> TokenService:
+    """Get the token service of the app."""
+    return services(request.app).token_service
+
+
+def get_job_service(request: Request) -> JobService:
+    """Get the job service of the app."""
+    return services(request.app).job_service
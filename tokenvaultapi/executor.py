@@ -0,0 +1,98 @@
+"""Offloading of CPU heavy batch work from the event loop.
+
+Deriving primary keys and generating tokens are pure CPU work. For small batches it
+takes less time than handing it to another process, but a large batch would block the
+event loop, and every other request of the worker with it, for as long as it runs.
+Batches of at least CPU_OFFLOAD_THRESHOLD items are therefore split into chunks that
+are run in a process pool, while the event loop keeps serving requests.
+
+The pool is created on first use, in the worker process, and its processes are
+spawned rather than forked so they don't inherit the state of the event loop or of
+the random generators.
+"""
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, AsyncIterator, Callable, List, Sequence
+
+from tokenvaultapi.config import (CPU_OFFLOAD_CHUNK_SIZE,
+                                  CPU_OFFLOAD_THRESHOLD, CPU_OFFLOAD_WORKERS)
+from tokenvaultapi.tokenizers import tokenize_values
+
+
+def tokenize_pairs(pairs: Sequence[tuple], method: str, data_type: str) -> List[str]:
+    """Tokenize (value, tweak) pairs, see tokenize_values."""
+    return tokenize_values(
+        method, data_type, [value for value, _ in pairs], [tweak for _, tweak in pairs]
+    )
+
+
+class Offloader:
+    """Runs functions of batches inline, or in chunks in a process pool if large."""
+
+    def __init__(
+        self,
+        threshold: int = CPU_OFFLOAD_THRESHOLD,
+        workers: int = CPU_OFFLOAD_WORKERS,
+        chunk_size: int = CPU_OFFLOAD_CHUNK_SIZE,
+    ) -> None:
+        self.threshold = threshold
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._pool: ProcessPoolExecutor = None
+
+    @property
+    def enabled(self) -> bool:
+        """Whether large batches are offloaded."""
+        return self.workers > 0 and self.threshold > 0
+
+    def pool(self) -> ProcessPoolExecutor:
+        """Get the process pool, created on first use."""
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    async def map(
+        self, func: Callable[..., List[Any]], items: Sequence[Any], *args: Any
+    ) -> List[Any]:
+        """Call func(items, *args), returning a list with one result per item.
+
+        func must be a module level function, so it can be called in another process,
+        and chunks of items must give the results of their items.
+        """
+        if not self.enabled or len(items) < self.threshold:
+            return func(items, *args)
+        loop = asyncio.get_running_loop()
+        pool = self.pool()
+        chunks = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    pool, partial(func, items[start : start + self.chunk_size], *args)
+                )
+                for start in range(0, len(items), self.chunk_size)
+            )
+        )
+        return [result for chunk in chunks for result in chunk]
+
+    async def chunks(self, items: Sequence[Any]) -> AsyncIterator[Sequence[Any]]:
+        """Iterate chunks of items, letting the event loop run between them.
+
+        For CPU work that has to stay in this process, like building models, so a
+        large batch doesn't block other requests for all of its duration.
+        """
+        for start in range(0, len(items), self.chunk_size):
+            if start:
+                await asyncio.sleep(0)
+            yield items[start : start + self.chunk_size]
+
+    def shutdown(self) -> None:
+        """Shut the process pool down."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+offloader = Offloader()
@@ -0,0 +1,208 @@
+"""Keyed, deterministic format preserving encryption.
+
+Tokens of the FORMAT_PRESERVING_ENCRYPTION method are derived from a secret key instead
+of being random, so deidentify does not need to store them and reidentify decrypts
+them instead of looking them up.
+
+Letters and digits are encrypted within their character class, other characters are
+kept. The encrypted characters form a mixed radix number that is encrypted with a
+Feistel network using HMAC-SHA256 as round function, like NIST FF1 but over mixed
+radixes. For INT and FLOAT values only digits are encrypted, and cycle walking makes
+sure the token is the canonical string of a number of the same type. Floats written
+with 17 significant digits rarely are, so they take tens of passes to encrypt. Only
+canonical values, and INT values in the int64 range, are encrypted, so the walk always
+ends at the latest when it cycles back to the value.
+"""
+import hashlib
+import hmac
+import string
+from typing import Dict, List, Tuple
+
+from tokenvaultapi.config import FPE_KEY, FPE_KEY_FILE
+
+ROUNDS = 10
+# encrypted characters must have at least this many combinations, like FF1
+MIN_DOMAIN_SIZE = 100
+# passes of the cycle walk before giving up, a guard against values that can't end it
+MAX_WALKS = 10000
+INT64_MIN = -(2**63)
+INT64_MAX = 2**63 - 1
+
+# character class alphabets by type
+ALPHABETS = {
+    "STRING": (string.ascii_lowercase, string.ascii_uppercase, string.digits),
+    "INT": (string.digits,),
+    "FLOAT": (string.digits,),
+}
+# encrypted characters by type, mapped to their class marker, numeral and alphabet
+CHARACTERS = {
+    data_type: {
+        char: (chr(marker), numeral, alphabet)
+        for marker, alphabet in enumerate(alphabets)
+        for numeral, char in enumerate(alphabet)
+    }
+    for data_type, alphabets in ALPHABETS.items()
+}
+
+
+def canonical(value: str, data_type: str) -> str:
+    """Get how a value of the type is written, e.g. "1.0" for the FLOAT "1"."""
+    if data_type == "INT":
+        return str(int(value))
+    if data_type == "FLOAT":
+        return str(float(value))
+    return value
+
+
+def is_canonical(value: str, data_type: str) -> bool:
+    """Check that a string is how a value of the type is written, e.g. no leading 0."""
+    if data_type == "INT":
+        return str(int(value)) == value and INT64_MIN <= int(value) <= INT64_MAX
+    if data_type == "FLOAT":
+        return str(float(value)) == value
+    return True
+
+
+def check_value(value: str, data_type: str) -> None:
+    """Raise a ValueError for values that aren't how a value of the type is written."""
+    try:
+        valid = is_canonical(value, data_type)
+    except ValueError:
+        valid = False
+    if not valid:
+        raise ValueError(f"Not a canonical {data_type} value, can't encrypt: {value}")
+
+
+class FormatPreservingCipher:
+    """Format preserving cipher for a key."""
+
+    def __init__(self, key: bytes) -> None:
+        if len(key) < 16:
+            raise ValueError("Format preserving encryption key must be >= 16 bytes.")
+        # keyed once, copied for every round
+        self._mac = hmac.new(key, digestmod=hashlib.sha256)
+
+    def encrypt(self, value: str, data_type: str, tweak: bytes = b"") -> str:
+        """Encrypt a value, the tweak must be the same to decrypt it.
+
+        Raises a ValueError for values that aren't canonical, see check_value, and
+        values with too few encrypted characters, see MIN_DOMAIN_SIZE.
+        """
+        check_value(value, data_type)
+        return self._walk(value, data_type, tweak, 1)
+
+    def decrypt(self, token: str, data_type: str, tweak: bytes = b"") -> str:
+        """Decrypt a token."""
+        return self._walk(token, data_type, tweak, -1)
+
+    def _walk(self, value: str, data_type: str, tweak: bytes, direction: int) -> str:
+        """Cycle walk until the result is a canonical value of the type."""
+        characters = CHARACTERS.get(data_type, CHARACTERS["STRING"])
+        result = self._cipher(canonical(value, data_type), characters, tweak, direction)
+        walks = 1
+        while not is_canonical(result, data_type):
+            if walks == MAX_WALKS:
+                raise ValueError(f"No {data_type} value in {MAX_WALKS} cycle walks.")
+            result = self._cipher(result, characters, tweak, direction)
+            walks += 1
+        return result
+
+    def _cipher(
+        self, value: str, characters: Dict[str, tuple], tweak: bytes, direction: int
+    ) -> str:
+        """Encrypt (direction 1) or decrypt (direction -1) the characters of a value."""
+        positions, numerals, radixes, position_alphabets = [], [], [], []
+        # the value with encrypted characters replaced by their class
+        pattern = list(value)
+        for index, char in enumerate(value):
+            if char in characters:
+                marker, numeral, alphabet = characters[char]
+                positions.append(index)
+                numerals.append(numeral)
+                radixes.append(len(alphabet))
+                position_alphabets.append(alphabet)
+                pattern[index] = marker
+        if not positions:
+            return value
+        half = len(numerals) // 2
+        a, size_a = to_number(numerals[:half], radixes[:half])
+        b, size_b = to_number(numerals[half:], radixes[half:])
+        if size_a * size_b < MIN_DOMAIN_SIZE:
+            raise ValueError(
+                f"Too few characters to encrypt, {size_a * size_b} values are"
+                f" fewer than {MIN_DOMAIN_SIZE}."
+            )
+        # the round function depends on the format, so each format is its own cipher
+        prefix = b"|".join([tweak, "".join(pattern).encode("UTF-8"), b""])
+        if direction == 1:
+            for i in range(ROUNDS):
+                a, b = b, (a + self._round(prefix, i, b, size_a)) % size_a
+                size_a, size_b = size_b, size_a
+        else:
+            for i in reversed(range(ROUNDS)):
+                size_a, size_b = size_b, size_a
+                a, b = (b - self._round(prefix, i, a, size_a)) % size_a, a
+        numerals = to_numerals(a, radixes[:half]) + to_numerals(b, radixes[half:])
+        result = list(value)
+        for index, numeral, alphabet in zip(positions, numerals, position_alphabets):
+            result[index] = alphabet[numeral]
+        return "".join(result)
+
+    def _round(self, prefix: bytes, i: int, b: int, modulus: int) -> int:
+        """Round function, a pseudorandom number with 64 bits more than modulus."""
+        message = prefix + bytes([i]) + b.to_bytes((b.bit_length() + 7) // 8, "big")
+        blocks = []
+        size = 0
+        counter = 0
+        while size < modulus.bit_length() + 64:
+            mac = self._mac.copy()
+            mac.update(message + counter.to_bytes(4, "big"))
+            blocks.append(mac.digest())
+            size += 256
+            counter += 1
+        return int.from_bytes(b"".join(blocks), "big")
+
+
+def to_number(numerals: List[int], radixes: List[int]) -> Tuple[int, int]:
+    """Convert mixed radix numerals to a number and the size of its domain."""
+    number, size = 0, 1
+    for numeral, radix in zip(numerals, radixes):
+        number = number * radix + numeral
+        size *= radix
+    return number, size
+
+
+def to_numerals(number: int, radixes: List[int]) -> List[int]:
+    """Convert a number to mixed radix numerals."""
+    numerals = []
+    for radix in reversed(radixes):
+        number, numeral = divmod(number, radix)
+        numerals.append(numeral)
+    return numerals[::-1]
+
+
+def encryption_tweak(identifier: str, identity_token: str, field: str = "") -> bytes:
+    """Create the tweak of a token, so equal values of different identities differ."""
+    parts = [str(part).encode("UTF-8") for part in (identifier, identity_token, field)]
+    return b"".join(len(part).to_bytes(4, "big") + part for part in parts)
+
+
+def load_key() -> bytes:
+    """Load the hex encoded key from FPE_KEY_FILE or FPE_KEY."""
+    if FPE_KEY_FILE:
+        with open(FPE_KEY_FILE) as key_file:
+            return bytes.fromhex(key_file.read().strip())
+    if FPE_KEY:
+        return bytes.fromhex(FPE_KEY)
+    raise ValueError("Set FPE_KEY or FPE_KEY_FILE to use format preserving encryption.")
+
+
+_cipher = None
+
+
+def get_cipher() -> FormatPreservingCipher:
+    """Get the cipher for the configured key, loaded on first use."""
+    global _cipher
+    if _cipher is None:
+        _cipher = FormatPreservingCipher(load_key())
+    return _cipher
@@ -1,8 +1,64 @@
-"""gunicorn server configuration."""
+"""gunicorn server configuration.
+
+Requests wait on Firestore most of the time, which an asyncio worker overlaps, with
+bursts of CPU when batches are tokenized. One uvicorn worker per CPU keeps every CPU
+busy without workers competing for them, see benchmarks/README.md. Threads don't apply
+to uvicorn workers, which run one event loop each; uvicorn uses uvloop and httptools
+when they are installed.
+
+Settings can be overridden with environment variables:
+
+- WEB_CONCURRENCY: number of workers, the number of CPUs available by default
+- FIRESTORE_MAX_CONCURRENCY: store calls in flight per instance, split between the
+  workers, unless ADMISSION_MAX_CONCURRENCY and READ_BATCH_MAX_CONCURRENCY (batched
+  reads) are set per worker
+- GUNICORN_PRELOAD: import the app once before forking the workers, so they start
+  faster and share memory, true or false
+- GUNICORN_TIMEOUT: seconds before a silent worker is restarted
+"""
 import os
+from importlib.util import find_spec
+
+
+def cpu_count() -> int:
+    """Get the number of CPUs available to the process, honoring a cgroup CPU quota."""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover
+        count = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            count = min(count, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return count
+
 
 bind = f":{os.environ.get('PORT', '8080')}"
-threads = 2
-workers = 5
-timeout = 60
+workers = int(os.environ.get("WEB_CONCURRENCY", cpu_count()))
 worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 30
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() == "true"
+
+# set before the app is imported, by the master with preload or else by each worker
+worker_store_concurrency = str(
+    max(1, int(os.environ.get("FIRESTORE_MAX_CONCURRENCY", "64")) // workers)
+)
+os.environ.setdefault("ADMISSION_MAX_CONCURRENCY", worker_store_concurrency)
+os.environ.setdefault("READ_BATCH_MAX_CONCURRENCY", worker_store_concurrency)
+
+
+def post_worker_init(worker) -> None:
+    """Log the event loop and HTTP parser of the worker."""
+    loop = "uvloop" if find_spec("uvloop") else "asyncio"
+    http = "httptools" if find_spec("httptools") else "h11"
+    worker.log.info(
+        "Worker %s runs %s with %s, %s store calls in flight",
+        worker.pid,
+        loop,
+        http,
+        os.environ["ADMISSION_MAX_CONCURRENCY"],
+    )
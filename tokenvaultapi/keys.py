@@ -0,0 +1,73 @@
+"""Derivation of document keys from values.
+
+Key schemes:
+
+- v1, the legacy scheme: md5 of the values joined by spaces, formatted as a UUID. The
+  encoding is ambiguous, ["a b", "c"] and ["a", "b c"] get the same key.
+- v2: blake2b-128 of the values, each prefixed by its length, as 32 hex characters.
+  v2 keys have no dashes, so they can't be mistaken for v1 keys.
+
+New keys are derived with KEY_SCHEME. With LEGACY_KEY_FALLBACK set, tokens that are not
+found by their key are also looked up by their v1 key. Reverse index keys are always
+derived with REVERSE_KEY_SCHEME, so switching KEY_SCHEME doesn't change the keys of
+the reverse index, the Bloom filter and snapshots.
+"""
+import hashlib
+from typing import Any, Iterable, List, Sequence
+from uuid import UUID
+
+from tokenvaultapi.config import KEY_SCHEME
+
+V1 = "v1"
+V2 = "v2"
+# the scheme of reverse index keys, independent of KEY_SCHEME
+REVERSE_KEY_SCHEME = V2
+
+
+def legacy_key(values: Sequence) -> str:
+    """Derive the v1 key of values."""
+    hex_string = hashlib.md5(" ".join(map(str, values)).encode("UTF-8")).hexdigest()
+    return str(UUID(hex=hex_string))
+
+
+def encode_values(values: Sequence) -> bytes:
+    """Encode values unambiguously, as "<length>:<value>" for every value."""
+    return "".join([f"{len(value)}:{value}" for value in map(str, values)]).encode(
+        "UTF-8"
+    )
+
+
+def key_v2(values: Sequence) -> str:
+    """Derive the v2 key of values."""
+    return hashlib.blake2b(encode_values(values), digest_size=16).hexdigest()
+
+
+def derive_key(values: Sequence, scheme: str = KEY_SCHEME) -> str:
+    """Derive the key of values with a key scheme."""
+    if scheme == V1:
+        return legacy_key(values)
+    return key_v2(values)
+
+
+def derive_keys(rows: Iterable[Sequence], scheme: str = KEY_SCHEME) -> List[str]:
+    """Derive the keys of many rows of values with a key scheme."""
+    if scheme == V1:
+        return [legacy_key(values) for values in rows]
+    blake2b = hashlib.blake2b
+    return [
+        blake2b(encode_values(values), digest_size=16).hexdigest() for values in rows
+    ]
+
+
+def reverse_key(
+    identifier: str, identity_token: str, token: Any, field: str = ""
+) -> str:
+    """Derive the reverse index key of a token, used to find it by its token."""
+    return derive_key([identifier, identity_token, token, field], REVERSE_KEY_SCHEME)
+
+
+def reverse_key_of(data: dict) -> str:
+    """Derive the reverse index key of a token document."""
+    return reverse_key(
+        data["identifier"], data["identity_token"], data["token"], data.get("field", "")
+    )
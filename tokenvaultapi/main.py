@@ -1,18 +1,131 @@
+import asyncio
 import os
 import time
-from typing import Any, Callable
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, List
 
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 
-from tokenvaultapi import __project_id__, __version__
-from tokenvaultapi.routers import health, token
+from tokenvaultapi import __project_id__, __version__, bloom, snapshot
+from tokenvaultapi.admission import Overloaded, backoff
+from tokenvaultapi.config import (BLOOM_PATH, RETRY_BASE_SECONDS,
+                                  RETRY_MAX_SECONDS, SNAPSHOT_PATH)
+from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.dependencies import create_services
+from tokenvaultapi.executor import offloader
+from tokenvaultapi.logger import logger
+from tokenvaultapi.metrics import observe_request
+from tokenvaultapi.routers import health, job, metrics, token
+from tokenvaultapi.stores import TokenCollision, create_store
 
 os.environ["TZ"] = "UTC"
 
+
+async def open_snapshot(token_dao: TokenDAO) -> asyncio.Task:
+    """Map the token snapshot of the worker, if configured, and keep it refreshed.
+
+    Returns the task refreshing it, or None.
+    """
+    if not SNAPSHOT_PATH:
+        return None
+    try:
+        replica = snapshot.SnapshotReplica(SNAPSHOT_PATH)
+        # hides what was deleted since the export before tokens are read from it
+        count = await replica.refresh(token_dao.store)
+    except Exception:
+        logger.exception(f"Not reading tokens from snapshot {SNAPSHOT_PATH}")
+        return None
+    logger.info(
+        f"Reading tokens from snapshot {SNAPSHOT_PATH} of {len(replica.snapshot)}"
+        f" tokens, {count} changed since"
+    )
+    token_dao.snapshot = replica
+    return asyncio.create_task(snapshot.refresh_forever(replica, token_dao.store))
+
+
+async def load_bloom(token_dao: TokenDAO) -> asyncio.Task:
+    """Load the Bloom filter of tokens, if configured, and keep it refreshed.
+
+    Returns the task refreshing it, or None.
+    """
+    if not BLOOM_PATH:
+        return None
+    try:
+        bloom_filter = bloom.BloomFilter.load(BLOOM_PATH)
+        # tokens created since the filter was built must not be skipped
+        count = await bloom.refresh(bloom_filter, token_dao.store)
+    except Exception:
+        logger.exception(f"Not skipping reads with Bloom filter {BLOOM_PATH}")
+        return None
+    logger.info(
+        f"Skipping reads with Bloom filter {BLOOM_PATH} of {bloom_filter.count} keys,"
+        f" {count} tokens created since, error rate {bloom_filter.error_rate:.4f}"
+    )
+    token_dao.bloom = bloom_filter
+    return asyncio.create_task(bloom.refresh_forever(bloom_filter, token_dao.store))
+
+
+async def start(app: FastAPI, tasks: List[asyncio.Task]) -> None:
+    """Warm the token store up and load the snapshot and Bloom filter of the worker.
+
+    Warming up is retried until the store answers, and the worker reports ready at
+    /healthcheck once it is done. The tasks started are added to tasks.
+    """
+    token_dao = app.state.token_service.token_dao
+    started = time.perf_counter()
+    attempt = 0
+    while True:
+        try:
+            await token_dao.store.warm_up()
+            break
+        except Exception:
+            logger.exception("Warming up the token store failed")
+            await asyncio.sleep(backoff(attempt, RETRY_BASE_SECONDS, RETRY_MAX_SECONDS))
+            attempt += 1
+    for task in (await open_snapshot(token_dao), await load_bloom(token_dao)):
+        if task is not None:
+            tasks.append(task)
+    app.state.ready = True
+    logger.info(f"Worker ready in {time.perf_counter() - started:.2f}s")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Set up the worker before it serves requests, and tear it down after.
+
+    The token store, with its client, and the services of the routes are created in
+    the worker and in its event loop, see tokenvaultapi.dependencies. The store is
+    warmed up in the background so the worker starts listening right away, for
+    /healthcheck to answer 503 until it is ready. The processes of the offloader are
+    shut down with the worker.
+    """
+    store = create_store()
+    create_services(app, store)
+    app.state.ready = False
+    tasks = []
+    tasks.append(asyncio.create_task(start(app, tasks)))
+    # deletes of other workers are removed from the cache of this one
+    cache = app.state.token_service.token_dao.cache
+    tasks.append(asyncio.create_task(cache.listen()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # as if the app was never started, the services are created again on first use
+    del app.state.ready
+    app.state.token_service = app.state.job_service = None
+    await store.close()
+    # the pool is started again on the next large batch
+    offloader.shutdown()
+
+
 #
 #   create the api
 #
-api = FastAPI(title=f"Firestore FastAPI: {__project_id__}", version=__version__)
+api = FastAPI(
+    title=f"Firestore FastAPI: {__project_id__}", version=__version__, lifespan=lifespan
+)
 
 
 #
@@ -20,15 +133,35 @@ api = FastAPI(title=f"Firestore FastAPI: {__project_id__}", version=__version__)
 #
 @api.middleware("http")
 async def add_process_time_header(request: Request, call_next: Callable) -> Any:
-    start_time = time.time()
+    start_time = time.perf_counter()
     response = await call_next(request)
-    process_time = time.time() - start_time
+    process_time = time.perf_counter() - start_time
     response.headers["X-Process-Time"] = str(process_time)
+    # the route's path template, so requests aren't labeled by their path parameters
+    route = request.scope.get("route")
+    observe_request(request.method, getattr(route, "path", "unmatched"), process_time)
     return response
 
 
+#
+#   exception handlers
+#
+@api.exception_handler(Overloaded)
+async def overloaded(request: Request, exc: Overloaded) -> JSONResponse:
+    return JSONResponse(
+        status_code=exc.status_code, content={"error": str(exc)}, headers=exc.headers
+    )
+
+
+@api.exception_handler(TokenCollision)
+async def token_collision(request: Request, exc: TokenCollision) -> JSONResponse:
+    return JSONResponse(status_code=409, content={"error": str(exc)})
+
+
 #
 #   routers
 #
 api.include_router(health.router)
 api.include_router(token.router)
+api.include_router(job.router)
+api.include_router(metrics.router)
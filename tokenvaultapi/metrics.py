@@ -0,0 +1,265 @@
+"""In-process metrics of the hot path, exported in the Prometheus text format.
+
+Stages of a request, like parsing, key derivation, tokenization and store round trips,
+are timed with the monotonic perf_counter into histograms labeled by stage, with the
+number of items of batched stages. Cache lookups are counted by result. With
+OTEL_ENABLED set every timed stage is also an OpenTelemetry span, if opentelemetry is
+installed.
+
+Metrics are kept per worker process. With METRICS_ENABLED unset timing a stage is a
+no-op.
+"""
+import time
+from bisect import bisect_left
+from typing import Any, Dict, Sequence, Tuple
+
+from tokenvaultapi.config import METRICS_ENABLED, OTEL_ENABLED
+from tokenvaultapi.logger import logger
+
+try:
+    from opentelemetry import trace
+except ImportError:  # pragma: no cover
+    trace = None
+
+# upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+)
+# upper bounds of batch size buckets
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Counts of observed values by bucket, with their count and sum."""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        # the last count is of values above the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Count a value."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Get the cumulative counts by bucket upper bound, with the count and sum."""
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {"buckets": buckets, "count": self.count, "sum": self.sum}
+
+
+class Registry:
+    """Named histograms and counters, by their labels."""
+
+    def __init__(self) -> None:
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.help: Dict[str, str] = {}
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        **labels: str,
+    ) -> Histogram:
+        """Get a histogram by name and labels, created on first use."""
+        self.help.setdefault(name, description)
+        histograms = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        if key not in histograms:
+            histograms[key] = Histogram(buckets)
+        return histograms[key]
+
+    def inc(self, name: str, description: str, value: float = 1, **labels: str) -> None:
+        """Increment a counter by name and labels."""
+        self.help.setdefault(name, description)
+        counters = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        counters[key] = counters.get(key, 0) + value
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text format."""
+        lines = []
+        for name, counters in sorted(self.counters.items()):
+            lines += [f"# HELP {name} {self.help[name]}", f"# TYPE {name} counter"]
+            for labels, value in sorted(counters.items()):
+                lines.append(f"{name}{format_labels(labels)} {value:g}")
+        for name, histograms in sorted(self.histograms.items()):
+            lines += [f"# HELP {name} {self.help[name]}", f"# TYPE {name} histogram"]
+            for labels, histogram in sorted(histograms.items()):
+                snapshot = histogram.snapshot()
+                for bound, count in snapshot["buckets"].items():
+                    bucket_labels = format_labels(labels + (("le", bound),))
+                    lines.append(f"{name}_bucket{bucket_labels} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {snapshot['sum']:g}")
+                lines.append(f"{name}_count{format_labels(labels)} {snapshot['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+    """Format labels as {name="value",...}."""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+registry = Registry()
+
+
+class Timer:
+    """Context manager timing a stage, with the number of items of a batched stage."""
+
+    def __init__(self, stage: str, items: int = None) -> None:
+        self.stage = stage
+        self.items = items
+        self.span = None
+
+    def __enter__(self) -> "Timer":
+        if tracer is not None:
+            self.span = tracer.start_as_current_span(self.stage)
+            span = self.span.__enter__()
+            if self.items is not None:
+                span.set_attribute("items", self.items)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        seconds = time.perf_counter() - self.start
+        registry.histogram(
+            "tokenvault_stage_seconds", "Seconds per stage.", stage=self.stage
+        ).observe(seconds)
+        if self.items is not None:
+            registry.histogram(
+                "tokenvault_stage_items",
+                "Items per batched stage.",
+                SIZE_BUCKETS,
+                stage=self.stage,
+            ).observe(self.items)
+        if self.span is not None:
+            self.span.__exit__(*exc_info)
+
+
+class NullTimer:
+    """Timer of disabled metrics."""
+
+    def __enter__(self) -> "NullTimer":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(stage: str, items: int = None) -> Any:
+    """Time a stage, e.g. with timer("store_get", len(pks)): ..."""
+    if not METRICS_ENABLED:
+        return NULL_TIMER
+    return Timer(stage, items)
+
+
+def count_cache(hits: int, misses: int) -> None:
+    """Count cache lookups by result."""
+    if not METRICS_ENABLED:
+        return
+    description = "Cache lookups by result."
+    registry.inc("tokenvault_cache_lookups_total", description, hits, result="hit")
+    registry.inc("tokenvault_cache_lookups_total", description, misses, result="miss")
+
+
+def count_cache_tier(tier: str, hits: int, misses: int) -> None:
+    """Count the lookups of a cache tier, memory or redis, by result."""
+    if not METRICS_ENABLED:
+        return
+    description = "Cache lookups by tier and result."
+    name = "tokenvault_cache_tier_lookups_total"
+    registry.inc(name, description, hits, tier=tier, result="hit")
+    registry.inc(name, description, misses, tier=tier, result="miss")
+
+
+def count_snapshot(hits: int, misses: int) -> None:
+    """Count snapshot lookups by result."""
+    if not METRICS_ENABLED:
+        return
+    description = "Snapshot lookups by result."
+    registry.inc("tokenvault_snapshot_lookups_total", description, hits, result="hit")
+    registry.inc(
+        "tokenvault_snapshot_lookups_total", description, misses, result="miss"
+    )
+
+
+def count_bloom(absent: int, present: int) -> None:
+    """Count Bloom filter lookups by result."""
+    if not METRICS_ENABLED:
+        return
+    description = "Bloom filter lookups by result."
+    registry.inc("tokenvault_bloom_lookups_total", description, absent, result="absent")
+    registry.inc(
+        "tokenvault_bloom_lookups_total", description, present, result="present"
+    )
+
+
+def count_rejected(reason: str) -> None:
+    """Count a store call rejected by admission control."""
+    if METRICS_ENABLED:
+        registry.inc(
+            "tokenvault_admission_rejected_total",
+            "Store calls rejected by admission control, by reason.",
+            reason=reason,
+        )
+
+
+def count_retry(error: str) -> None:
+    """Count a retried store call."""
+    if METRICS_ENABLED:
+        registry.inc(
+            "tokenvault_store_retries_total",
+            "Store calls retried, by error.",
+            error=error,
+        )
+
+
+def observe_request(method: str, route: str, seconds: float) -> None:
+    """Observe the latency of a request."""
+    if METRICS_ENABLED:
+        registry.histogram(
+            "tokenvault_request_seconds",
+            "Seconds per request.",
+            method=method,
+            route=route,
+        ).observe(seconds)
+
+
+def create_tracer() -> Any:
+    """Create the OpenTelemetry tracer if it is enabled and installed."""
+    if not (METRICS_ENABLED and OTEL_ENABLED):
+        return None
+    if trace is None:
+        logger.warning("OTEL_ENABLED is set but opentelemetry isn't installed.")
+        return None
+    return trace.get_tracer("tokenvaultapi")
+
+
+tracer = create_tracer()
@@ -0,0 +1,129 @@
+"""Backfill the reverse index for existing token documents of the Firestore store.
+
+Run with `python -m tokenvaultapi.migrations.reverse_index`. The backfill is idempotent
+and can be resumed from the last logged document id with `--start-after`.
+
+Entries are only created, never overwritten. Legacy documents of an identity and field
+that have the same token are ambiguous, their entry is removed so that finding them
+falls back to the query, which reports the ambiguity, instead of finding one of them.
+"""
+import argparse
+import asyncio
+from typing import Any, Dict, List
+
+from google.api_core.exceptions import AlreadyExists
+
+from tokenvaultapi.database import create_client
+from tokenvaultapi.keys import reverse_key_of
+from tokenvaultapi.logger import logger
+from tokenvaultapi.stores.codec import V1, V2, VERSION, decode, field_name
+from tokenvaultapi.stores.firestore import FirestoreTokenStore
+
+INDEX_FIELDS = ["identifier", "identity_token", "token", "field"]
+# the stored names of the fields in both schema versions, see tokenvaultapi.stores.codec
+STORED_INDEX_FIELDS = [
+    VERSION,
+    *(field_name(name, version) for version in (V1, V2) for name in INDEX_FIELDS),
+]
+
+
+async def index_page(client: Any, documents: Dict[str, dict]) -> List[str]:
+    """Create the missing reverse index entries of a page of decoded documents by pk.
+
+    Returns the reverse keys that are ambiguous.
+    """
+    batch = client.batch()
+    ambiguous = await index_writes(client, batch, documents)
+    await batch.commit()
+    return ambiguous
+
+
+async def index_writes(
+    client: Any, batch: Any, documents: Dict[str, dict]
+) -> List[str]:
+    """Add the writes of the missing reverse index entries of documents to a batch.
+
+    Entries are created, the batch fails with AlreadyExists if one was created since it
+    was read. Returns the reverse keys that are ambiguous, their entries are deleted.
+    """
+    tokens = client.collection(FirestoreTokenStore.collection_name)
+    index = client.collection(FirestoreTokenStore.index_collection_name)
+    keys = {}
+    ambiguous = set()
+    for pk, data in documents.items():
+        key = reverse_key_of(data)
+        if key in keys:
+            ambiguous.add(key)
+        keys.setdefault(key, pk)
+    entries = {
+        doc.id: doc.get("pk")
+        async for doc in client.get_all([index.document(key) for key in keys])
+        if doc.exists
+    }
+    others = {key: pk for key, pk in entries.items() if pk != keys[key]}
+    if others:
+        # entries of documents that were deleted since are replaced
+        exist = {
+            doc.id
+            async for doc in client.get_all(
+                [tokens.document(pk) for pk in set(others.values())]
+            )
+            if doc.exists
+        }
+        ambiguous |= {key for key, pk in others.items() if pk in exist}
+    for key, pk in keys.items():
+        if key in ambiguous:
+            batch.delete(index.document(key))
+        elif key in others:
+            batch.set(index.document(key), {"pk": pk})
+        elif key not in entries:
+            # fails if the service created the entry since it was read
+            batch.create(index.document(key), {"pk": pk})
+    return sorted(ambiguous)
+
+
+async def backfill(
+    page_size: int = 500, start_after: str = None, client: Any = None
+) -> int:
+    """Create a reverse index entry for every token document, one page at a time.
+
+    Returns the number of documents indexed.
+    """
+    if client is None:
+        client = create_client()
+    tokens = client.collection(FirestoreTokenStore.collection_name)
+    count = 0
+    while True:
+        query = tokens.select(STORED_INDEX_FIELDS).order_by("__name__")
+        query = query.limit(page_size)
+        if start_after:
+            query = query.start_after({"__name__": start_after})
+        documents = {
+            doc.id: decode(doc.id, doc.to_dict()) async for doc in query.stream()
+        }
+        if not documents:
+            return count
+        try:
+            ambiguous = await index_page(client, documents)
+        except AlreadyExists:
+            # the page is read again
+            continue
+        for key in ambiguous:
+            logger.warning(f"Removed the ambiguous reverse index entry {key}")
+        start_after = max(documents)
+        count += len(documents)
+        logger.info(f"Indexed {count} tokens, last document id {start_after}")
+
+
+def main() -> None:
+    """Parse arguments and run the backfill."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--start-after", help="resume after this document id")
+    args = parser.parse_args()
+    count = asyncio.run(backfill(args.page_size, args.start_after))
+    logger.info(f"Backfill done, indexed {count} tokens")
+
+
+if __name__ == "__main__":
+    main()
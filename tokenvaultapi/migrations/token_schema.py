@@ -0,0 +1,115 @@
+"""Migrate the token documents of the Firestore store to the v2 schema.
+
+Run with `python -m tokenvaultapi.migrations.token_schema` while the service keeps
+running. Documents are read in id order and rewritten in batches, at most --rate
+documents per second. The migration is idempotent and can be resumed from the last
+logged document id with `--start-after`.
+
+Every rewrite is conditional on the document not having changed since it was read, so a
+token deleted in the meantime fails its batch, and the batch is read again. The missing
+reverse index entries of the migrated documents are created in the same batch, like the
+backfill of tokenvaultapi.migrations.reverse_index does, entries are never overwritten
+and ambiguous ones are removed. Disable LEGACY_SCHEMA_FALLBACK once a run with
+`--dry-run` finds no v1 documents left.
+"""
+import argparse
+import asyncio
+import time
+from typing import Any, Dict
+
+from google.api_core.exceptions import (AlreadyExists, FailedPrecondition,
+                                        NotFound)
+from google.cloud.firestore_v1 import DELETE_FIELD
+
+from tokenvaultapi.admission import retry
+from tokenvaultapi.database import create_client
+from tokenvaultapi.logger import logger
+from tokenvaultapi.migrations.reverse_index import index_writes
+from tokenvaultapi.stores.codec import V2, VERSION, decode, encode
+from tokenvaultapi.stores.firestore import FirestoreTokenStore
+
+
+def upgrade(pk: str, stored: Dict[str, Any]) -> Dict[str, Any]:
+    """Get the field updates that rewrite a v1 document in v2."""
+    updates = {field: DELETE_FIELD for field in stored}
+    updates.update(encode(decode(pk, stored), V2))
+    return updates
+
+
+async def migrate(
+    page_size: int = 250,
+    start_after: str = None,
+    rate: float = 500,
+    dry_run: bool = False,
+    client: Any = None,
+) -> int:
+    """Rewrite the v1 token documents in v2, one page at a time.
+
+    Pages are written at most rate documents per second. With dry_run set documents are
+    only counted. Returns the number of v1 documents.
+    """
+    if client is None:
+        client = create_client()
+    tokens = client.collection(FirestoreTokenStore.collection_name)
+    started = time.monotonic()
+    count = 0
+    while True:
+        query = tokens.order_by("__name__").limit(page_size)
+        if start_after:
+            query = query.start_after({"__name__": start_after})
+        docs = [doc async for doc in query.stream()]
+        if not docs:
+            return count
+        batch = client.batch()
+        documents = {}
+        for doc in docs:
+            stored = doc.to_dict()
+            if stored.get(VERSION) == V2:
+                continue
+            option = client.write_option(last_update_time=doc.update_time)
+            batch.update(doc.reference, upgrade(doc.id, stored), option=option)
+            documents[doc.id] = decode(doc.id, stored)
+        size = len(documents)
+        if size and not dry_run:
+            ambiguous = await index_writes(client, batch, documents)
+            try:
+                await retry(batch.commit, FirestoreTokenStore.retryable_errors)
+            except (AlreadyExists, FailedPrecondition, NotFound):
+                logger.info(f"Documents after {start_after} changed, read them again")
+                continue
+            for key in ambiguous:
+                logger.warning(f"Removed the ambiguous reverse index entry {key}")
+        count += size
+        start_after = docs[-1].id
+        logger.info(
+            f"{'Found' if dry_run else 'Migrated'} {count} v1 tokens,"
+            f" last document id {start_after}"
+        )
+        # paces the writes to rate documents per second on average
+        if size and not dry_run:
+            await asyncio.sleep(max(0, started + count / rate - time.monotonic()))
+
+
+def main() -> None:
+    """Parse arguments and run the migration."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--page-size", type=int, default=250)
+    parser.add_argument("--start-after", help="resume after this document id")
+    parser.add_argument(
+        "--rate", type=float, default=500, help="maximum documents written per second"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only count the v1 documents"
+    )
+    args = parser.parse_args()
+    count = asyncio.run(
+        migrate(args.page_size, args.start_after, args.rate, args.dry_run)
+    )
+    if args.dry_run:
+        logger.info(f"Found {count} v1 tokens")
+    else:
+        logger.info(f"Migration done, migrated {count} tokens")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Request, Response, status
 
 from tokenvaultapi import __version__
 from tokenvaultapi.logger import logger
@@ -10,8 +10,12 @@ router = APIRouter()
 
 
 @router.get("/healthcheck", response_model=HealthcheckResponse, tags=["health"])
-def healthcheck() -> HealthcheckResponse:
+def healthcheck(request: Request, response: Response) -> HealthcheckResponse:
+    # 503 until the lifespan has warmed the token store up, see tokenvaultapi.main
     message = "healthy"
+    if not getattr(request.app.state, "ready", True):
+        message = "starting"
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
     logger.debug(message)
     return HealthcheckResponse(
         message=message,
@@ -0,0 +1,19 @@
+"""Job router."""
+from fastapi import APIRouter, Depends, HTTPException
+
+from tokenvaultapi.dependencies import get_job_service
+from tokenvaultapi.schemas.job import Job
+from tokenvaultapi.services.job import JobService
+
+router = APIRouter()
+
+
+@router.get("/jobs/{job_id}", response_model=Job, tags=["job"])
+async def get_job(
+    job_id: str, job_service: JobService = Depends(get_job_service)
+) -> Job:
+    """Get the status of a background job."""
+    job = await job_service.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
@@ -0,0 +1,15 @@
+"""Metrics router."""
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from tokenvaultapi.metrics import registry
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse, tags=["health"])
+def metrics() -> PlainTextResponse:
+    """Metrics of this worker in the Prometheus text format."""
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
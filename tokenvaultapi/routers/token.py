@@ -1,60 +1,121 @@
 """Token router."""
-import hashlib
-from typing import List
-from uuid import UUID
+from typing import List, Union
 
-from fastapi import APIRouter, Body, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import (APIRouter, BackgroundTasks, Body, Depends, HTTPException,
+                     Query, Request, Response)
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 
+from tokenvaultapi.admission import Overloaded
+from tokenvaultapi.config import LIST_MAX_PAGE_SIZE, LIST_PAGE_SIZE
+from tokenvaultapi.dependencies import get_token_service
+from tokenvaultapi.keys import derive_key
+from tokenvaultapi.metrics import timer
+from tokenvaultapi.schemas.job import Job
 from tokenvaultapi.schemas.token import (RemoteFunctionTokenRequest,
                                          RemoteFunctionTokenResponse, Token,
                                          TokenCreate, TokenFind)
+from tokenvaultapi.serialization import (RemoteFunctionResponse, dumps,
+                                         json_array,
+                                         parse_remote_function_request)
 from tokenvaultapi.services.token import TokenService
+from tokenvaultapi.stores.base import TOKEN_FIELDS
+from tokenvaultapi.streaming import (DuplexStreamingResponse, peek,
+                                     stream_format)
 
 router = APIRouter()
-token_service = TokenService()
 
 
-def create_uuid_from_list(_list: list) -> str:
-    """Create a UUID from a list of values."""
-    val = " ".join(map(str, _list))
-    hex_string = hashlib.md5(val.encode("UTF-8")).hexdigest()
-    return str(UUID(hex=hex_string))
-
-
-def create_uuid_from_string(val: str) -> str:
-    """Create a UUID from a string."""
-    hex_string = hashlib.md5(val.encode("UTF-8")).hexdigest()
-    return str(UUID(hex=hex_string))
-
-
-@router.post("/", response_model=RemoteFunctionTokenResponse, tags=["token"])
+@router.post(
+    "/",
+    response_model=RemoteFunctionTokenResponse,
+    tags=["token"],
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "application/json": {"schema": RemoteFunctionTokenRequest.schema()}
+            },
+            "required": True,
+        }
+    },
+)
 async def batch_token(
-    batch: RemoteFunctionTokenRequest = Body(...),
-) -> RemoteFunctionTokenResponse:
-    """Batch tokenization."""
+    request: Request, token_service: TokenService = Depends(get_token_service)
+) -> Response:
+    """Batch tokenization.
+
+    The body is parsed and the replies rendered without pydantic models per call, see
+    tokenvaultapi.serialization.
+    """
+    body = await request.body()
     try:
-        return await token_service.remote_function_request(batch)
+        with timer("parse"):
+            batch = parse_remote_function_request(body)
+    except ValueError as e:
+        return JSONResponse(status_code=422, content={"detail": str(e)})
+    try:
+        response = await token_service.remote_function_request(batch)
+    except Overloaded:
+        # answered with a 429 or 503 that BigQuery retries, see tokenvaultapi.main
+        raise
     except Exception as e:
         return JSONResponse(status_code=400, content={"error": str(e)})
+    if response is None:
+        return JSONResponse(status_code=400, content={"error": "Unknown action."})
+    with timer("render", len(response.replies)):
+        return RemoteFunctionResponse(content={"replies": response.replies})
+
+
+@router.post("/stream", response_class=StreamingResponse, tags=["token"])
+async def stream_tokens(
+    request: Request,
+    action: str,
+    tokenType: str = "STRING",
+    method: Union[str, None] = None,
+    token_service: TokenService = Depends(get_token_service),
+) -> StreamingResponse:
+    """Streaming bulk tokenization of NDJSON, or CSV with content type text/csv.
+
+    Every row is a call as in batch tokenization, the response has one reply per row.
+    """
+    if action not in ("DEIDENTIFY", "REIDENTIFY"):
+        raise HTTPException(status_code=400, detail="Unknown action.")
+    context = {"action": action, "tokenType": tokenType}
+    if method:
+        context["method"] = method
+    rows_format = stream_format(request.headers.get("content-type", ""))
+    return DuplexStreamingResponse(
+        token_service.stream_request(request.stream(), context, rows_format),
+        media_type=rows_format.media_type,
+    )
 
 
 @router.post("/token", response_model=Token, tags=["token"])
-async def create_token(token_create: TokenCreate = Body(...)) -> Token:
+async def create_token(
+    token_create: TokenCreate = Body(...),
+    token_service: TokenService = Depends(get_token_service),
+) -> Token:
     """Create a multi-use token."""
-    token_create.pk = create_uuid_from_list(
-        [
-            token_create.identifier,
-            token_create.identity,
-            token_create.value,
-            token_create.field,
-        ]
-    )
-    return await token_service.create_token(token_create)
+    values = [
+        token_create.identifier,
+        token_create.identity,
+        token_create.value,
+        token_create.field,
+    ]
+    if await token_service.get_token_by_values(values):
+        raise HTTPException(status_code=409, detail="Token already exists.")
+    token_create.pk = derive_key(values)
+    try:
+        return await token_service.create_token(token_create)
+    except ValueError as e:
+        # values format preserving encryption can't encrypt
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @router.get("/token/{pk}", response_model=Token, tags=["token"])
-async def get_token(pk: str) -> Token:
+async def get_token(
+    pk: str, token_service: TokenService = Depends(get_token_service)
+) -> Token:
     """Get a token by primary key."""
     token = await token_service.get_token(pk)
     if not token:
@@ -67,10 +128,14 @@ async def get_token(pk: str) -> Token:
     response_model=Token,
     tags=["token"],
 )
-async def get_token_by_value(identifier: str, identity: str, value: str) -> Token:
+async def get_token_by_value(
+    identifier: str,
+    identity: str,
+    value: str,
+    token_service: TokenService = Depends(get_token_service),
+) -> Token:
     """Get a token by identifier, identity, and value."""
-    pk = create_uuid_from_list([identifier, identity, value])
-    token = await token_service.get_token(pk)
+    token = await token_service.get_token_by_values([identifier, identity, value])
     if not token:
         raise HTTPException(status_code=404, detail="Token not found.")
     return token
@@ -82,18 +147,26 @@ async def get_token_by_value(identifier: str, identity: str, value: str) -> Toke
     tags=["token"],
 )
 async def get_token_by_value_field(
-    identifier: str, identity: str, value: str, field: str
+    identifier: str,
+    identity: str,
+    value: str,
+    field: str,
+    token_service: TokenService = Depends(get_token_service),
 ) -> Token:
     """Get a token by identifier, identity, value, and field."""
-    pk = create_uuid_from_list([identifier, identity, value, field])
-    token = await token_service.get_token(pk)
+    token = await token_service.get_token_by_values(
+        [identifier, identity, value, field]
+    )
     if not token:
         raise HTTPException(status_code=404, detail="Token not found.")
     return token
 
 
 @router.post("/token/find", response_model=Token, tags=["token"])
-async def get_token_by_identifier(token_find: TokenFind = Body(...)) -> Token:
+async def get_token_by_identifier(
+    token_find: TokenFind = Body(...),
+    token_service: TokenService = Depends(get_token_service),
+) -> Token:
     """Find a token by identifier, identity, and token."""
     token = await token_service.find_token(token_find)
     if not token:
@@ -103,15 +176,71 @@ async def get_token_by_identifier(token_find: TokenFind = Body(...)) -> Token:
 
 @router.get(
     "/tokens/identifier/{identifier}/identity/{identity}",
-    response_model=List[Token],
+    # pages and streams are rendered without the model, and fields may leave it out
+    response_model=None,
+    responses={
+        200: {
+            "model": List[Token],
+            "description": (
+                "A page of tokens, or with stream set every token after start_after,"
+                " written as one JSON array while they are read."
+            ),
+            "headers": {
+                "X-Next-Cursor": {
+                    "description": (
+                        "The pk of the last token of a page that more tokens follow,"
+                        " the start_after of the next page. Not set with stream."
+                    ),
+                    "schema": {"type": "string"},
+                }
+            },
+        }
+    },
     tags=["token"],
 )
-async def list_tokens(identifier: str, identity: str) -> List[Token]:
-    """List all tokens for an identifier and identity."""
-    tokens = await token_service.list_tokens(identifier, identity)
-    if not tokens:
+async def list_tokens(
+    identifier: str,
+    identity: str,
+    limit: Union[int, None] = Query(None, ge=1, le=LIST_MAX_PAGE_SIZE),
+    start_after: Union[str, None] = None,
+    fields: Union[str, None] = None,
+    stream: bool = False,
+    token_service: TokenService = Depends(get_token_service),
+) -> Response:
+    """List the tokens for an identifier and identity, a page at a time in pk order.
+
+    Pages have limit tokens, LIST_PAGE_SIZE if it isn't given. When more tokens follow
+    a page the pk of its last token is returned in the X-Next-Cursor header, pass it as
+    start_after to get the next page. fields is a comma separated list of the fields to
+    return besides the pk. With stream set the tokens are written as they are read
+    instead, all of them unless limit is given.
+    """
+    field_names = None
+    if fields:
+        field_names = list(dict.fromkeys(field.strip() for field in fields.split(",")))
+        if not set(field_names) <= TOKEN_FIELDS:
+            raise HTTPException(status_code=422, detail="Unknown fields.")
+    if stream:
+        tokens = token_service.scan_tokens(
+            identifier, identity, field_names, start_after, limit
+        )
+        first, tokens = await peek(tokens)
+        if first is None and not start_after:
+            raise HTTPException(status_code=404, detail="Tokens not found.")
+        return StreamingResponse(json_array(tokens), media_type="application/json")
+    limit = limit or LIST_PAGE_SIZE
+    # one token more than the page, to know if another page follows
+    tokens = token_service.scan_tokens(
+        identifier, identity, field_names, start_after, limit + 1
+    )
+    page = [token async for token in tokens]
+    if not page and not start_after:
         raise HTTPException(status_code=404, detail="Tokens not found.")
-    return tokens
+    headers = None
+    if len(page) > limit:
+        page = page[:limit]
+        headers = {"X-Next-Cursor": page[-1]["pk"]}
+    return Response(dumps(page), media_type="application/json", headers=headers)
 
 
 @router.delete(
@@ -119,17 +248,23 @@ async def list_tokens(identifier: str, identity: str) -> List[Token]:
     status_code=204,
     tags=["token"],
 )
-async def delete_token_by_value(identifier: str, identity: str, value: str):
+async def delete_token_by_value(
+    identifier: str,
+    identity: str,
+    value: str,
+    token_service: TokenService = Depends(get_token_service),
+):
     """Delete a token."""
-    pk = create_uuid_from_list([identifier, identity, value])
-    token = await token_service.get_token(pk)
+    token = await token_service.get_token_by_values([identifier, identity, value])
     if not token:
         raise HTTPException(status_code=404, detail="Token not found.")
-    await token_service.delete_token(pk)
+    await token_service.delete_token(token.pk)
 
 
 @router.delete("/token/{pk}", status_code=204, tags=["token"])
-async def delete_token(pk: str):
+async def delete_token(
+    pk: str, token_service: TokenService = Depends(get_token_service)
+):
     """Delete a token."""
     token = await token_service.get_token(pk)
     if not token:
@@ -141,11 +276,32 @@ async def delete_token(pk: str):
     "/tokens/identifier/{identifier}/identity/{identity}",
     status_code=204,
     tags=["token"],
+    responses={202: {"model": Job}},
 )
-async def delete_tokens(identifier: str, identity: str):
-    """Delete all tokens for an identifier and identity."""
-    tokens = await token_service.list_tokens(identifier, identity)
-    if not tokens:
+async def delete_tokens(
+    identifier: str,
+    identity: str,
+    background_tasks: BackgroundTasks,
+    background: bool = False,
+    token_service: TokenService = Depends(get_token_service),
+) -> Response:
+    """Delete all tokens for an identifier and identity.
+
+    The number of deleted tokens is returned in the X-Deleted-Count header. With
+    background set the tokens are deleted by a background job instead, whose status is
+    returned and can be followed at /jobs/{job_id}.
+    """
+    if background:
+        job = await token_service.start_delete_identity()
+        background_tasks.add_task(
+            token_service.run_delete_identity, job.id, identifier, identity
+        )
+        return JSONResponse(
+            status_code=202,
+            content=jsonable_encoder(job),
+            headers={"Location": f"/jobs/{job.id}"},
+        )
+    count = await token_service.delete_identity(identifier, identity)
+    if not count:
         raise HTTPException(status_code=404, detail="Tokens not found.")
-    for token in tokens:
-        await token_service.delete_token(token.pk)
+    return Response(status_code=204, headers={"X-Deleted-Count": str(count)})
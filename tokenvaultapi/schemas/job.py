@@ -0,0 +1,34 @@
+"""Job schemas."""
+from datetime import datetime
+from typing import Union
+
+from pydantic import BaseModel
+
+
+class Job(BaseModel):
+    """Background job."""
+
+    id: str
+    kind: str
+    # pending, running, done or failed
+    status: str = "pending"
+    # number of items processed so far, e.g. deleted tokens
+    count: int = 0
+    error: Union[str, None] = None
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        """Config for job."""
+
+        schema_extra = {
+            "example": {
+                "id": "5f0c6e4c9a6b4e0f8a3d2b1c0e9f8a7b",
+                "kind": "delete_identity",
+                "status": "running",
+                "count": 2500,
+                "error": None,
+                "created_at": "2023-09-01T12:00:00",
+                "updated_at": "2023-09-01T12:00:05",
+            }
+        }
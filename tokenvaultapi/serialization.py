@@ -0,0 +1,107 @@
+"""Fast parsing and rendering of remote function requests and responses.
+
+Request bodies are parsed with orjson when it is installed, and validated in one pass
+with the rules of RemoteFunctionTokenRequest instead of by pydantic value by value.
+Replies, and the tokens of listings, are rendered with orjson as well.
+"""
+import json
+from datetime import datetime
+from typing import Any, AsyncIterator
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from tokenvaultapi.schemas.token import RemoteFunctionTokenRequest
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# response class of replies, orjson if it is installed
+RemoteFunctionResponse = JSONResponse if orjson is None else ORJSONResponse
+
+CALL_VALUE_TYPES = {str, int, float, type(None)}
+
+
+def loads(data: bytes) -> Any:
+    """Parse JSON, with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_default(value: Any) -> Any:
+    """Render the values json can't, like pydantic renders them."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable.")
+
+
+def dumps(data: Any) -> bytes:
+    """Render JSON, with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, default=json_default, separators=(",", ":")).encode()
+
+
+async def json_array(items: AsyncIterator[Any], size: int = 100) -> AsyncIterator[bytes]:
+    """Render items as one JSON array, written in parts of size items."""
+    opening = b"["
+    part = []
+    async for item in items:
+        part.append(dumps(item))
+        if len(part) == size:
+            yield opening + b",".join(part)
+            opening, part = b",", []
+    yield (opening + b",".join(part) if part or opening == b"[" else b"") + b"]"
+
+
+def string(value: Any, name: str) -> str:
+    """Validate a string like pydantic does, numbers are converted to strings."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        return str(value)
+    raise ValueError(f"{name} must be a string.")
+
+
+def call_value(value: Any, name: str) -> Any:
+    """Validate a call value that is not a string, number or null."""
+    if isinstance(value, bool):
+        # neither a strict int nor a strict float, so pydantic makes it a string
+        return str(value)
+    raise ValueError(f"{name} must be null, a number or a string.")
+
+
+def parse_remote_function_request(body: bytes) -> RemoteFunctionTokenRequest:
+    """Parse and validate a remote function request body.
+
+    Raises ValueError if the body is not a valid request.
+    """
+    data = loads(body)
+    if not isinstance(data, dict):
+        raise ValueError("Request must be an object.")
+    fields = {
+        name: string(data.get(name), name)
+        for name in ("requestId", "caller", "sessionUser")
+    }
+    context = data.get("userDefinedContext")
+    if context is not None:
+        if not isinstance(context, dict):
+            raise ValueError("userDefinedContext must be an object.")
+        context = {
+            key: string(value, f"userDefinedContext.{key}")
+            for key, value in context.items()
+        }
+    calls = data.get("calls")
+    if not isinstance(calls, list):
+        raise ValueError("calls must be a list.")
+    for i, call in enumerate(calls):
+        if not isinstance(call, list):
+            raise ValueError(f"calls[{i}] must be a list.")
+        for j, value in enumerate(call):
+            if type(value) not in CALL_VALUE_TYPES:
+                call[j] = call_value(value, f"calls[{i}][{j}]")
+    return RemoteFunctionTokenRequest.construct(
+        **fields, userDefinedContext=context, calls=calls
+    )
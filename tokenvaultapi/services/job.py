@@ -0,0 +1,14 @@
+"""Job Service"""
+from tokenvaultapi.daos.jobs import JobDAO
+from tokenvaultapi.schemas.job import Job
+
+
+class JobService:
+    """Job Service"""
+
+    def __init__(self, job_dao: JobDAO = None) -> None:
+        self.job_dao = job_dao if job_dao is not None else JobDAO()
+
+    async def get_job(self, job_id: str) -> Job:
+        """Get a job."""
+        return await self.job_dao.get(job_id)
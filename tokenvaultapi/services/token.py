@@ -1,37 +1,84 @@
 """Token Service"""
-from typing import List
+from typing import AsyncIterator, Dict, List, Sequence
 from uuid import UUID
 
+from tokenvaultapi.config import STREAM_CHUNK_SIZE
+from tokenvaultapi.daos.jobs import JobDAO
 from tokenvaultapi.daos.tokens import TokenDAO
+from tokenvaultapi.logger import logger
+from tokenvaultapi.schemas.job import Job
 from tokenvaultapi.schemas.token import (RemoteFunctionTokenRequest,
                                          RemoteFunctionTokenResponse, Token,
                                          TokenCreate, TokenFind)
-
-token_dao = TokenDAO()
+from tokenvaultapi.streaming import StreamFormat, tokenize_stream
 
 
 class TokenService:
     """Token Service"""
 
+    def __init__(self, token_dao: TokenDAO = None, job_dao: JobDAO = None) -> None:
+        self.token_dao = token_dao if token_dao is not None else TokenDAO()
+        self.job_dao = job_dao if job_dao is not None else JobDAO(self.token_dao.store)
+
     async def create_token(self, token_create: TokenCreate) -> Token:
         """Create a token."""
-        return await token_dao.create(token_create)
+        return await self.token_dao.create(token_create)
 
     async def get_token(self, pk: UUID) -> Token:
         """Get a token."""
-        return await token_dao.get(pk)
+        return await self.token_dao.get(pk)
+
+    async def get_token_by_values(self, values: Sequence) -> Token:
+        """Get a token by the values its primary key is derived from."""
+        return await self.token_dao.get_by_values(values)
 
     async def list_tokens(self, identifier: str, identity: str) -> List[Token]:
         """List tokens."""
-        return await token_dao.list(identifier, identity)
+        return await self.token_dao.list(identifier, identity)
+
+    def scan_tokens(
+        self,
+        identifier: str,
+        identity: str,
+        fields: List[str] = None,
+        start_after: str = None,
+        limit: int = None,
+    ) -> AsyncIterator[dict]:
+        """Stream a page of tokens in pk order, as dicts of their fields."""
+        return self.token_dao.scan(identifier, identity, fields, start_after, limit)
 
     async def delete_token(self, pk: UUID) -> UUID:
         """Delete a token."""
-        return await token_dao.delete(pk)
+        return await self.token_dao.delete(pk)
+
+    async def delete_identity(self, identifier: str, identity: str) -> int:
+        """Delete all tokens of an identity, returns the number of deleted tokens."""
+        return await self.token_dao.delete_identity(identifier, identity)
+
+    async def start_delete_identity(self) -> Job:
+        """Create the job of deleting all tokens of an identity in the background."""
+        return await self.job_dao.create("delete_identity")
+
+    async def run_delete_identity(
+        self, job_id: str, identifier: str, identity: str
+    ) -> None:
+        """Delete all tokens of an identity, recording progress in a job."""
+
+        async def progress(count: int) -> None:
+            await self.job_dao.update(job_id, count=count)
+
+        await self.job_dao.update(job_id, status="running")
+        try:
+            count = await self.token_dao.delete_identity(identifier, identity, progress)
+        except Exception as e:
+            logger.exception(f"Job {job_id} failed.")
+            await self.job_dao.update(job_id, status="failed", error=str(e))
+        else:
+            await self.job_dao.update(job_id, status="done", count=count)
 
     async def find_token(self, token_find: TokenFind) -> Token:
         """Find a token."""
-        return await token_dao.find(token_find)
+        return await self.token_dao.find(token_find)
 
     async def remote_function_request(
         self, request: RemoteFunctionTokenRequest
@@ -41,7 +88,37 @@ class TokenService:
         user_defined_context = request.userDefinedContext
         action = user_defined_context["action"]
         if action == "DEIDENTIFY":
-            return await token_dao.deidentify(request)
+            return await self.token_dao.deidentify(request)
         if action == "REIDENTIFY":
-            return await token_dao.reidentify(request)
+            return await self.token_dao.reidentify(request)
         return None
+
+    def stream_request(
+        self,
+        stream: AsyncIterator[bytes],
+        context: Dict[str, str],
+        stream_format: StreamFormat,
+    ) -> AsyncIterator[bytes]:
+        """Streaming request, the context is like the userDefinedContext of remote \
+        function requests."""
+        data_type = context.get("tokenType", "STRING")
+        if context["action"] == "DEIDENTIFY":
+            method = context.get("method", "FORMAT_PRESERVING")
+            # identity tokens shared between chunks, about the last chunk's worth
+            identities = {}
+
+            async def process(calls: List[list]) -> list:
+                if len(identities) > STREAM_CHUNK_SIZE:
+                    identities.clear()
+                return await self.token_dao.deidentify_calls(
+                    calls, data_type, method, identities
+                )
+
+        else:
+
+            async def process(calls: List[list]) -> list:
+                return await self.token_dao.reidentify_calls(
+                    calls, data_type, context.get("method")
+                )
+
+        return tokenize_stream(stream, stream_format, process)
@@ -0,0 +1,93 @@
+"""Coalescing of concurrent calls for the same keys.
+
+When parallel batches contain the same rows, concurrent callers look up and create the
+same tokens. A single flight runs one call per key at a time; callers that ask for a
+key that is already in flight wait for that call's result instead of making their own.
+Results are not kept once the call is done, that's what the cache is for.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, List
+
+# result of keys that a call returned no result for
+_MISSING = object()
+
+
+class SingleFlight:
+    """In-process single flight of calls by key."""
+
+    def __init__(self) -> None:
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    def in_flight(self) -> int:
+        """Get the number of keys in flight."""
+        return len(self._calls)
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """Call func for key, or wait for the call of key in flight."""
+
+        async def call(keys: List[str]) -> Dict[str, Any]:
+            return {key: await func()}
+
+        results = await self.do_many([key], call)
+        return results.get(key)
+
+    async def do_many(
+        self,
+        keys: Iterable[str],
+        func: Callable[[List[str]], Awaitable[Dict[str, Any]]],
+    ) -> Dict[str, Any]:
+        """Call func once for the keys that are not in flight, and wait for the rest.
+
+        func gets the keys to call for and returns the results by key, keys can be left
+        out if they have no result. Returns the results of all keys. Errors of a call are
+        raised to all callers waiting for it, keys whose call was cancelled are called
+        for again.
+        """
+        keys = list(dict.fromkeys(keys))
+        waiting = {key: self._calls[key] for key in keys if key in self._calls}
+        own = [key for key in keys if key not in waiting]
+        results = {}
+        if own:
+            results.update(await self._call(own, func))
+        retry = []
+        for key, future in waiting.items():
+            try:
+                # the caller being cancelled must not cancel the shared call
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                retry.append(key)
+                continue
+            if result is not _MISSING:
+                results[key] = result
+        if retry:
+            results.update(await self.do_many(retry, func))
+        return results
+
+    async def _call(
+        self, keys: List[str], func: Callable[[List[str]], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        """Call func for keys, publishing the results to callers waiting for them."""
+        loop = asyncio.get_running_loop()
+        futures = {key: loop.create_future() for key in keys}
+        self._calls.update(futures)
+        try:
+            results = await func(keys)
+        except asyncio.CancelledError:
+            for future in futures.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in futures.values():
+                future.set_exception(e)
+                # retrieved here, there may be no other callers to retrieve it
+                future.exception()
+            raise
+        else:
+            for key, future in futures.items():
+                future.set_result(results.get(key, _MISSING))
+            return results
+        finally:
+            for key in keys:
+                del self._calls[key]
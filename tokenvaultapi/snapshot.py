@@ -0,0 +1,357 @@
+"""Memory-mapped snapshots of token documents, a local replica for read-heavy traffic.
+
+Reidentify traffic on hot identifiers reads the same tokens over and over. A snapshot
+exports the token documents, of all identifiers or of selected ones, into a file that
+every worker maps read-only at startup, so the pages are shared by the workers of a
+node through the page cache. Tokens are then read from local memory, and only misses
+are read from the store.
+
+The file has a header, a JSON metadata block, the documents sorted by pk as length
+prefixed JSON arrays of their fields, and two open addressing hash tables of 16 byte
+slots, of the pk and of the reverse index key of every document. Each slot has a
+64-bit hash of the key and the offset of its document.
+
+Each worker keeps the documents created since the snapshot and the tombstones of the
+documents deleted since, refreshed every SNAPSHOT_REFRESH_SECONDS from the created_at
+and deleted_at watermarks. Deleted documents are hidden as soon as the worker that
+deletes them does so, and by the other workers at their next refresh. Re-export the
+snapshot periodically, e.g. with --incremental, to keep the refreshes small; workers
+reopen the file when it is replaced.
+
+Export with `python -m tokenvaultapi.snapshot --path tokens.snapshot`.
+"""
+import argparse
+import asyncio
+import hashlib
+import mmap
+import os
+import struct
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Iterator, List
+
+from tokenvaultapi.config import (SNAPSHOT_PATH,
+                                  SNAPSHOT_REFRESH_OVERLAP_SECONDS,
+                                  SNAPSHOT_REFRESH_SECONDS)
+from tokenvaultapi.keys import reverse_key_of
+from tokenvaultapi.logger import logger
+from tokenvaultapi.schemas.token import Token
+from tokenvaultapi.serialization import dumps, loads
+from tokenvaultapi.stores.base import TokenStore, token_from_dict
+
+MAGIC = b"TVSNAP01"
+# magic and length of the metadata
+HEADER = struct.Struct("<8sI")
+# hash of the key and offset of the document plus one, 0 for an empty slot
+SLOT = struct.Struct("<QQ")
+LENGTH = struct.Struct("<I")
+FIELDS = list(Token.__fields__)
+EPOCH = datetime(1970, 1, 1)
+
+
+def key_hash(key: str) -> int:
+    """Hash a key to 64 bits."""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+
+def utc(value: datetime) -> datetime:
+    """Convert a datetime to naive UTC, naive datetimes are UTC already."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def encode(data: dict) -> bytes:
+    """Encode a document as a length prefixed JSON array of its fields."""
+    values = [data.get(field) for field in FIELDS]
+    values[FIELDS.index("created_at")] = utc(data["created_at"]).isoformat()
+    record = dumps(values)
+    return LENGTH.pack(len(record)) + record
+
+
+def build_index(keys: List[tuple]) -> bytes:
+    """Build a hash table of (key, offset) with linear probing, at most half full."""
+    slots = 2
+    while slots < 2 * len(keys):
+        slots *= 2
+    table = bytearray(slots * SLOT.size)
+    for key, offset in keys:
+        hashed = key_hash(key)
+        slot = hashed & (slots - 1)
+        while SLOT.unpack_from(table, slot * SLOT.size)[1]:
+            slot = (slot + 1) & (slots - 1)
+        SLOT.pack_into(table, slot * SLOT.size, hashed, offset + 1)
+    return bytes(table)
+
+
+def write_snapshot(
+    path: str,
+    documents: Iterable[dict],
+    exported_at: datetime,
+    identifiers: List[str] = None,
+) -> int:
+    """Write documents to a snapshot file, replacing it atomically.
+
+    exported_at is when the documents started to be read, the time tombstones are
+    read from. Returns the number of documents.
+    """
+    documents = sorted(documents, key=lambda data: data["pk"])
+    records = bytearray()
+    pks, keys = [], []
+    watermark = EPOCH
+    for data in documents:
+        pks.append((data["pk"], len(records)))
+        keys.append((reverse_key_of(data), len(records)))
+        watermark = max(watermark, utc(data["created_at"]))
+        records += encode(data)
+    pk_index = build_index(pks)
+    key_index = build_index(keys)
+    metadata = dumps(
+        {
+            "count": len(documents),
+            "watermark": watermark.isoformat(),
+            "exported_at": utc(exported_at).isoformat(),
+            "identifiers": identifiers,
+            "pk_index": len(records),
+            "key_index": len(records) + len(pk_index),
+            "slots": len(pk_index) // SLOT.size,
+        }
+    )
+    temporary = f"{path}.tmp"
+    # documents have values, only the owner may read them
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(metadata)) + metadata)
+        f.write(records)
+        f.write(pk_index)
+        f.write(key_index)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    return len(documents)
+
+
+class Snapshot:
+    """A read-only memory-mapped snapshot file."""
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a token snapshot.")
+        metadata = loads(self._map[HEADER.size : HEADER.size + length])
+        self.count = metadata["count"]
+        self.watermark = datetime.fromisoformat(metadata["watermark"])
+        self.exported_at = datetime.fromisoformat(metadata["exported_at"])
+        self.identifiers = metadata["identifiers"]
+        self._records = HEADER.size + length
+        self._slots = metadata["slots"]
+        self._pk_index = self._records + metadata["pk_index"]
+        self._key_index = self._records + metadata["key_index"]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[dict]:
+        """Iterate the documents in pk order."""
+        offset = self._records
+        while offset < self._pk_index:
+            yield self._read(offset)
+            offset += LENGTH.size + LENGTH.unpack_from(self._map, offset)[0]
+
+    def __enter__(self) -> "Snapshot":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def get(self, pk: str) -> dict:
+        """Get a document by pk, or None."""
+        return self._lookup(self._pk_index, pk, lambda data: data["pk"])
+
+    def find(self, key: str) -> dict:
+        """Find a document by reverse index key, or None."""
+        return self._lookup(self._key_index, key, reverse_key_of)
+
+    def close(self) -> None:
+        """Unmap the file."""
+        self._map.close()
+
+    def _lookup(self, index: int, key: str, key_of: Any) -> dict:
+        """Look a key up in a hash table, verifying the key of the document."""
+        hashed = key_hash(key)
+        slot = hashed & (self._slots - 1)
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self._map, index + slot * SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == hashed:
+                data = self._read(self._records + offset - 1)
+                if key_of(data) == key:
+                    return data
+            slot = (slot + 1) & (self._slots - 1)
+
+    def _read(self, offset: int) -> dict:
+        """Read the document at an offset."""
+        (length,) = LENGTH.unpack_from(self._map, offset)
+        start = offset + LENGTH.size
+        data = dict(zip(FIELDS, loads(self._map[start : start + length])))
+        data["created_at"] = datetime.fromisoformat(data["created_at"])
+        return data
+
+
+class SnapshotReplica:
+    """A snapshot with the documents created and deleted since it was exported."""
+
+    def __init__(
+        self, path: str, overlap: float = SNAPSHOT_REFRESH_OVERLAP_SECONDS
+    ) -> None:
+        self.path = path
+        # documents are committed after their created_at, refreshes read back this far
+        self.overlap = timedelta(seconds=overlap)
+        self.snapshot: Snapshot = None
+        self._open()
+
+    def _open(self) -> None:
+        """Map the snapshot file and forget what was refreshed since the last one."""
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = Snapshot(self.path)
+        self.inode = os.stat(self.path).st_ino
+        # documents created since the snapshot by pk, and their pks by reverse key
+        self.documents: Dict[str, dict] = {}
+        self.index: Dict[str, str] = {}
+        # times documents were deleted at by pk
+        self.deleted: Dict[str, datetime] = {}
+        self.created_watermark = self.snapshot.watermark
+        self.deleted_watermark = self.snapshot.exported_at
+
+    def get_many(self, pks: Iterable[str]) -> Dict[str, Token]:
+        """Get tokens by pk, those that are not in the replica are left out."""
+        tokens = {}
+        for pk in pks:
+            data = self.documents.get(pk) or self.snapshot.get(pk)
+            if data is not None and self._visible(data):
+                tokens[pk] = token_from_dict(data)
+        return tokens
+
+    def find_many(self, keys: Iterable[str]) -> Dict[str, Token]:
+        """Find tokens by reverse index key, those not in the replica are left out."""
+        tokens = {}
+        for key in keys:
+            pk = self.index.get(key)
+            data = self.documents[pk] if pk else self.snapshot.find(key)
+            if data is not None and self._visible(data):
+                tokens[key] = token_from_dict(data)
+        return tokens
+
+    def forget(self, documents: Iterable[dict]) -> None:
+        """Hide deleted documents until the next refresh reads their tombstones."""
+        deleted_at = datetime.utcnow()
+        for data in documents:
+            self.deleted[data["pk"]] = deleted_at
+
+    async def refresh(self, store: TokenStore) -> int:
+        """Read the documents created and deleted since the last refresh.
+
+        The snapshot is reopened first if its file was replaced. Returns the number of
+        documents and tombstones read.
+        """
+        if os.stat(self.path).st_ino != self.inode:
+            self._open()
+        count = 0
+        created_after = self.created_watermark - self.overlap
+        identifiers = self.snapshot.identifiers
+        async for data in store.scan_since(created_after, identifiers):
+            data["created_at"] = utc(data["created_at"])
+            self.documents[data["pk"]] = data
+            self.index[reverse_key_of(data)] = data["pk"]
+            self.created_watermark = max(self.created_watermark, data["created_at"])
+            count += 1
+        async for tombstone in store.deleted_since(
+            self.deleted_watermark - self.overlap
+        ):
+            deleted_at = utc(tombstone["deleted_at"])
+            pk = tombstone["pk"]
+            self.deleted[pk] = max(deleted_at, self.deleted.get(pk, deleted_at))
+            self.deleted_watermark = max(self.deleted_watermark, deleted_at)
+            count += 1
+        return count
+
+    def _visible(self, data: dict) -> bool:
+        """Whether a document wasn't deleted, or was created again after."""
+        deleted_at = self.deleted.get(data["pk"])
+        return deleted_at is None or data["created_at"] > deleted_at
+
+
+async def refresh_forever(
+    replica: SnapshotReplica,
+    store: TokenStore,
+    interval: float = SNAPSHOT_REFRESH_SECONDS,
+) -> None:
+    """Refresh a replica every interval seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await replica.refresh(store)
+        except Exception:
+            logger.exception("Refreshing the token snapshot failed")
+
+
+async def export(
+    store: TokenStore,
+    path: str,
+    identifiers: List[str] = None,
+    incremental: bool = False,
+    overlap: float = SNAPSHOT_REFRESH_OVERLAP_SECONDS,
+) -> int:
+    """Export the documents of the store, of identifiers if given, to a snapshot.
+
+    With incremental set and an existing snapshot only the documents created and
+    deleted since it are read, for the identifiers of the snapshot. Returns the number
+    of documents.
+    """
+    exported_at = datetime.utcnow()
+    documents = {}
+    created_after = None
+    if incremental and os.path.exists(path):
+        with Snapshot(path) as snapshot:
+            documents = {data["pk"]: data for data in snapshot}
+            identifiers = snapshot.identifiers
+            created_after = snapshot.watermark - timedelta(seconds=overlap)
+            deleted_after = snapshot.exported_at - timedelta(seconds=overlap)
+        async for tombstone in store.deleted_since(deleted_after):
+            data = documents.get(tombstone["pk"])
+            if data is not None and data["created_at"] <= utc(tombstone["deleted_at"]):
+                del documents[tombstone["pk"]]
+    async for data in store.scan_since(created_after, identifiers):
+        documents[data["pk"]] = data
+    return write_snapshot(path, documents.values(), exported_at, identifiers)
+
+
+def main() -> None:
+    """Parse arguments and export a snapshot of the configured token store."""
+    from tokenvaultapi.stores import get_store
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--path", default=SNAPSHOT_PATH or "tokens.snapshot")
+    parser.add_argument(
+        "--identifier",
+        action="append",
+        dest="identifiers",
+        help="only export the tokens of this identifier, can be repeated",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only read what changed since the existing snapshot",
+    )
+    args = parser.parse_args()
+    count = asyncio.run(
+        export(get_store(), args.path, args.identifiers, args.incremental)
+    )
+    logger.info(f"Exported {count} tokens to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Token storage backends, selected with TOKEN_STORE."""
+from tokenvaultapi.config import (MEMORY_STORE_LATENCY_SECONDS,
+                                  SNAPSHOT_TOMBSTONES, SQLITE_PATH,
+                                  TOKEN_STORE)
+from tokenvaultapi.stores.base import TokenCollision, TokenExists, TokenStore
+
+_store = None
+
+
+def create_store() -> TokenStore:
+    """Create the configured token store, only importing its backend."""
+    if TOKEN_STORE == "sqlite":
+        from tokenvaultapi.stores.sqlite import SQLiteTokenStore
+
+        store = SQLiteTokenStore(SQLITE_PATH)
+    elif TOKEN_STORE == "firestore":
+        from tokenvaultapi.stores.firestore import FirestoreTokenStore
+
+        store = FirestoreTokenStore()
+    elif TOKEN_STORE == "memory":
+        from tokenvaultapi.stores.memory import MemoryTokenStore
+
+        store = MemoryTokenStore(MEMORY_STORE_LATENCY_SECONDS)
+    else:
+        raise ValueError(f"Unknown TOKEN_STORE {TOKEN_STORE}.")
+    store.tombstones = SNAPSHOT_TOMBSTONES
+    return store
+
+
+def get_store() -> TokenStore:
+    """Get the token store shared by DAOs created without one, created on first use."""
+    global _store
+    if _store is None:
+        _store = create_store()
+    return _store
+
+
+__all__ = [
+    "TokenCollision",
+    "TokenExists",
+    "TokenStore",
+    "create_store",
+    "get_store",
+]
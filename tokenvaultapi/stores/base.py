@@ -0,0 +1,143 @@
+"""Token store interface."""
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Tuple, Type
+
+from tokenvaultapi.schemas.token import Token, TokenFind
+
+
+class TokenExists(Exception):
+    """Raised when creating a token that already exists.
+
+    Also raised when another token of the identity and field has the same token, i.e.
+    the reverse index key of the token is taken.
+    """
+
+
+class TokenCollision(Exception):
+    """Raised when no token was found that no other token of its identity has."""
+
+
+def typed_value(data_type: str, value: Any) -> Any:
+    """Convert a value or token to its type."""
+    if data_type == "INT":
+        return int(value)
+    if data_type == "FLOAT":
+        return float(value)
+    return value
+
+
+def typed_token(token: Token) -> Token:
+    """Convert token to correct type."""
+    if token.type in ("INT", "FLOAT"):
+        token.token = typed_value(token.type, token.token)
+        token.value = typed_value(token.type, token.value)
+    return token
+
+
+TOKEN_FIELDS = set(Token.__fields__)
+# fields of the tombstones of deleted documents, besides deleted_at
+TOMBSTONE_FIELDS = ["pk", "identifier", "identity_token", "token", "field"]
+
+
+def token_from_dict(data: dict) -> Token:
+    """Build a token from stored data, which was validated when it was created."""
+    return typed_token(
+        Token.construct(**{key: data[key] for key in TOKEN_FIELDS if key in data})
+    )
+
+
+class TokenStore:
+    """Interface of a token storage backend.
+
+    Stores read and write batches of documents, the token DAO takes care of chunking,
+    concurrency and caching. Documents are the dicts of TokenCreate with the
+    identity_token set. Background jobs are stored as dicts by id.
+    """
+
+    # maximum number of documents per create_many or delete_many call
+    max_write_batch = 250
+    # errors of contention or overload, that calls are retried on with backoff
+    retryable_errors: Tuple[Type[Exception], ...] = ()
+    # record a tombstone of every deleted document, for snapshot replicas
+    tombstones = False
+
+    async def warm_up(self) -> None:
+        """Connect to the backend, so the first requests don't wait for it."""
+
+    async def close(self) -> None:
+        """Release the connections of the store."""
+
+    async def get_many(self, pks: List[str]) -> Dict[str, Token]:
+        """Get tokens by primary key, missing tokens are left out."""
+        raise NotImplementedError
+
+    async def find_many(self, token_finds: Dict[str, TokenFind]) -> Dict[str, Token]:
+        """Find tokens by token, keyed by their reverse index key."""
+        raise NotImplementedError
+
+    async def create_many(self, documents: List[dict]) -> None:
+        """Create token documents, raises TokenExists if any of them exists.
+
+        Documents are only created with their reverse index entry, so TokenExists is
+        also raised if the reverse key of any of them, see reverse_key_of, is taken by
+        another document or repeated in documents. Nothing is created if it is raised.
+        """
+        raise NotImplementedError
+
+    def scan(
+        self,
+        identifier: str,
+        identity: str,
+        fields: List[str] = None,
+        start_after: str = None,
+        limit: int = None,
+    ) -> AsyncIterator[dict]:
+        """Stream the documents of an identity in pk order.
+
+        Documents have their pk and only fields if given. start_after is the pk of the
+        last document of the previous page, limit the maximum number of documents.
+        """
+        raise NotImplementedError
+
+    async def list(self, identifier: str, identity: str) -> List[Token]:
+        """List the tokens of an identity."""
+        return [
+            token_from_dict(data) async for data in self.scan(identifier, identity)
+        ]
+
+    def scan_since(
+        self, created_after: datetime = None, identifiers: List[str] = None
+    ) -> AsyncIterator[dict]:
+        """Stream the documents created after a time, of identifiers if given.
+
+        Times are naive UTC datetimes. Documents are streamed in no particular order.
+        """
+        raise NotImplementedError
+
+    async def delete_many(self, documents: List[dict]) -> None:
+        """Delete token documents, given at least their pk and reverse key fields.
+
+        With tombstones set a tombstone of each document is recorded, see
+        deleted_since.
+        """
+        raise NotImplementedError
+
+    def deleted_since(self, deleted_after: datetime) -> AsyncIterator[dict]:
+        """Stream the tombstones of documents deleted after a naive UTC datetime.
+
+        Tombstones have the pk and reverse key fields of their document and the time
+        it was deleted at as deleted_at.
+        """
+        raise NotImplementedError
+
+    async def get_job(self, job_id: str) -> Dict[str, Any]:
+        """Get a background job, or None."""
+        raise NotImplementedError
+
+    async def set_job(self, job_id: str, data: Dict[str, Any]) -> None:
+        """Create or replace a background job."""
+        raise NotImplementedError
+
+    async def update_job(self, job_id: str, fields: Dict[str, Any]) -> None:
+        """Update fields of a background job."""
+        raise NotImplementedError
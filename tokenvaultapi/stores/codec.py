@@ -0,0 +1,130 @@
+"""Versioned schemas of stored token documents.
+
+- v1, the legacy schema: the dict of TokenCreate with the identity_token, every field
+  under its name, values and tokens as strings and the pk repeated in the document.
+- v2: short field names, see FIELDS, and the version in VERSION. The pk is only the
+  document id, field and method are left out at their defaults, values and tokens of
+  INT and FLOAT tokens are numbers so their type is left out too, and identity documents
+  leave out their value and token, which are their identity and identity token.
+
+Documents are written in TOKEN_SCHEMA_VERSION and read in either version. Values that
+don't survive a round trip through their type, like the INT token "0123", are kept as
+strings with their type, as in v1.
+"""
+from typing import Any, Dict, Tuple
+
+from tokenvaultapi.config import TOKEN_SCHEMA_VERSION
+from tokenvaultapi.schemas.token import Token
+from tokenvaultapi.stores.base import (TOKEN_FIELDS, token_from_dict,
+                                       typed_value)
+
+V1 = 1
+V2 = 2
+VERSION = "_v"
+# short name of every field in v2
+FIELDS = {
+    "identifier": "n",
+    "identity": "i",
+    "identity_token": "it",
+    "value": "v",
+    "token": "t",
+    "type": "y",
+    "field": "f",
+    "method": "m",
+    "created_at": "c",
+}
+DEFAULT_METHOD = "FORMAT_PRESERVING"
+# types of the tokens stored as numbers, by the type of the number
+NUMBER_TYPES = {int: "INT", float: "FLOAT"}
+
+
+def field_name(name: str, version: int) -> str:
+    """Get the stored name of a field in a schema version."""
+    return FIELDS[name] if version == V2 else name
+
+
+def numbers(data_type: str, value: Any, token: Any) -> Tuple[Any, Any]:
+    """Convert the value and token of an INT or FLOAT token to numbers.
+
+    Returns None if they are of another type or don't convert back to the same string.
+    """
+    if data_type not in NUMBER_TYPES.values():
+        return None
+    try:
+        converted = typed_value(data_type, value), typed_value(data_type, token)
+    except (TypeError, ValueError):
+        return None
+    if str(converted[0]) != str(value) or str(converted[1]) != str(token):
+        return None
+    return converted
+
+
+def encode(data: dict, version: int = TOKEN_SCHEMA_VERSION) -> Dict[str, Any]:
+    """Encode a token document to store it in a schema version."""
+    if version == V1:
+        return dict(data)
+    data_type = data.get("type") or "STRING"
+    stored = {
+        VERSION: V2,
+        "n": data["identifier"],
+        "i": data["identity"],
+        "it": data["identity_token"],
+        "c": data["created_at"],
+    }
+    if data.get("field"):
+        stored["f"] = data["field"]
+    if (
+        data_type == "STRING"
+        and data["value"] == data["identity"]
+        and data["token"] == data["identity_token"]
+        and not data.get("field")
+    ):
+        return stored
+    converted = numbers(data_type, data["value"], data["token"])
+    if converted is not None:
+        stored["v"], stored["t"] = converted
+    else:
+        stored["v"], stored["t"] = data["value"], data["token"]
+        if data_type != "STRING":
+            stored["y"] = data_type
+    if data.get("method", DEFAULT_METHOD) != DEFAULT_METHOD:
+        stored["m"] = data["method"]
+    return stored
+
+
+def _token_fields(pk: str, stored: Dict[str, Any]) -> Dict[str, Any]:
+    """Get the Token fields of a v2 document, or of the fields of it that were read."""
+    data = {name: stored[short] for name, short in FIELDS.items() if short in stored}
+    data.pop("method", None)
+    data["pk"] = pk
+    data.setdefault("field", "")
+    if "t" not in stored and "it" in stored:
+        # identity documents
+        data["token"] = stored["it"]
+        data["value"] = stored.get("i")
+    data.setdefault("type", NUMBER_TYPES.get(type(data.get("token")), "STRING"))
+    return data
+
+
+def decode(pk: str, stored: Dict[str, Any]) -> Dict[str, Any]:
+    """Decode a stored document of either version to a token document."""
+    if stored.get(VERSION) != V2:
+        return {**stored, "pk": pk}
+    data = _token_fields(pk, stored)
+    if "t" in stored:
+        data["method"] = stored.get("m", DEFAULT_METHOD)
+    return data
+
+
+def token_from_document(pk: str, stored: Dict[str, Any]) -> Token:
+    """Build a token from a stored document of either version.
+
+    v2 documents have every field of a token, with values as numbers already unless
+    they have a type, so they are set without the per field checks of Token.construct.
+    """
+    if stored.get(VERSION) != V2 or "y" in stored:
+        return token_from_dict(decode(pk, stored))
+    token = Token.__new__(Token)
+    object.__setattr__(token, "__dict__", _token_fields(pk, stored))
+    object.__setattr__(token, "__fields_set__", TOKEN_FIELDS)
+    return token
@@ -0,0 +1,314 @@
+"""Firestore token store."""
+import asyncio
+import heapq
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List
+
+from google.api_core.exceptions import (Aborted, AlreadyExists,
+                                        DeadlineExceeded, InternalServerError,
+                                        ResourceExhausted, ServiceUnavailable,
+                                        TooManyRequests)
+from google.cloud.firestore_v1.base_query import (BaseCompositeFilter,
+                                                  FieldFilter)
+from google.cloud.firestore_v1.types import StructuredQuery
+
+from tokenvaultapi.config import (LEGACY_SCHEMA_FALLBACK,
+                                  REVERSE_INDEX_FALLBACK, TOKEN_SCHEMA_VERSION)
+from tokenvaultapi.database import create_client
+from tokenvaultapi.keys import reverse_key_of
+from tokenvaultapi.schemas.token import Token, TokenFind
+from tokenvaultapi.stores.base import (TOMBSTONE_FIELDS, TokenExists,
+                                       TokenStore, token_from_dict)
+from tokenvaultapi.stores.codec import (V1, V2, VERSION, decode, encode,
+                                        field_name, token_from_document)
+
+
+class FirestoreTokenStore(TokenStore):
+    """Tokens stored in Firestore.
+
+    Every token document has a reverse index entry in a second collection, keyed by
+    its reverse key, so tokens are found by token with point reads. Keys missing from
+    the reverse index fall back to a query when reverse_index_fallback is set, i.e.
+    until the index has been backfilled.
+
+    Documents are written in schema_version and read in either version, see
+    tokenvaultapi.stores.codec. Queries match the documents of both versions when
+    legacy_schema_fallback is set, i.e. until the documents have been migrated.
+
+    Without a client one is created on first use, or by warm_up without blocking the
+    event loop.
+    """
+
+    collection_name = "tokens"
+    index_collection_name = "token_index"
+    jobs_collection_name = "jobs"
+    tombstones_collection_name = "token_tombstones"
+    # a write batch has at most 500 writes, two per document with its index entry
+    max_write_batch = 250
+    retryable_errors = (
+        Aborted,
+        DeadlineExceeded,
+        InternalServerError,
+        ResourceExhausted,
+        ServiceUnavailable,
+        TooManyRequests,
+    )
+
+    def __init__(
+        self,
+        client: Any = None,
+        reverse_index_fallback: bool = REVERSE_INDEX_FALLBACK,
+        schema_version: int = TOKEN_SCHEMA_VERSION,
+        legacy_schema_fallback: bool = LEGACY_SCHEMA_FALLBACK,
+    ) -> None:
+        self._client = client
+        self.reverse_index_fallback = reverse_index_fallback
+        self.schema_version = schema_version
+        # schema versions of the documents that queries match
+        self.query_versions = [V1, V2] if legacy_schema_fallback else [schema_version]
+
+    @property
+    def db(self) -> Any:
+        """Get the Firestore client, created on first use."""
+        if self._client is None:
+            self._client = create_client()
+        return self._client
+
+    async def warm_up(self) -> None:
+        if self._client is None:
+            client = await asyncio.to_thread(create_client)
+            if self._client is None:
+                self._client = client
+        # opens the channel and gets an access token
+        await self.db.collection(self.jobs_collection_name).document("warm-up").get()
+
+    async def close(self) -> None:
+        if self._client is None:
+            return
+        client, self._client = self._client, None
+        # the gRPC channel, which the client's close leaves open, if it was opened
+        if client._firestore_api_internal is not None:
+            await client._firestore_api_internal.transport.close()
+        client.close()
+
+    async def get_many(self, pks: List[str]) -> Dict[str, Token]:
+        collection = self.db.collection(self.collection_name)
+        tokens = {}
+        async for doc in self.db.get_all([collection.document(pk) for pk in pks]):
+            if doc.exists:
+                tokens[doc.id] = token_from_document(doc.id, doc.to_dict())
+        return tokens
+
+    async def find_many(self, token_finds: Dict[str, TokenFind]) -> Dict[str, Token]:
+        index = self.db.collection(self.index_collection_name)
+        pks = {}
+        async for doc in self.db.get_all([index.document(key) for key in token_finds]):
+            if doc.exists:
+                pks[doc.id] = doc.get("pk")
+        found = await self.get_many(list(set(pks.values()))) if pks else {}
+        tokens = {key: found[pk] for key, pk in pks.items() if pk in found}
+        if self.reverse_index_fallback:
+            for key, token_find in token_finds.items():
+                if key not in tokens:
+                    token = await self._query(token_find)
+                    if token:
+                        tokens[key] = token
+        return tokens
+
+    async def _query(self, token_find: TokenFind) -> Token:
+        """Find a token with a composite query on the tokens collection.
+
+        Only v1 documents may be missing from the reverse index, v2 documents are
+        created or migrated with their entry, unless their token is ambiguous.
+        """
+        identities_ref = self.db.collection(self.collection_name)
+        composite_filter = BaseCompositeFilter(
+            operator=StructuredQuery.CompositeFilter.Operator.AND,
+            filters=[
+                FieldFilter("identifier", "==", token_find.identifier),
+                FieldFilter("identity_token", "==", token_find.identity_token),
+                FieldFilter("token", "==", token_find.token),
+                FieldFilter("field", "==", token_find.field),
+            ],
+        )
+        composite_query = identities_ref.where(filter=composite_filter)
+        tokens = [
+            token_from_dict(doc.to_dict())
+            async for doc in composite_query.stream()
+            if doc.to_dict()
+        ]
+        if len(tokens) > 1:
+            raise Exception("More than one token found.")
+        if len(tokens) == 0:
+            return
+        else:
+            return tokens[0]
+
+    async def create_many(self, documents: List[dict]) -> None:
+        collection = self.db.collection(self.collection_name)
+        index = self.db.collection(self.index_collection_name)
+        batch = self.db.batch()
+        for data in documents:
+            batch.create(
+                collection.document(data["pk"]), encode(data, self.schema_version)
+            )
+            # fails if another token of the identity and field has the same token
+            batch.create(index.document(reverse_key_of(data)), {"pk": data["pk"]})
+        try:
+            await batch.commit()
+        except AlreadyExists as e:
+            # not Conflict, Aborted contention is one too and is retried instead
+            raise TokenExists(str(e))
+
+    def _identity_query(self, identifier: str, identity: str, version: int) -> Any:
+        """Query the tokens of an identity stored in a schema version."""
+        composite_filter = BaseCompositeFilter(
+            operator=StructuredQuery.CompositeFilter.Operator.AND,
+            filters=[
+                FieldFilter(field_name("identifier", version), "==", identifier),
+                FieldFilter(field_name("identity", version), "==", identity),
+            ],
+        )
+        return self.db.collection(self.collection_name).where(filter=composite_filter)
+
+    async def _scan(
+        self,
+        identifier: str,
+        identity: str,
+        version: int,
+        fields: List[str] = None,
+        start_after: str = None,
+        limit: int = None,
+    ) -> AsyncIterator[dict]:
+        """Stream the documents of an identity stored in a schema version."""
+        query = self._identity_query(identifier, identity, version)
+        if fields is not None:
+            selected = set(fields) - {"pk"}
+            if version == V2 and {"value", "token", "type"} & selected:
+                # derived from each other in identity and number documents
+                selected |= {"identity", "identity_token", "value", "token", "type"}
+            selected = [field_name(field, version) for field in sorted(selected)]
+            query = query.select(selected + ([VERSION] if version == V2 else []))
+        query = query.order_by("__name__")
+        if start_after:
+            query = query.start_after({"__name__": start_after})
+        if limit:
+            query = query.limit(limit)
+        async for doc in query.stream():
+            data = decode(doc.id, doc.to_dict())
+            if fields is not None:
+                names = ["pk", *fields]
+                data = {name: data[name] for name in names if name in data}
+            yield data
+
+    async def scan(
+        self,
+        identifier: str,
+        identity: str,
+        fields: List[str] = None,
+        start_after: str = None,
+        limit: int = None,
+    ) -> AsyncIterator[dict]:
+        if len(self.query_versions) == 1:
+            async for data in self._scan(
+                identifier, identity, self.query_versions[0], fields, start_after, limit
+            ):
+                yield data
+            return
+        # the query of each version streams in pk order, they are merged as they stream
+        streams = [
+            self._scan(identifier, identity, version, fields, start_after, limit)
+            for version in self.query_versions
+        ]
+        async for data in merge_by_pk(streams, limit):
+            yield data
+
+    async def scan_since(
+        self, created_after: datetime = None, identifiers: List[str] = None
+    ) -> AsyncIterator[dict]:
+        # without filters one query reads the documents of both versions
+        versions = self.query_versions
+        if created_after is None and not identifiers:
+            versions = versions[:1]
+        for version in versions:
+            query = self.db.collection(self.collection_name)
+            if identifiers:
+                query = query.where(
+                    filter=FieldFilter(
+                        field_name("identifier", version), "in", identifiers
+                    )
+                )
+            if created_after is not None:
+                query = query.where(
+                    filter=FieldFilter(
+                        field_name("created_at", version), ">", created_after
+                    )
+                )
+            async for doc in query.stream():
+                yield decode(doc.id, doc.to_dict())
+
+    async def delete_many(self, documents: List[dict]) -> None:
+        collection = self.db.collection(self.collection_name)
+        index = self.db.collection(self.index_collection_name)
+        tombstones = self.db.collection(self.tombstones_collection_name)
+        deleted_at = datetime.utcnow()
+        # a write batch has at most 500 writes
+        size = 500 // (3 if self.tombstones else 2)
+        for start in range(0, len(documents), size):
+            batch = self.db.batch()
+            for data in documents[start : start + size]:
+                batch.delete(collection.document(data["pk"]))
+                batch.delete(index.document(reverse_key_of(data)))
+                if self.tombstones:
+                    tombstone = {field: data.get(field) for field in TOMBSTONE_FIELDS}
+                    tombstone["deleted_at"] = deleted_at
+                    batch.set(tombstones.document(data["pk"]), tombstone)
+            await batch.commit()
+
+    async def deleted_since(self, deleted_after: datetime) -> AsyncIterator[dict]:
+        query = self.db.collection(self.tombstones_collection_name).where(
+            filter=FieldFilter("deleted_at", ">", deleted_after)
+        )
+        async for doc in query.stream():
+            yield doc.to_dict()
+
+    async def get_job(self, job_id: str) -> Dict[str, Any]:
+        doc = await self.db.collection(self.jobs_collection_name).document(job_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    async def set_job(self, job_id: str, data: Dict[str, Any]) -> None:
+        await self.db.collection(self.jobs_collection_name).document(job_id).set(data)
+
+    async def update_job(self, job_id: str, fields: Dict[str, Any]) -> None:
+        job = self.db.collection(self.jobs_collection_name).document(job_id)
+        await job.update(fields)
+
+
+async def merge_by_pk(
+    streams: List[AsyncIterator[dict]], limit: int = None
+) -> AsyncIterator[dict]:
+    """Merge streams of documents in pk order, reading one document ahead of each.
+
+    Stops after limit documents if it is given, and closes the streams.
+    """
+    heads = []
+
+    async def read(index: int) -> None:
+        try:
+            data = await streams[index].__anext__()
+        except StopAsyncIteration:
+            return
+        heapq.heappush(heads, (data["pk"], index, data))
+
+    try:
+        await asyncio.gather(*(read(index) for index in range(len(streams))))
+        count = 0
+        while heads and count != limit:
+            _, index, data = heapq.heappop(heads)
+            yield data
+            count += 1
+            if count != limit:
+                await read(index)
+    finally:
+        for stream in streams:
+            await stream.aclose()
@@ -0,0 +1,153 @@
+"""In-memory token store, for benchmarks and tests.
+
+It makes the same round trips as the Firestore store, e.g. a lookup by token reads the
+reverse index and then the tokens, and counts them. Every round trip can be delayed by
+an injected latency to stand in for the network.
+"""
+import asyncio
+import copy
+from collections import Counter
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List
+
+from tokenvaultapi.keys import reverse_key, reverse_key_of
+from tokenvaultapi.schemas.token import Token, TokenFind
+from tokenvaultapi.stores.base import (TOMBSTONE_FIELDS, TokenExists,
+                                       TokenStore, token_from_dict)
+
+
+class MemoryTokenStore(TokenStore):
+    """Tokens stored in dicts of the process."""
+
+    max_write_batch = 250
+    # documents per round trip when scanning the tokens of an identity
+    page_size = 1000
+
+    def __init__(self, latency: float = 0) -> None:
+        self.latency = latency
+        self.documents: Dict[str, dict] = {}
+        # pk by reverse key
+        self.index: Dict[str, str] = {}
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.deleted: Dict[str, dict] = {}
+        # round trips and documents read and written
+        self.rpcs = Counter()
+
+    async def _round_trip(self, kind: str, documents: int = 0) -> None:
+        """Count a round trip of documents and wait for the latency."""
+        self.rpcs[kind] += 1
+        self.rpcs[f"{kind}_documents"] += documents
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def get_many(self, pks: List[str]) -> Dict[str, Token]:
+        await self._round_trip("get", len(pks))
+        return {
+            pk: token_from_dict(self.documents[pk])
+            for pk in pks
+            if pk in self.documents
+        }
+
+    async def find_many(self, token_finds: Dict[str, TokenFind]) -> Dict[str, Token]:
+        await self._round_trip("get", len(token_finds))
+        pks = {}
+        for key, token_find in token_finds.items():
+            pk = self.index.get(
+                reverse_key(
+                    token_find.identifier,
+                    token_find.identity_token,
+                    token_find.token,
+                    token_find.field,
+                )
+            )
+            if pk:
+                pks[key] = pk
+        found = await self.get_many(list(set(pks.values()))) if pks else {}
+        return {key: found[pk] for key, pk in pks.items() if pk in found}
+
+    async def create_many(self, documents: List[dict]) -> None:
+        await self._round_trip("write", len(documents))
+        keys = set()
+        for data in documents:
+            if data["pk"] in self.documents:
+                raise TokenExists(data["pk"])
+            key = reverse_key_of(data)
+            if key in self.index or key in keys:
+                raise TokenExists(f"Reverse key {key} of {data['pk']} is taken.")
+            keys.add(key)
+        for data in documents:
+            # documents only have immutable values
+            self.documents[data["pk"]] = dict(data)
+            self.index[reverse_key_of(data)] = data["pk"]
+
+    async def scan(
+        self,
+        identifier: str,
+        identity: str,
+        fields: List[str] = None,
+        start_after: str = None,
+        limit: int = None,
+    ) -> AsyncIterator[dict]:
+        pks = sorted(
+            pk
+            for pk, data in self.documents.items()
+            if data["identifier"] == identifier
+            and data["identity"] == identity
+            and pk > (start_after or "")
+        )[:limit]
+        for start in range(0, max(len(pks), 1), self.page_size):
+            page = pks[start : start + self.page_size]
+            await self._round_trip("query", len(page))
+            for pk in page:
+                data = self.documents.get(pk)
+                if data is None:
+                    continue
+                if fields is not None:
+                    data = {field: data[field] for field in fields if field in data}
+                yield {**data, "pk": pk}
+
+    async def scan_since(
+        self, created_after: datetime = None, identifiers: List[str] = None
+    ) -> AsyncIterator[dict]:
+        pks = [
+            pk
+            for pk, data in self.documents.items()
+            if (created_after is None or data["created_at"] > created_after)
+            and (not identifiers or data["identifier"] in identifiers)
+        ]
+        for start in range(0, len(pks), self.page_size):
+            page = pks[start : start + self.page_size]
+            await self._round_trip("query", len(page))
+            for pk in page:
+                if pk in self.documents:
+                    yield dict(self.documents[pk])
+
+    async def delete_many(self, documents: List[dict]) -> None:
+        await self._round_trip("write", len(documents))
+        deleted_at = datetime.utcnow()
+        for data in documents:
+            self.documents.pop(data["pk"], None)
+            self.index.pop(reverse_key_of(data), None)
+            if self.tombstones:
+                self.deleted[data["pk"]] = {
+                    **{field: data.get(field) for field in TOMBSTONE_FIELDS},
+                    "deleted_at": deleted_at,
+                }
+
+    async def deleted_since(self, deleted_after: datetime) -> AsyncIterator[dict]:
+        await self._round_trip("query", len(self.deleted))
+        for tombstone in list(self.deleted.values()):
+            if tombstone["deleted_at"] > deleted_after:
+                yield dict(tombstone)
+
+    async def get_job(self, job_id: str) -> Dict[str, Any]:
+        await self._round_trip("get", 1)
+        return copy.deepcopy(self.jobs.get(job_id))
+
+    async def set_job(self, job_id: str, data: Dict[str, Any]) -> None:
+        await self._round_trip("write", 1)
+        self.jobs[job_id] = copy.deepcopy(data)
+
+    async def update_job(self, job_id: str, fields: Dict[str, Any]) -> None:
+        await self._round_trip("write", 1)
+        self.jobs[job_id].update(copy.deepcopy(fields))
@@ -0,0 +1,293 @@
+"""SQLite token store, for single node deployments and tests.
+
+The database runs in WAL mode so reads don't wait for writes. Each thread of the store's
+executor has its own connection, the event loop never waits on SQLite.
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Dict, List
+
+from tokenvaultapi.schemas.token import Token, TokenFind
+from tokenvaultapi.stores.base import (TOMBSTONE_FIELDS, TokenExists,
+                                       TokenStore, token_from_dict)
+
+COLUMNS = [
+    "pk",
+    "identifier",
+    "identity",
+    "identity_token",
+    "value",
+    "token",
+    "type",
+    "field",
+    "method",
+    "created_at",
+]
+SELECT = f"SELECT {', '.join(COLUMNS)} FROM tokens"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    pk TEXT PRIMARY KEY,
+    identifier TEXT NOT NULL,
+    identity TEXT NOT NULL,
+    identity_token TEXT NOT NULL,
+    value TEXT,
+    token TEXT,
+    type TEXT NOT NULL,
+    field TEXT NOT NULL,
+    method TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tokens_identity ON tokens (identifier, identity, pk);
+CREATE UNIQUE INDEX IF NOT EXISTS tokens_reverse_key
+    ON tokens (identifier, identity_token, token, field);
+CREATE INDEX IF NOT EXISTS tokens_created_at ON tokens (created_at);
+CREATE TABLE IF NOT EXISTS tombstones (
+    pk TEXT PRIMARY KEY,
+    identifier TEXT NOT NULL,
+    identity_token TEXT NOT NULL,
+    token TEXT,
+    field TEXT NOT NULL,
+    deleted_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tombstones_deleted_at ON tombstones (deleted_at);
+CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+"""
+
+
+def to_row(data: dict) -> tuple:
+    """Convert a token document to a row."""
+    row = {column: data.get(column) for column in COLUMNS}
+    row["field"] = row["field"] or ""
+    if isinstance(row["created_at"], datetime):
+        row["created_at"] = row["created_at"].isoformat()
+    for column in ("value", "token"):
+        if row[column] is not None:
+            row[column] = str(row[column])
+    return tuple(row.values())
+
+
+def from_row(row: tuple) -> Token:
+    """Convert a row to a token."""
+    data = dict(zip(COLUMNS, row))
+    data["created_at"] = datetime.fromisoformat(data["created_at"])
+    return token_from_dict(data)
+
+
+class SQLiteTokenStore(TokenStore):
+    """Tokens stored in a local SQLite database file."""
+
+    max_write_batch = 1000
+    # rows per query when scanning the tokens of an identity
+    page_size = 1000
+
+    def __init__(self, path: str, threads: int = 4, timeout: float = 30) -> None:
+        self.path = path
+        self.timeout = timeout
+        # connections to an in-memory database are separate databases
+        if path == ":memory:":
+            threads = 1
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix="sqlite")
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Get the connection of the current thread."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    async def _run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Run func with a connection in the executor."""
+
+        def run() -> Any:
+            return func(self._connection(), *args)
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, run)
+
+    async def warm_up(self) -> None:
+        await self._run(lambda connection: None)
+
+    async def close(self) -> None:
+        self._executor.shutdown()
+
+    async def _fetch(self, sql: str, parameters: tuple = ()) -> List[tuple]:
+        """Run a query and fetch all rows."""
+        return await self._run(
+            lambda connection: connection.execute(sql, parameters).fetchall()
+        )
+
+    async def get_many(self, pks: List[str]) -> Dict[str, Token]:
+        if not pks:
+            return {}
+        placeholders = ", ".join("?" * len(pks))
+        rows = await self._fetch(f"{SELECT} WHERE pk IN ({placeholders})", tuple(pks))
+        return {row[0]: from_row(row) for row in rows}
+
+    async def find_many(self, token_finds: Dict[str, TokenFind]) -> Dict[str, Token]:
+        def find(connection: sqlite3.Connection) -> Dict[str, tuple]:
+            found = {}
+            for key, token_find in token_finds.items():
+                row = connection.execute(
+                    f"{SELECT} WHERE identifier = ? AND identity_token = ?"
+                    " AND token = ? AND field = ?",
+                    (
+                        token_find.identifier,
+                        token_find.identity_token,
+                        str(token_find.token),
+                        token_find.field,
+                    ),
+                ).fetchone()
+                if row:
+                    found[key] = row
+            return found
+
+        rows = await self._run(find)
+        return {key: from_row(row) for key, row in rows.items()}
+
+    async def create_many(self, documents: List[dict]) -> None:
+        def create(connection: sqlite3.Connection) -> None:
+            placeholders = ", ".join("?" * len(COLUMNS))
+            with connection:
+                connection.executemany(
+                    f"INSERT INTO tokens ({', '.join(COLUMNS)})"
+                    f" VALUES ({placeholders})",
+                    [to_row(data) for data in documents],
+                )
+
+        try:
+            await self._run(create)
+        except sqlite3.IntegrityError as e:
+            raise TokenExists(str(e))
+
+    async def scan(
+        self,
+        identifier: str,
+        identity: str,
+        fields: List[str] = None,
+        start_after: str = None,
+        limit: int = None,
+    ) -> AsyncIterator[dict]:
+        fields = COLUMNS[1:] if fields is None else fields
+        if not set(fields) <= set(COLUMNS):
+            raise ValueError(f"Unknown fields {fields}.")
+        columns = ["pk"] + [field for field in fields if field != "pk"]
+        start_after = start_after or ""
+        remaining = limit
+        while remaining is None or remaining > 0:
+            page_size = min(remaining or self.page_size, self.page_size)
+            rows = await self._fetch(
+                f"SELECT {', '.join(columns)} FROM tokens"
+                " WHERE identifier = ? AND identity = ? AND pk > ? ORDER BY pk LIMIT ?",
+                (identifier, identity, start_after, page_size),
+            )
+            for row in rows:
+                data = dict(zip(columns, row))
+                if "created_at" in data:
+                    data["created_at"] = datetime.fromisoformat(data["created_at"])
+                yield data
+            if len(rows) < page_size:
+                return
+            start_after = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    async def scan_since(
+        self, created_after: datetime = None, identifiers: List[str] = None
+    ) -> AsyncIterator[dict]:
+        where = "created_at > ?"
+        parameters = (created_after.isoformat() if created_after else "",)
+        if identifiers:
+            where += f" AND identifier IN ({', '.join('?' * len(identifiers))})"
+            parameters += tuple(identifiers)
+        rowid = 0
+        while True:
+            rows = await self._fetch(
+                f"SELECT rowid, {', '.join(COLUMNS)} FROM tokens"
+                f" WHERE {where} AND rowid > ? ORDER BY rowid LIMIT ?",
+                parameters + (rowid, self.page_size),
+            )
+            for row in rows:
+                data = dict(zip(COLUMNS, row[1:]))
+                data["created_at"] = datetime.fromisoformat(data["created_at"])
+                yield data
+            if len(rows) < self.page_size:
+                return
+            rowid = rows[-1][0]
+
+    async def delete_many(self, documents: List[dict]) -> None:
+        deleted_at = datetime.utcnow().isoformat()
+
+        def delete(connection: sqlite3.Connection) -> None:
+            with connection:
+                connection.executemany(
+                    "DELETE FROM tokens WHERE pk = ?",
+                    [(data["pk"],) for data in documents],
+                )
+                if self.tombstones:
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO tombstones"
+                        f" ({', '.join(TOMBSTONE_FIELDS)}, deleted_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?)",
+                        [
+                            (
+                                data["pk"],
+                                data["identifier"],
+                                data["identity_token"],
+                                None if data["token"] is None else str(data["token"]),
+                                data.get("field") or "",
+                                deleted_at,
+                            )
+                            for data in documents
+                        ],
+                    )
+
+        await self._run(delete)
+
+    async def deleted_since(self, deleted_after: datetime) -> AsyncIterator[dict]:
+        rows = await self._fetch(
+            f"SELECT {', '.join(TOMBSTONE_FIELDS)}, deleted_at FROM tombstones"
+            " WHERE deleted_at > ?",
+            (deleted_after.isoformat(),),
+        )
+        for row in rows:
+            tombstone = dict(zip(TOMBSTONE_FIELDS + ["deleted_at"], row))
+            tombstone["deleted_at"] = datetime.fromisoformat(tombstone["deleted_at"])
+            yield tombstone
+
+    async def get_job(self, job_id: str) -> Dict[str, Any]:
+        rows = await self._fetch("SELECT data FROM jobs WHERE id = ?", (job_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def set_job(self, job_id: str, data: Dict[str, Any]) -> None:
+        def set_job(connection: sqlite3.Connection) -> None:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO jobs (id, data) VALUES (?, ?)",
+                    (job_id, json.dumps(data, default=str)),
+                )
+
+        await self._run(set_job)
+
+    async def update_job(self, job_id: str, fields: Dict[str, Any]) -> None:
+        def update_job(connection: sqlite3.Connection) -> None:
+            with connection:
+                (data,) = connection.execute(
+                    "SELECT data FROM jobs WHERE id = ?", (job_id,)
+                ).fetchone()
+                data = {**json.loads(data), **fields}
+                connection.execute(
+                    "UPDATE jobs SET data = ? WHERE id = ?",
+                    (json.dumps(data, default=str), job_id),
+                )
+
+        await self._run(update_job)
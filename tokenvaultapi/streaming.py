@@ -0,0 +1,190 @@
+"""Streaming bulk tokenization of newline delimited JSON or CSV rows.
+
+Rows are calls like those of the remote function request, identifier, identity (token)
+and value (token), with an optional field. They are read from the request body in
+chunks, each chunk is tokenized while the next chunks are read, and the replies of a
+chunk are written as soon as it is done, one reply per row in the order of the rows.
+Memory stays constant however many rows are streamed.
+
+CSV rows can't contain newlines, also not in quoted values. If a chunk fails, the
+stream ends with an error line, {"error": ...} in NDJSON or #error,... in CSV.
+"""
+import asyncio
+import csv
+import io
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Tuple
+
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from tokenvaultapi.config import STREAM_CHUNK_SIZE, STREAM_PREFETCH_CHUNKS
+from tokenvaultapi.logger import logger
+
+
+class StreamFormat:
+    """Parsing of rows and formatting of replies, newline delimited JSON."""
+
+    media_type = "application/x-ndjson"
+
+    def parse(self, lines: List[bytes], first_row: int) -> List[list]:
+        """Parse lines to calls, first_row is the number of the first line."""
+        calls = []
+        for row, line in enumerate(lines, first_row):
+            try:
+                call = json.loads(line)
+            except ValueError:
+                raise ValueError(f"Row {row} is not valid JSON.")
+            calls.append(validate_call(call, row))
+        return calls
+
+    def format(self, replies: List[Any]) -> bytes:
+        """Format replies, one line per reply."""
+        return "".join(json.dumps(reply) + "\n" for reply in replies).encode("UTF-8")
+
+    def format_error(self, message: str) -> bytes:
+        """Format an error line."""
+        return (json.dumps({"error": message}) + "\n").encode("UTF-8")
+
+
+class CSVStreamFormat(StreamFormat):
+    """Parsing of rows and formatting of replies, CSV without a header."""
+
+    media_type = "text/csv"
+
+    def parse(self, lines: List[bytes], first_row: int) -> List[list]:
+        reader = csv.reader(line.decode("UTF-8") for line in lines)
+        return [validate_call(call, row) for row, call in enumerate(reader, first_row)]
+
+    def format(self, replies: List[Any]) -> bytes:
+        output = io.StringIO()
+        csv.writer(output, lineterminator="\n").writerows([reply] for reply in replies)
+        return output.getvalue().encode("UTF-8")
+
+    def format_error(self, message: str) -> bytes:
+        output = io.StringIO()
+        csv.writer(output, lineterminator="\n").writerow(["#error", message])
+        return output.getvalue().encode("UTF-8")
+
+
+def stream_format(content_type: str) -> StreamFormat:
+    """Get the stream format of a content type, NDJSON unless it is CSV."""
+    if content_type.split(";")[0].strip() == CSVStreamFormat.media_type:
+        return CSVStreamFormat()
+    return StreamFormat()
+
+
+def validate_call(call: Any, row: int) -> list:
+    """Check that a row is a call of 3 or 4 values."""
+    if not isinstance(call, list) or len(call) not in (3, 4):
+        raise ValueError(f"Row {row} must have 3 or 4 values.")
+    if any(isinstance(value, (dict, list)) for value in call):
+        raise ValueError(f"Row {row} must only have scalar values.")
+    return call
+
+
+async def iter_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Split a stream of bytes into lines, skipping blank lines."""
+    buffer = b""
+    async for data in stream:
+        buffer += data
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+async def read_chunks(
+    stream: AsyncIterator[bytes], stream_format: StreamFormat, chunk_size: int
+) -> AsyncIterator[List[list]]:
+    """Read calls from a stream in chunks of at most chunk_size rows."""
+    lines = []
+    first_row = 1
+    async for line in iter_lines(stream):
+        lines.append(line)
+        if len(lines) == chunk_size:
+            yield stream_format.parse(lines, first_row)
+            first_row += len(lines)
+            lines = []
+    if lines:
+        yield stream_format.parse(lines, first_row)
+
+
+async def prefetch(items: AsyncIterator, size: int) -> AsyncIterator:
+    """Iterate items while a background task reads up to size items ahead."""
+    queue = asyncio.Queue(size)
+    done = object()
+
+    async def fill() -> None:
+        try:
+            async for item in items:
+                await queue.put(item)
+            await queue.put(done)
+        except Exception as e:
+            await queue.put(e)
+
+    task = asyncio.create_task(fill())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+
+
+async def peek(items: AsyncIterator) -> Tuple[Any, AsyncIterator]:
+    """Read the first of items, returns it, None if there are none, and all items."""
+    try:
+        first = await items.__anext__()
+    except StopAsyncIteration:
+        return None, items
+
+    async def all_items() -> AsyncIterator:
+        yield first
+        async for item in items:
+            yield item
+
+    return first, all_items()
+
+
+async def tokenize_stream(
+    stream: AsyncIterator[bytes],
+    stream_format: StreamFormat,
+    process: Callable[[List[list]], Awaitable[List[Any]]],
+    chunk_size: int = STREAM_CHUNK_SIZE,
+    prefetch_chunks: int = STREAM_PREFETCH_CHUNKS,
+) -> AsyncIterator[bytes]:
+    """Tokenize the rows of a stream with process, a chunk of calls at a time.
+
+    Chunks are processed one after the other so rows of the same identity in
+    consecutive chunks don't race to create it, while up to prefetch_chunks chunks
+    are read and parsed ahead.
+    """
+    chunks = prefetch(read_chunks(stream, stream_format, chunk_size), prefetch_chunks)
+    try:
+        async for calls in chunks:
+            yield stream_format.format(await process(calls))
+    except Exception as e:
+        logger.error(f"Streaming tokenization failed: {e}")
+        yield stream_format.format_error(str(e))
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    """Streaming response written while the request body is still being read.
+
+    StreamingResponse listens for the client disconnecting by receiving messages,
+    which would take chunks of the request body. Here the body is received by the
+    response content instead, which raises ClientDisconnect if the client goes away.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
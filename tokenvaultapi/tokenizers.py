@@ -0,0 +1,176 @@
+"""Tokenization of values.
+
+format_preserving_token and tokenize_value tokenize a single value. tokenize_values
+tokenizes a batch with the same semantics, generating random characters in bulk with
+os.urandom and replacing characters with bytes.translate and bitwise operations
+instead of one random.choice call and string concatenation per character.
+"""
+import hashlib
+import os
+import string
+from random import choice, randint, random
+from typing import Any, List, Sequence
+from uuid import UUID
+
+from tokenvaultapi.fpe import get_cipher
+
+
+def format_preserving_token(input_string) -> str:
+    """Create a token that preserves the format of the input string."""
+    token = ""
+    last_index = len(input_string) - 1
+    for index, char in enumerate(input_string):
+        if char.islower() and char.isalpha():
+            token += choice(string.ascii_lowercase)
+        elif char.isupper() and char.isalpha():
+            token += choice(string.ascii_uppercase)
+        elif char.isdigit() and index in (0, last_index):
+            token += choice("123456789")
+        elif char.isdigit():
+            token += choice(string.digits)
+        else:
+            token += char
+    return token
+
+
+def tokenize_value(method: str, data_type: str, val: Any, tweak: bytes = b"") -> str:
+    """Tokenize a value.
+
+    The tweak is only used by FORMAT_PRESERVING_ENCRYPTION, see encryption_tweak.
+    """
+    if method == "FORMAT_PRESERVING" and data_type in ["STRING", "INT", "FLOAT"]:
+        return format_preserving_token(val)
+    if method == "FORMAT_PRESERVING_ENCRYPTION":
+        return get_cipher().encrypt(str(val), data_type, tweak)
+    if method == "RANDOM":
+        if data_type == "INT":
+            return str(randint(0, 1000000))
+        if data_type == "FLOAT":
+            return str(random())
+        if data_type == "STRING":
+            hex_string = hashlib.md5(str(val).encode("UTF-8")).hexdigest()
+            return str(UUID(hex=hex_string))
+        else:
+            hex_string = hashlib.md5(str(val).encode("UTF-8")).hexdigest()
+            return str(UUID(hex=hex_string))
+
+
+class RandomCharacters:
+    """Uniformly random ASCII characters from an alphabet, generated in blocks.
+
+    Random bytes are mapped to the alphabet with bytes.translate. Bytes above the
+    largest multiple of the alphabet size are dropped, so every character is equally
+    likely.
+    """
+
+    def __init__(self, alphabet: str, block_size: int = 65536) -> None:
+        limit = 256 - 256 % len(alphabet)
+        self._table = bytes.maketrans(
+            bytes(range(limit)), alphabet.encode("ascii") * (limit // len(alphabet))
+        )
+        self._rejected = bytes(range(limit, 256))
+        self.block_size = block_size
+        self._buffer = b""
+        self._position = 0
+
+    def take(self, n: int) -> bytes:
+        """Take n random characters."""
+        end = self._position + n
+        if end > len(self._buffer):
+            blocks = [self._buffer[self._position :]]
+            size = len(blocks[0])
+            while size < n:
+                block = os.urandom(max(self.block_size, n - size)).translate(
+                    self._table, self._rejected
+                )
+                blocks.append(block)
+                size += len(block)
+            self._buffer = b"".join(blocks)
+            self._position = 0
+            end = n
+        characters = self._buffer[self._position : end]
+        self._position = end
+        return characters
+
+
+def character_mask(characters: str) -> bytes:
+    """Create a translation table mapping characters to 0xFF and other bytes to 0."""
+    table = bytearray(256)
+    for char in characters:
+        table[ord(char)] = 0xFF
+    return bytes(table)
+
+
+LOWERCASE_MASK = character_mask(string.ascii_lowercase)
+UPPERCASE_MASK = character_mask(string.ascii_uppercase)
+DIGITS_MASK = character_mask(string.digits)
+OTHER_MASK = bytes(
+    0xFF - a - b - c for a, b, c in zip(LOWERCASE_MASK, UPPERCASE_MASK, DIGITS_MASK)
+)
+
+
+def format_preserving_tokens(values: Sequence[str]) -> List[str]:
+    """Create tokens that preserve the format of a batch of strings.
+
+    Same semantics as format_preserving_token. ASCII values are tokenized together:
+    the batch is concatenated, and every character class is replaced at once by
+    masking a random string of that class with big integer bitwise operations.
+    Values with other characters use format_preserving_token.
+    """
+    ascii_values = [value for value in values if value.isascii()]
+    data = "".join(ascii_values).encode("ascii")
+    size = len(data)
+    to_int = int.from_bytes
+    result = to_int(data, "big") & to_int(data.translate(OTHER_MASK), "big")
+    for alphabet, mask in (
+        (string.ascii_lowercase, LOWERCASE_MASK),
+        (string.ascii_uppercase, UPPERCASE_MASK),
+        (string.digits, DIGITS_MASK),
+    ):
+        random_characters = RandomCharacters(alphabet).take(size)
+        result |= to_int(random_characters, "big") & to_int(data.translate(mask), "big")
+    tokenized = result.to_bytes(size, "big").decode("ascii")
+    nonzero_digits = RandomCharacters("123456789").take(2 * len(ascii_values))
+    digits = string.digits
+    tokens = []
+    start = 0
+    for index, value in enumerate(ascii_values):
+        end = start + len(value)
+        token = tokenized[start:end]
+        start = end
+        if value and value[0] in digits:
+            token = chr(nonzero_digits[2 * index]) + token[1:]
+        if value and value[-1] in digits:
+            token = token[:-1] + chr(nonzero_digits[2 * index + 1])
+        tokens.append(token)
+    if len(tokens) == len(values):
+        return tokens
+    ascii_tokens = iter(tokens)
+    return [
+        next(ascii_tokens) if value.isascii() else format_preserving_token(value)
+        for value in values
+    ]
+
+
+def tokenize_values(
+    method: str, data_type: str, values: Sequence[Any], tweaks: Sequence[bytes] = None
+) -> List[str]:
+    """Tokenize a batch of values, same semantics as tokenize_value."""
+    if method == "FORMAT_PRESERVING" and data_type in ["STRING", "INT", "FLOAT"]:
+        return format_preserving_tokens([str(val) for val in values])
+    if method == "FORMAT_PRESERVING_ENCRYPTION":
+        cipher = get_cipher()
+        return [
+            cipher.encrypt(str(val), data_type, tweak)
+            for val, tweak in zip(values, tweaks or [b""] * len(values))
+        ]
+    if method == "RANDOM":
+        if data_type == "INT":
+            return [str(randint(0, 1000000)) for _ in values]
+        if data_type == "FLOAT":
+            return [str(random()) for _ in values]
+        md5 = hashlib.md5
+        return [
+            str(UUID(hex=md5(str(val).encode("UTF-8")).hexdigest())) for val in values
+        ]
+    return [None] * len(values)